@@ -1,3 +1,6 @@
+from logging import getLogger
+log = getLogger('seantis.reservation')
+
 import six
 
 from dateutil import rrule
@@ -135,6 +138,12 @@ class AllocationAddForm(AllocationForm):
     def allocate(self, data):
         dates = self.get_dates(data)
 
+        def progress(written, total):
+            if total > self.scheduler.allocation_batch_size:
+                log.info('allocated {} of {} dates on {}'.format(
+                    written, total, self.context.absolute_url_path()
+                ))
+
         def allocate():
             self.scheduler.allocate(
                 dates,
@@ -144,7 +153,8 @@ class AllocationAddForm(AllocationForm):
                 grouped=data['recurring'] and not data['separately'],
                 approve_manually=data['approve_manually'],
                 quota_limit=data['reservation_quota_limit'],
-                whole_day=data['whole_day']
+                whole_day=data['whole_day'],
+                progress=progress
             )
             self.flash(_(u'Allocation added'))
 
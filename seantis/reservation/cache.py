@@ -0,0 +1,427 @@
+""" In-process caches for data which is expensive to compute, but which
+changes rarely compared to how often it is read.
+
+Caches are process-global and are shared by all threads of a Zope instance.
+They are invalidated by the events of this module, which only reach the
+instance the change is made on. Other ZEO clients rely on the maximum age
+of the cached entries to eventually pick up the change.
+
+"""
+
+import threading
+import time
+import transaction
+
+from collections import defaultdict
+
+from five import grok
+from plone import api
+from plone.app.workflow.interfaces import ILocalrolesModifiedEvent
+from Products.CMFCore.interfaces import IActionSucceededEvent
+from Products.PluggableAuthService.interfaces.events import (
+    IPrincipalDeletedEvent,
+    IPropertiesUpdatedEvent
+)
+from plone.registry.interfaces import IRecordModifiedEvent
+
+try:
+    # group membership events exist from Products.PluggableAuthService 1.11
+    from Products.PluggableAuthService.interfaces.events import (
+        IPrincipalAddedToGroupEvent,
+        IPrincipalRemovedFromGroupEvent
+    )
+except ImportError:
+    IPrincipalAddedToGroupEvent = IPrincipalRemovedFromGroupEvent = None
+
+from zope.lifecycleevent.interfaces import IObjectModifiedEvent
+from zope.lifecycleevent.interfaces import IObjectMovedEvent
+from zope.security import checkPermission
+
+from seantis.reservation import utils
+from seantis.reservation.interfaces import (
+    IEmailTemplate,
+    IReservationsApprovedEvent,
+    IReservationsConfirmedEvent,
+    IReservationsDeniedEvent,
+    IReservationsRevokedEvent,
+    IReservationTimeChangedEvent,
+    ITimeframe,
+)
+
+
+class TaggedCache(object):
+    """ Thread-safe cache with entries tagged by resource uuids. Invalidating
+    a uuid removes all entries tagged with it.
+
+    Each tag carries a generation which is increased on invalidation. Values
+    computed while an invalidation happened are not stored, as they might
+    have been computed from data which is already outdated.
+
+    """
+
+    def __init__(self, max_age, max_entries):
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.entries = utils.OrderedDict()
+            self.keys_by_tag = defaultdict(set)
+            self.generations = defaultdict(int)
+            self.epoch = 0
+
+    def _generation(self, tags):
+        return self.epoch, tuple(self.generations[tag] for tag in tags)
+
+    def generation(self, tags):
+        """ Returns the generation of the given tags, to be passed to
+        :meth:`set` once the value is computed.
+
+        """
+        with self.lock:
+            return self._generation(tags)
+
+    def _remove(self, key):
+        """ Removes the given entry together with its keys_by_tag references.
+        Must be called with the lock held.
+
+        """
+        entry = self.entries.pop(key, None)
+
+        if entry is None:
+            return
+
+        for tag in entry[2]:
+            keys = self.keys_by_tag.get(tag)
+
+            if keys is not None:
+                keys.discard(key)
+
+                if not keys:
+                    del self.keys_by_tag[tag]
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+
+        if entry is None:
+            return None
+
+        created, value, tags = entry
+
+        if time.time() - created > self.max_age:
+            return None
+
+        return value
+
+    def set(self, key, tags, value, generation):
+        with self.lock:
+            if self._generation(tags) != generation:
+                return False
+
+            # drop the oldest entry if the cache is full
+            if key in self.entries:
+                self._remove(key)
+            elif len(self.entries) >= self.max_entries:
+                self._remove(next(iter(self.entries)))
+
+            self.entries[key] = (time.time(), value, tuple(tags))
+
+            for tag in tags:
+                self.keys_by_tag[tag].add(key)
+
+        return True
+
+    def invalidate(self, tags):
+        with self.lock:
+            for tag in tags:
+                self.generations[tag] += 1
+
+                for key in tuple(self.keys_by_tag.get(tag, ())):
+                    self._remove(key)
+
+    def invalidate_all(self):
+        with self.lock:
+            self.epoch += 1
+            self.entries.clear()
+            self.keys_by_tag.clear()
+
+    def cached(self, key, tags, compute):
+        """ Returns the value for the given key, computing and storing it
+        first if necessary.
+
+        """
+        value = self.get(key)
+
+        if value is None:
+            generation = self.generation(tags)
+            value = compute()
+            self.set(key, tags, value, generation)
+
+        return value
+
+
+# the json responses of the calendar feeds (/slots and /overview)
+feeds = TaggedCache(max_age=5 * 60, max_entries=1000)
+
+# the timeframe index of each site (see timeframe.timeframe_index)
+timeframe_indexes = TaggedCache(max_age=5 * 60, max_entries=100)
+
+# the manager emails of each folder (see mail.get_manager_emails_by_context)
+manager_emails = TaggedCache(max_age=5 * 60, max_entries=1000)
+
+# the compiled user email templates of each folder and language
+# (see mail.get_compiled_email_content)
+email_templates = TaggedCache(max_age=60 * 60, max_entries=1000)
+
+# the pre-reservation script of each site
+# (see restricted_eval.get_pre_reserve_script)
+pre_reserve_scripts = TaggedCache(max_age=60, max_entries=100)
+
+# permissions which change the content of the calendar feeds
+feed_permissions = (
+    'zope2.View',
+    'cmf.ModifyPortalContent',
+    'seantis.reservation.SubmitReservation',
+    'seantis.reservation.ViewReservations',
+    'seantis.reservation.ViewHiddenAllocations',
+)
+
+
+def permission_set(context):
+    """ Returns a tuple identifying the feed-relevant permissions the current
+    user has on the given context.
+
+    """
+    return tuple(checkPermission(p, context) for p in feed_permissions)
+
+
+def feed_key(context, request, name, uuids, start, end, per_user=False):
+    """ Returns the key of a calendar feed response.
+
+    If per_user is True, the id of the current user is part of the key. This
+    is necessary if the feed contains resources other than the context,
+    as the permissions on those may differ from the ones on the context.
+
+    """
+    key = (
+        name,
+        context.absolute_url_path(),
+        tuple(sorted(uuids)),
+        start,
+        end,
+        utils.get_current_language(context, request),
+        permission_set(context)
+    )
+
+    if per_user:
+        if api.user.is_anonymous():
+            key += (None, )
+        else:
+            key += (api.user.get_current().getId(), )
+
+    return key
+
+
+def invalidate_after_commit(cache, tags=None):
+    """ Invalidates the given tags of the cache (or all of its entries if
+    no tags are given) right away and again once the current transaction is
+    committed.
+
+    The second invalidation catches values computed by concurrent requests
+    which still saw the state before the commit.
+
+    """
+
+    def invalidate(*args):
+        if tags is None:
+            cache.invalidate_all()
+        else:
+            cache.invalidate(tags)
+
+    invalidate()
+    transaction.get().addAfterCommitHook(invalidate)
+
+
+def invalidate_feeds(uuids):
+    """ Invalidates the calendar feeds of the given resource uuids now and
+    after the commit.
+
+    """
+    uuids = set(utils.string_uuid(u) for u in uuids)
+
+    if uuids:
+        invalidate_after_commit(feeds, uuids)
+
+
+def invalidate_all_feeds():
+    """ Invalidates all calendar feeds now and after the commit. """
+
+    invalidate_after_commit(feeds)
+
+
+def invalidate_timeframes():
+    """ Invalidates the timeframe indexes and all calendar feeds now and
+    after the commit.
+
+    """
+
+    invalidate_after_commit(timeframe_indexes)
+    invalidate_all_feeds()
+
+
+def invalidate_manager_emails():
+    """ Invalidates the manager emails of all folders now and after the
+    commit.
+
+    """
+
+    invalidate_after_commit(manager_emails)
+
+
+def invalidate_email_templates():
+    """ Invalidates the user email templates of all folders now and after
+    the commit.
+
+    """
+
+    invalidate_after_commit(email_templates)
+
+
+def invalidate_pre_reserve_scripts():
+    """ Invalidates the pre-reservation scripts of all sites now and after
+    the commit.
+
+    """
+
+    invalidate_after_commit(pre_reserve_scripts)
+
+
+def on_allocations_changed(context, allocations):
+    invalidate_feeds(set(a.mirror_of for a in allocations))
+
+
+def on_reservations_changed(context, reservations, *args, **kwargs):
+    invalidate_feeds(set(r.resource for r in reservations))
+
+
+def on_reservation_changed(context, reservation, *args, **kwargs):
+    invalidate_feeds([reservation.resource])
+
+
+def setup_libres_events():
+    """ Pending reservations and allocations are not covered by the
+    seantis.reservation events, so libres events are used for those.
+
+    Removed reservations are handled by the CustomScheduler, as the
+    reservations passed to on_reservations_removed are already deleted.
+
+    """
+    from libres.modules import events
+
+    subscribers = (
+        ('on_allocations_added', on_allocations_changed),
+        ('on_reservations_made', on_reservations_changed),
+        ('on_reservation_time_changed', on_reservation_changed),
+    )
+
+    for event, subscriber in subscribers:
+        libres_event = getattr(events, event)
+
+        if subscriber not in libres_event:
+            libres_event.append(subscriber)
+
+setup_libres_events()
+
+
+@grok.subscribe(IReservationsApprovedEvent)
+def on_reservations_approved(event):
+    on_reservations_changed(None, event.reservations)
+
+
+@grok.subscribe(IReservationsDeniedEvent)
+def on_reservations_denied(event):
+    on_reservations_changed(None, event.reservations)
+
+
+@grok.subscribe(IReservationsRevokedEvent)
+def on_reservations_revoked(event):
+    on_reservations_changed(None, event.reservations)
+
+
+@grok.subscribe(IReservationsConfirmedEvent)
+def on_reservations_confirmed(event):
+    on_reservations_changed(None, event.reservations)
+
+
+@grok.subscribe(IReservationTimeChangedEvent)
+def on_reservation_time_changed(event):
+    on_reservation_changed(None, event.reservation)
+
+
+# timeframes decide which allocations are exposed, as they may be defined
+# on any folder above a resource all feeds are invalidated. Moved events
+# include added and removed timeframes, as well as renamed folders
+@grok.subscribe(ITimeframe, IObjectMovedEvent)
+def on_timeframe_moved(timeframe, event):
+    invalidate_timeframes()
+
+
+@grok.subscribe(ITimeframe, IObjectModifiedEvent)
+def on_timeframe_modified(timeframe, event):
+    invalidate_timeframes()
+
+
+@grok.subscribe(ITimeframe, IActionSucceededEvent)
+def on_timeframe_transition(timeframe, event):
+    invalidate_timeframes()
+
+
+# the managers are found through the local roles of the folders and the
+# members of their groups. Roles assigned on the site are not notified and
+# neither are changed group memberships before PluggableAuthService 1.11,
+# those changes are picked up once the cached entries expire
+@grok.subscribe(ILocalrolesModifiedEvent)
+def on_local_roles_modified(event):
+    invalidate_manager_emails()
+
+
+@grok.subscribe(IPrincipalDeletedEvent)
+def on_principal_deleted(event):
+    invalidate_manager_emails()
+
+
+@grok.subscribe(IPropertiesUpdatedEvent)
+def on_properties_updated(event):
+    invalidate_manager_emails()
+
+
+if IPrincipalAddedToGroupEvent is not None:
+
+    @grok.subscribe(IPrincipalAddedToGroupEvent)
+    def on_principal_added_to_group(event):
+        invalidate_manager_emails()
+
+    @grok.subscribe(IPrincipalRemovedFromGroupEvent)
+    def on_principal_removed_from_group(event):
+        invalidate_manager_emails()
+
+
+# templates apply to the folder they are in and all folders below, moved
+# events include added and removed templates
+@grok.subscribe(IEmailTemplate, IObjectMovedEvent)
+def on_email_template_moved(template, event):
+    invalidate_email_templates()
+
+
+@grok.subscribe(IEmailTemplate, IObjectModifiedEvent)
+def on_email_template_modified(template, event):
+    invalidate_email_templates()
+
+
+@grok.subscribe(IRecordModifiedEvent)
+def on_registry_record_modified(event):
+    if event.record.__name__.endswith('.pre_reservation_script'):
+        invalidate_pre_reserve_scripts()
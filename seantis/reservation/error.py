@@ -44,6 +44,14 @@ class ThrottleBlock(ReservationError):
     pass
 
 
+class ScriptBudgetExceeded(CustomReservationError):
+
+    def __init__(self):
+        self.msg = _(
+            u'The reservation could not be validated. Please try again later.'
+        )
+
+
 errormap = {
 
     OverlappingAllocationError:
@@ -1,9 +1,13 @@
 import codecs
+import csv
 import isodate
+import os
+import tempfile
 
 from copy import copy
 from collections import namedtuple
 from datetime import datetime, date, time
+from itertools import chain
 
 from five import grok
 from zope import schema
@@ -16,6 +20,7 @@ from z3c.form import button
 
 from plone import api
 from plone.app.textfield.value import RichTextValue
+from ZPublisher.Iterators import filestream_iterator
 
 from seantis.plonetools import tools
 
@@ -23,10 +28,14 @@ from seantis.reservation import _
 from seantis.reservation import form
 from seantis.reservation import utils
 from seantis.reservation import exports
+from seantis.reservation import export_jobs
+from seantis.reservation import serializer
 from seantis.reservation.form import extract_action_data
 from seantis.reservation.base import BaseView, BaseForm
 
-Source = namedtuple('Source', ['id', 'title', 'description', 'method'])
+Source = namedtuple(
+    'Source', ['id', 'title', 'description', 'method', 'rows']
+)
 
 sources = [
     Source(
@@ -38,6 +47,11 @@ sources = [
         lambda resources, language, year, month, transform_record:
         exports.reservations.dataset(
             resources, language, year, month, transform_record, compact=False
+        ),
+        lambda resources, language, year, month, transform_record:
+        exports.reservations.rows(
+            resources, language, year, month, transform_record, compact=False,
+            stream=True
         )
     ),
 
@@ -51,6 +65,11 @@ sources = [
         lambda resources, language, year, month, transform_record:
         exports.reservations.dataset(
             resources, language, year, month, transform_record, compact=True
+        ),
+        lambda resources, language, year, month, transform_record:
+        exports.reservations.rows(
+            resources, language, year, month, transform_record, compact=True,
+            stream=True
         )
     )
 ]
@@ -63,6 +82,43 @@ extensions = {
     'json': _(u'JSON Format'),
 }
 
+content_types = {
+    'xls': 'application/xls',
+    'xlsx': 'application/xlsx',
+    'csv': 'application/csv',
+    'json': 'application/json',
+}
+
+# formats which are built in memory and are therefore exported in the
+# background (see export_jobs)
+background_formats = ('xls', 'xlsx')
+
+
+def get_source_by_id(source_id):
+    source = next((s for s in sources if s.id == source_id), None)
+
+    if not source:
+        raise NotImplementedError
+
+    return source
+
+
+def export_filename(title, source_title, year, month, extension):
+    parts = [title, source_title]
+
+    if year not in ('any', 'all'):
+        parts.append(year)
+
+    if month not in ('any', 'all'):
+        if len(month) == 1:
+            parts.append('0{}'.format(month))
+        else:
+            parts.append(month)
+
+    parts.append(extension)
+
+    return '.'.join(parts)
+
 
 def get_sources_description(request):
     translate = tools.translator(request, 'seantis.reservation')
@@ -201,10 +257,47 @@ class ExportSelection(BaseForm, form.ResourceParameterView):
         )
         super(ExportSelection, self).update()
 
+    def start_export_job(self, data):
+        if not self.uuids:
+            utils.form_error(_(u"Missing 'uuid' parameter"))
+
+        translate = tools.translator(self.request, 'seantis.reservation')
+
+        job = export_jobs.ExportJob(
+            site_path='/'.join(api.portal.get().getPhysicalPath()),
+            user_id=api.user.get_current().getId(),
+            source=data['export'],
+            format=data['format'],
+            resources=dict(
+                (uuid, '/'.join(resource.getPhysicalPath()))
+                for uuid, resource in self.resources.items()
+            ),
+            language=self.request.get('lang', 'en'),
+            year=data['year'],
+            month=data['month'],
+            filename=export_filename(
+                self.context.title,
+                translate(get_source_by_id(data['export']).title),
+                data['year'],
+                data['month'],
+                data['format']
+            )
+        )
+
+        return export_jobs.enqueue(job)
+
     @button.buttonAndHandler(_(u'Export'))
     @extract_action_data
     def export(self, data):
-        self.request.response.redirect(self.build_export_url(data))
+        if data['format'] in background_formats:
+            job = self.start_export_job(data)
+            self.request.response.redirect(
+                u'{base}/reservation-export-job?id={id}'.format(
+                    base=self.context.absolute_url(), id=job.id
+                )
+            )
+        else:
+            self.request.response.redirect(self.build_export_url(data))
 
     @button.buttonAndHandler(_(u'Cancel'))
     @extract_action_data
@@ -250,6 +343,52 @@ def prepare_record(record, target_format):
     return record
 
 
+def encode_csv_value(value):
+    if value is None:
+        return ''
+
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+
+    return value
+
+
+def write_csv(stream, headers, records):
+    """ Writes the headers and records to the given stream in the same csv
+    format tablib uses.
+
+    """
+    writer = csv.writer(stream)
+
+    for record in chain((headers, ), records):
+        writer.writerow([encode_csv_value(value) for value in record])
+
+
+def encode_json_value(value):
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+
+    return unicode(value)
+
+
+def write_json(stream, headers, records):
+    """ Writes the records to the given stream as a list of objects with the
+    headers as keys, like tablib does.
+
+    """
+    stream.write('[')
+
+    for ix, record in enumerate(records):
+        if ix != 0:
+            stream.write(', ')
+
+        stream.write(serializer.dumps(
+            utils.OrderedDict(zip(headers, record)), encode_json_value
+        ))
+
+    stream.write(']')
+
+
 class ExportView(BaseView, form.ResourceParameterView):
     """Exports the reservations from a list of resources. """
 
@@ -260,12 +399,11 @@ class ExportView(BaseView, form.ResourceParameterView):
     grok.baseclass()
 
     def get_source_by_id(self, source_id):
-        source = next((s for s in sources if s.id == source_id), None)
+        return get_source_by_id(source_id)
 
-        if not source:
-            raise NotImplementedError
-
-        return source
+    # if set, the export is written to a temporary file record by record
+    # and streamed from there, instead of being built in memory
+    stream_writer = None
 
     @property
     def content_type(self):
@@ -301,30 +439,36 @@ class ExportView(BaseView, form.ResourceParameterView):
         )
 
     @property
-    def filename(self):
-        parts = []
+    def stream_source(self):
+        source = self.get_source_by_id(self.request.get('source'))
+        transform_record = lambda r: prepare_record(r, self.file_extension)
 
-        parts.append(self.context.title)
+        return lambda: source.rows(
+            self.resources,
+            self.language,
+            self.year,
+            self.month,
+            transform_record
+        )
 
+    @property
+    def filename(self):
         source = self.get_source_by_id(self.request.get('source'))
         translate = tools.translator(self.request, 'seantis.reservation')
-        parts.append(translate(source.title))
-
-        if self.year not in ('any', 'all'):
-            parts.append(self.year)
-
-        if self.month not in ('any', 'all'):
-            if len(self.month) == 1:
-                parts.append('0{}'.format(self.month))
-            else:
-                parts.append(self.month)
 
-        parts.append(self.file_extension)
-
-        return '.'.join(parts)
+        return export_filename(
+            self.context.title,
+            translate(source.title),
+            self.year,
+            self.month,
+            self.file_extension
+        )
 
     def render(self, **kwargs):
-        output = getattr(self.source(), self.file_extension)
+        if self.stream_writer is not None:
+            output = self.stream()
+        else:
+            output = getattr(self.source(), self.file_extension)
 
         RESPONSE = self.request.RESPONSE
         RESPONSE.setHeader(
@@ -338,26 +482,122 @@ class ExportView(BaseView, form.ResourceParameterView):
 
         return output
 
+    def stream(self):
+        """ Writes the export to a temporary file and returns a stream
+        iterator over it. The file is unlinked right away, it is removed
+        once the iterator is closed.
+
+        """
+        headers, records = self.stream_source()
+
+        handle, path = tempfile.mkstemp(suffix='.' + self.file_extension)
+
+        try:
+            with os.fdopen(handle, 'wb') as stream:
+                self.stream_writer(stream, headers, records)
+
+            return filestream_iterator(path, 'rb')
+        finally:
+            os.unlink(path)
+
 
 class XlsExportView(ExportView):
     grok.name('reservation-export.xls')
-    content_type = 'application/xls'
+    content_type = content_types['xls']
     file_extension = 'xls'
 
 
 class XlsxExportView(ExportView):
     grok.name('reservation-export.xlsx')
-    content_type = 'application/xlsx'
+    content_type = content_types['xlsx']
     file_extension = 'xlsx'
 
 
 class JsonExportView(ExportView):
     grok.name('reservation-export.json')
-    content_type = 'application/json'
+    content_type = content_types['json']
     file_extension = 'json'
+    stream_writer = staticmethod(write_json)
 
 
 class CsvExportView(ExportView):
     grok.name('reservation-export.csv')
-    content_type = 'application/csv'
+    content_type = content_types['csv']
     file_extension = 'csv'
+    stream_writer = staticmethod(write_csv)
+
+
+class ExportJobMixin(object):
+
+    @utils.cached_property
+    def job(self):
+        export_jobs.remove_expired_jobs()
+
+        job = export_jobs.get_job(self.request.get('id'))
+
+        # jobs are only visible to the user who started them
+        if job is None or job.user_id != api.user.get_current().getId():
+            return None
+
+        return job
+
+
+class ExportJobView(BaseView, ExportJobMixin):
+    """ Shows the state of a background export and links to the file once
+    the export is finished.
+
+    """
+
+    permission = 'seantis.reservation.ViewReservations'
+    grok.require(permission)
+
+    grok.context(Interface)
+    grok.name('reservation-export-job')
+
+    template = grok.PageTemplateFile('templates/export_job.pt')
+
+    # seconds after which the page is reloaded while the export is running
+    refresh_interval = 5
+
+    @property
+    def running(self):
+        return self.job is not None and self.job.pending
+
+    @property
+    def download_url(self):
+        return u'{base}/reservation-export-download?id={id}'.format(
+            base=self.context.absolute_url(), id=self.job.id
+        )
+
+
+class ExportDownloadView(BaseView, ExportJobMixin):
+    """ Serves the file of a finished background export. """
+
+    permission = 'seantis.reservation.ViewReservations'
+    grok.require(permission)
+
+    grok.context(Interface)
+    grok.name('reservation-export-download')
+
+    def render(self, **kwargs):
+        job = self.job
+
+        if job is None or job.state != 'finished' or job.expired:
+            self.request.response.setStatus(404)
+            return u''
+
+        RESPONSE = self.request.RESPONSE
+        RESPONSE.setHeader(
+            "Content-disposition",
+            'filename="{}"'.format(codecs.utf_8_encode(job.filename)[0])
+        )
+        RESPONSE.setHeader(
+            "Content-Type", "{};charset=utf-8".format(
+                content_types[job.format]
+            )
+        )
+
+        output = filestream_iterator(job.path, 'rb')
+        RESPONSE.setHeader("Content-Length", len(output))
+
+        return output
@@ -0,0 +1,269 @@
+""" Runs exports in the background and keeps the resulting files in a spool
+directory until they are downloaded.
+
+Exports which are too large to be run within a request are put into a queue
+processed by a small number of worker threads. Each worker opens its own
+ZODB connection to load the resources, writes the export into the spool
+directory and marks the job as finished, at which point the status view
+offers the file for download.
+
+Jobs are identified by their parameters, so starting the same export twice
+while the first one is still queued or running returns the existing job.
+Starting it again later runs the export anew, so the file is up to date.
+
+The spool directory may be configured using the product-config of
+seantis.reservation (export-spool), otherwise a directory in the systems
+temporary directory is used.
+
+"""
+
+from logging import getLogger
+log = getLogger('seantis.reservation')
+
+import hashlib
+import os
+import Queue
+import tempfile
+import threading
+import time
+import transaction
+
+from Testing.makerequest import makerequest
+from zope.component.hooks import setSite
+
+from seantis.reservation import utils
+
+_jobs = dict()  # the known jobs by id
+_workers = list()  # the running worker threads
+_queue = Queue.Queue()
+
+locks = {
+    '_jobs': threading.Lock(),
+    '_workers': threading.Lock()
+}
+
+# the number of exports which may run at the same time
+max_workers = 2
+
+# the number of seconds a finished export is kept in the spool directory,
+# and a failed export is reported as such
+max_age = 60 * 60
+
+
+def spool_directory():
+    """ Returns the directory the exports are written to, creating it if
+    necessary.
+
+    """
+    try:
+        path = utils.get_config('export-spool')
+    except utils.ConfigurationError:
+        path = None
+
+    path = path or os.path.join(
+        tempfile.gettempdir(), 'seantis.reservation.exports'
+    )
+
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            # another thread might have been quicker
+            if not os.path.isdir(path):
+                raise
+
+    return path
+
+
+class ExportJob(object):
+    """ An export running in the background. """
+
+    def __init__(
+        self, site_path, user_id, source, format, resources, language,
+        year, month, filename
+    ):
+        self.site_path = site_path
+        self.user_id = user_id
+        self.source = source
+        self.format = format
+        self.resources = resources  # uuid -> physical path of the resource
+        self.language = language
+        self.year = year
+        self.month = month
+        self.filename = filename
+
+        self.state = 'queued'
+        self.finished = None
+
+    @property
+    def id(self):
+        """ The id of the job, derived from its parameters. """
+
+        parameters = (
+            self.site_path, self.user_id, self.source, self.format,
+            sorted(self.resources.items()), self.language, self.year,
+            self.month
+        )
+
+        return hashlib.sha1(repr(parameters)).hexdigest()
+
+    @property
+    def path(self):
+        return os.path.join(spool_directory(), '{}.{}'.format(
+            self.id, self.format
+        ))
+
+    @property
+    def pending(self):
+        return self.state in ('queued', 'running')
+
+    @property
+    def expired(self):
+        if self.state not in ('finished', 'failed'):
+            return False
+
+        if time.time() - self.finished > max_age:
+            return True
+
+        # the spool directory might have been cleaned up by someone else
+        return self.state == 'finished' and not os.path.exists(self.path)
+
+    def run(self, site):
+        """ Runs the export on the given site and writes the result to the
+        spool directory.
+
+        """
+        # keep direct imports out of the module as the export module
+        # imports this one
+        from seantis.reservation.export import get_source_by_id, prepare_record
+
+        self.state = 'running'
+
+        # the file is written under a temporary name first, so the download
+        # never sees an incomplete export
+        handle, path = tempfile.mkstemp(dir=spool_directory())
+
+        try:
+            resources = dict(
+                (uuid, site.unrestrictedTraverse(resource_path))
+                for uuid, resource_path in self.resources.items()
+            )
+
+            dataset = get_source_by_id(self.source).method(
+                resources, self.language, self.year, self.month,
+                lambda record: prepare_record(record, self.format)
+            )
+
+            with os.fdopen(handle, 'wb') as spool:
+                spool.write(getattr(dataset, self.format))
+
+            os.rename(path, self.path)
+
+        except Exception:
+            log.exception('export {} failed'.format(self.id))
+            self.finished = time.time()
+            self.state = 'failed'
+
+            if os.path.exists(path):
+                os.remove(path)
+
+            raise
+
+        self.finished = time.time()
+        self.state = 'finished'
+
+    def run_in_worker(self):
+        """ Runs the export with a separate ZODB connection. """
+
+        # Zope2 is only imported when needed as it may not be configured
+        # during imports in testing
+        import Zope2
+        app = makerequest(Zope2.app())
+
+        try:
+            site = app.unrestrictedTraverse(self.site_path)
+            setSite(site)
+
+            self.run(site)
+        finally:
+            transaction.abort()
+            setSite(None)
+            app._p_jar.close()
+
+
+def worker():
+    while True:
+        job = _queue.get()
+
+        try:
+            job.run_in_worker()
+        except Exception:
+            # errors of the export itself are logged by the job already
+            log.exception('export worker failed to run {}'.format(job.id))
+        finally:
+            _queue.task_done()
+
+
+def start_workers():
+    with locks['_workers']:
+        while len(_workers) < max_workers:
+            thread = threading.Thread(
+                target=worker, name='seantis.reservation.export'
+            )
+            thread.daemon = True
+            thread.start()
+
+            _workers.append(thread)
+
+
+def enqueue(job, start=True):
+    """ Adds the given job to the queue and returns it. If there is already
+    a job with the same parameters which is queued or running, that job is
+    returned instead.
+
+    If start is False, the job is registered, but not put into the queue.
+
+    """
+    remove_expired_jobs()
+
+    with locks['_jobs']:
+        existing = _jobs.get(job.id)
+
+        if existing is not None and existing.pending:
+            return existing
+
+        _jobs[job.id] = job
+
+    if start:
+        start_workers()
+        _queue.put(job)
+
+    return job
+
+
+def get_job(job_id):
+    return _jobs.get(job_id)
+
+
+def remove_expired_jobs():
+    with locks['_jobs']:
+        expired = [job for job in _jobs.values() if job.expired]
+
+        for job in expired:
+            del _jobs[job.id]
+
+    for job in expired:
+        if os.path.exists(job.path):
+            os.remove(job.path)
+
+
+def clear_jobs():
+    """ Clears the jobs and their files for testing. """
+
+    with locks['_jobs']:
+        jobs = _jobs.values()
+        _jobs.clear()
+
+    for job in jobs:
+        if os.path.exists(job.path):
+            os.remove(job.path)
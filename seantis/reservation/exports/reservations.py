@@ -3,6 +3,8 @@ import tablib
 from zope import i18n
 from zope.i18nmessageid import Message
 
+from sqlalchemy import cast, func, select, Numeric
+from sqlalchemy.dialects.postgresql import JSON
 from sqlalchemy.sql.expression import extract
 
 from seantis.reservation import _
@@ -12,6 +14,10 @@ from seantis.reservation.form import ReservationDataView
 from libres.db.models import Reservation
 
 
+# the number of reservations fetched at once when streaming an export
+stream_batch_size = 500
+
+
 class Translator(object):
 
     def __init__(self, language):
@@ -71,21 +77,58 @@ def dataset(
 
     """
 
+    return generate_dataset(*rows(
+        resources, language, year, month, transform_record, compact
+    ))
+
+
+def rows(
+    resources, language, year, month, transform_record=None, compact=False,
+    stream=False
+):
+    """ Same as :func:`dataset`, but returns the headers and a generator of
+    records instead of a tablib dataset.
+
+    If stream is True, the reservations are not loaded all at once, but
+    fetched from the database in batches while the records are generated.
+    This keeps the memory use bounded for large exports, at the cost of
+    reading the reservations twice (once to collect the headers).
+
+    """
+
     translator = Translator(language)
-    reservations = fetch_records(resources, year, month)
+
+    if stream:
+        reservations = stream_records(resources, year, month)
+        dataheaders = discover_headers(resources, year, month)
+    else:
+        reservations = fetch_records(resources, year, month)
+        dataheaders = additional_headers(reservations)
 
     # create the headers
     headers = translator.translate(basic_headers())
-    dataheaders = additional_headers(reservations)
     headers.extend(dataheaders)
 
+    records = generate_records(
+        resources, reservations, dataheaders, translator, transform_record,
+        compact
+    )
+
+    return headers, records
+
+
+def generate_records(
+    resources, reservations, dataheaders, translator, transform_record,
+    compact
+):
     # use dataview for display info helper view (yep, could be nicer)
     dataview = ReservationDataView()
 
+    positions = header_positions(dataheaders)
+
     # for each reservation get a record per timeslot (which is a single slot
     # for reservations targeting an allocation and n slots for a reservation
     # targeting a group)
-    records = []
     for r in reservations:
 
         token = utils.string_uuid(r.token)
@@ -112,7 +155,7 @@ def dataset(
             ]
             record.extend(
                 additional_columns(
-                    r, dataheaders, dataview.display_reservation_data
+                    r, positions, dataview.display_reservation_data
                 )
             )
 
@@ -120,10 +163,7 @@ def dataset(
                 transform_record(record)
 
             translator.translate(record)
-            records.append(record)
-
-    # put the results in a tablib dataset
-    return generate_dataset(headers, records)
+            yield record
 
 
 def fetch_records(resources, year, month):
@@ -131,7 +171,28 @@ def fetch_records(resources, year, month):
     if not resources.keys():
         return []
 
-    query = Session().query(Reservation)
+    return records_query(resources, year, month).all()
+
+
+def stream_records(resources, year, month, *columns):
+    """ Returns an iterator over the records used for the dataset, fetched
+    from the database in batches. If columns are given, only those are
+    fetched instead of the whole reservations.
+
+    """
+    if not resources.keys():
+        return []
+
+    query = records_query(resources, year, month, *columns)
+    query = query.execution_options(stream_results=True)
+
+    return query.yield_per(stream_batch_size)
+
+
+def records_query(resources, year, month, *columns):
+    """ Returns the query for the records used for the dataset. """
+
+    query = Session().query(*(columns or (Reservation, )))
     query = query.filter(Reservation.resource.in_(resources.keys()))
 
     if year != 'all':
@@ -140,7 +201,13 @@ def fetch_records(resources, year, month):
     if month != 'all':
         query = query.filter(extract('month', Reservation.start) == int(month))
 
-    query = query.order_by(
+    query = query.order_by(*records_order())
+
+    return query
+
+
+def records_order():
+    return (
         Reservation.resource,
         Reservation.status,
         Reservation.start,
@@ -148,8 +215,6 @@ def fetch_records(resources, year, month):
         Reservation.token,
     )
 
-    return query.all()
-
 
 def fieldkey(form, field):
     """ Returns the fieldkey for any given json data field + form. """
@@ -159,41 +224,136 @@ def fieldkey(form, field):
 def additional_headers(reservations):
     """ Go through all reservations and build a list of all possible headers.
 
+    The forms of each reservation are gone through by form key, the fields
+    of each form by their sortkey.
+
     """
 
-    formdata = [r.data.values() for r in reservations if r.data]
+    formdata = [
+        [r.data[key] for key in sorted(r.data)] for r in reservations if r.data
+    ]
 
     headers = []
+    known = set()
     for forms in formdata:
         for form in forms:
             for field in sorted(form["values"], key=lambda f: f["sortkey"]):
 
-                # A set could be used here, but then a separate step for
-                # sorting would be needed
+                # the list keeps the order, the set speeds up the lookup
                 key = fieldkey(form, field)
-                if key not in headers:
+                if key not in known:
                     headers.append(key)
+                    known.add(key)
+
+    return headers
+
+
+def supports_json_functions(session):
+    """ Returns true if the database offers the json functions used by
+    :func:`discover_headers` (PostgreSQL 9.3+).
+
+    """
+    return session.connection().dialect.server_version_info >= (9, 3)
+
+
+def discover_headers(resources, year, month):
+    """ Returns the same headers as :func:`additional_headers` for the
+    reservations returned by :func:`fetch_records`, without loading them.
+
+    The form and field descriptions are read by the database, which returns
+    the first occurrence of each header. Those are then put in the same order
+    additional_headers would put them.
+
+    """
+    if not resources.keys():
+        return []
+
+    if not supports_json_functions(Session()):
+        return additional_headers(
+            stream_records(resources, year, month, Reservation.data)
+        )
+
+    position = func.row_number().over(order_by=records_order())
+    data = cast(Reservation.data, JSON)
+
+    # one row per reservation and form
+    forms = records_query(
+        resources, year, month,
+        position.label('position'),
+        data.label('data'),
+        func.json_object_keys(data).label('formkey')
+    )
+    forms = forms.filter(Reservation.data.isnot(None)).order_by(None)
+    forms = forms.subquery('forms')
+
+    # one row per reservation, form and field
+    form = forms.c.data[forms.c.formkey]
+    fields = select([
+        forms.c.position,
+        forms.c.formkey,
+        form['desc'].astext.label('form'),
+        func.json_array_elements(form['values'], type_=JSON).label('field')
+    ]).alias('fields')
+
+    # the first occurrence of each header
+    field = fields.c.field['desc'].astext
+    sortkey = cast(fields.c.field['sortkey'].astext, Numeric)
+
+    query = select([
+        fields.c.form,
+        field,
+        fields.c.position,
+        fields.c.formkey,
+        sortkey
+    ])
+    query = query.distinct(fields.c.form, field)
+    query = query.order_by(
+        fields.c.form, field, fields.c.position, fields.c.formkey, sortkey
+    )
+
+    occurrences = Session().execute(query).fetchall()
+    occurrences.sort(key=lambda o: (o[2], o[3], o[4]))
+
+    headers = []
+    known = set()
+    for form, field, position, formkey, sortkey in occurrences:
+        key = fieldkey({'desc': form}, {'desc': field})
+
+        if key not in known:
+            headers.append(key)
+            known.add(key)
 
     return headers
 
 
+def header_positions(headers):
+    """ Returns a dictionary with the given headers as keys and their
+    position as value.
+
+    """
+    return dict((key, ix) for ix, key in enumerate(headers))
+
+
 def additional_columns(reservation, headers, display_info=lambda x: x):
     """ Given a reservation and the list of additional headers return a list
     of columns filled with either None or the value of the json data.
 
+    The headers may also be given as dictionary returned by
+    :func:`header_positions`, which is faster if there are many records.
+
     The resulting list will always be of the same length as the given headers
     list.
 
     """
     forms = reservation.data and reservation.data.values() or []
 
+    if not isinstance(headers, dict):
+        headers = header_positions(headers)
+
     columns = [None] * len(headers)
     for form in forms:
         for field in form["values"]:
-            key = fieldkey(form, field)
-            idx = headers.index(key)
-
-            columns[idx] = field["value"]
+            columns[headers[fieldkey(form, field)]] = field["value"]
 
     return columns
 
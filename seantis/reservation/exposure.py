@@ -1,11 +1,98 @@
-from uuid import UUID
-
 from zope.security import checkPermission
 from zope.component import getMultiAdapter
 
-from seantis.reservation.utils import is_uuid, get_resource_by_uuid
+from seantis.reservation.utils import is_uuid, get_resources_by_uuids
+from seantis.reservation.utils import request_cache
 from seantis.reservation.utils import string_uuid, real_uuid
-from seantis.reservation.timeframe import timeframes_by_context
+from seantis.reservation.timeframe import timeframe_index
+
+
+class RequestExposure(object):
+    """ Decides which allocations are exposed to the current user.
+
+    The timeframes and permissions of each resource are looked up the first
+    time the resource is encountered and kept for the rest of the request,
+    so all schedulers and queries of a request share them (see for_request).
+
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.timeframes = {}
+
+    def add(self, resources):
+        """ Looks up the given resources, unless they are known already.
+
+        resources can be a list of uuids or a list of resource objects
+
+        """
+
+        resources = [
+            r for r in resources if real_uuid(r) not in self.timeframes
+        ]
+
+        if not resources:
+            return
+
+        # resolve all uuids with a single catalog query
+        brains = get_resources_by_uuids([o for o in resources if is_uuid(o)])
+
+        for obj in resources:
+            if is_uuid(obj):
+                resource = brains.get(string_uuid(obj))
+            else:
+                resource = obj
+
+            # Don't load the timeframes of the resources for which the user
+            # has special access to. This way they won't get checked later
+            # in 'is_exposed_on'
+            if resource is None:
+                frames = False
+            elif checkPermission(
+                    'seantis.reservation.ViewHiddenAllocations', resource):
+                frames = None
+            else:
+                frames = self.index.timeframes_for(resource)
+
+            self.timeframes[real_uuid(obj)] = frames
+
+    def is_exposed_on(self, resource, day):
+        if resource not in self.timeframes:
+            resource = real_uuid(resource)
+            self.add([resource])
+
+        frames = self.timeframes[resource]
+
+        if frames is None:
+            return True
+
+        if frames is False:
+            return False
+
+        return frames.is_visible(day)
+
+    def is_allocation_exposed(self, allocation):
+
+        # use the mirror_of as resource-keys of mirrors do not really exist
+        # as plone objects. The start date is relevant.
+        return self.is_exposed_on(
+            allocation.mirror_of, allocation.start.date()
+        )
+
+
+def for_request():
+    """ Returns the exposure of the current request. It is discarded once
+    a timeframe changes, as the timeframe index is rebuilt in that case.
+
+    """
+
+    index = timeframe_index()
+    cached = request_cache('exposure')
+
+    if cached.get('exposure') is None or cached['exposure'].index is not index:
+        cached['exposure'] = RequestExposure(index)
+
+    return cached['exposure']
 
 
 def for_allocations(resources):
@@ -16,52 +103,24 @@ def for_allocations(resources):
 
     """
 
-    # get a dictionary with uuids as keys and resources as values
-    def get_object(obj):
-        if is_uuid(obj):
-            return UUID(obj), get_resource_by_uuid(obj)
-        else:
-            return UUID(obj.uuid()), obj
-
-    resource_objects = dict([get_object(o) for o in resources])
-
-    # get timeframes for each uuid
-    timeframes = {}
-    for uuid, resource in resource_objects.items():
-
-        # Don't load the timeframes of the resources for which the user has
-        # special access to. This way they won't get checked later in
-        # 'is_exposed'
-        if checkPermission(
-                'seantis.reservation.ViewHiddenAllocations', resource):
-            timeframes[uuid] = []
-        elif resource is None:
-            timeframes[uuid] = [None]
-        else:
-            timeframes[uuid] = timeframes_by_context(resource)
+    exposure = for_request()
+    exposure.add(resources)
 
-    # returning closure
-    def is_exposed(allocation):
+    return exposure.is_allocation_exposed
 
-        # use the mirror_of as resource-keys of mirrors do not really exist
-        # as plone objects
-        frames = timeframes[allocation.mirror_of]
 
-        if frames is None or len(frames) == 0:
-            return True
+def for_days(resources):
+    """Returns a function which takes a resource uuid and a day and returns
+    true if the allocations of the resource on that day can be exposed.
 
-        if frames == [None]:
-            return False
+    resources can be a list of uuids or a list of resource objects
 
-        # the start date is relevant
-        day = allocation.start.date()
-        for frame in frames:
-            if frame.start <= day and day <= frame.end:
-                return frame.visible()
+    """
 
-        return False
+    exposure = for_request()
+    exposure.add(resources)
 
-    return is_exposed
+    return exposure.is_exposed_on
 
 
 def for_views(context, request):
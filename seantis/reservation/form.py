@@ -415,13 +415,11 @@ class ResourceParameterView(object):
     @view.memoize
     def resources(self):
         objs = dict()
+        found = utils.get_resource_objects_by_uuids(self.uuids)
 
         for uuid in self.uuids:
-            try:
-                objs[uuid] = utils.get_resource_by_uuid(uuid) \
-                    .getObject()
-            except AttributeError:
-                continue
+            if utils.string_uuid(uuid) in found:
+                objs[uuid] = found[utils.string_uuid(uuid)]
 
         return objs
 
@@ -0,0 +1,168 @@
+""" Answers availability questions about partly available allocations
+without going through the slots one by one.
+
+The reserved slots of each allocation are kept as a sorted list of raster
+indices (the first slot of the allocation having the index 0). Whether a
+timespan is completely free is then answered by comparing the position of
+its first and its last index in that list, and the free share of a timespan
+by counting the reserved indices in between.
+
+The free slots of many allocations, together with their mirrors, are loaded
+with two queries by free_slots_by_allocation.
+
+"""
+
+from bisect import bisect_left
+from collections import defaultdict
+from datetime import timedelta
+
+from libres.db.models import Allocation, ReservedSlot
+
+
+class FreeSlots(object):
+    """ The free slots of a single allocation. """
+
+    def __init__(self, allocation, reserved):
+        self.start = allocation._start
+        self.end = allocation._end
+        self.allocation = allocation
+
+        if allocation.partly_available:
+            self.raster = allocation.raster * 60
+            self.count = int(allocation.count_slots())
+        else:
+            self.raster = None
+            self.count = 1
+
+        self.reserved = sorted(set(self.index(start) for start in reserved))
+
+    def index(self, date):
+        """ Returns the index of the slot containing the given date. """
+
+        if self.raster is None:
+            return 0
+
+        return int((date - self.start).total_seconds() // self.raster)
+
+    def span(self, start=None, end=None):
+        """ Returns the range of indices of the slots overlapping the given
+        timespan, limited to the allocation.
+
+        """
+        start, end = self.allocation._prepare_range(start, end)
+
+        start = max(start or self.start, self.start)
+        end = min(end or self.end, self.end)
+
+        if end < start:
+            return 0, 0
+
+        # an end on the raster belongs to the previous slot
+        last = self.index(end - timedelta(microseconds=1))
+
+        return self.index(start), min(last + 1, self.count)
+
+    def reserved_count(self, first, last):
+        return (
+            bisect_left(self.reserved, last) -
+            bisect_left(self.reserved, first)
+        )
+
+    def is_free(self, start=None, end=None):
+        """ Returns True if the given timespan is completely free. """
+
+        first, last = self.span(start, end)
+        return self.reserved_count(first, last) == 0
+
+    def percent_free(self, start=None, end=None):
+        """ Returns the free share of the given timespan in percent. """
+
+        first, last = self.span(start, end)
+
+        if first == last:
+            return 0.0
+
+        reserved = self.reserved_count(first, last)
+        return 100.0 - float(reserved) / float(last - first) * 100.0
+
+
+class Spots(object):
+    """ The free slots of a master allocation and its existing mirrors.
+    Mirrors which don't exist yet are completely free.
+
+    """
+
+    def __init__(self, quota, slots):
+        self.quota = quota
+        self.slots = slots
+
+    @property
+    def missing(self):
+        return max(self.quota - len(self.slots), 0)
+
+    def find_spot(self, start=None, end=None):
+        """ Returns True if the given timespan is completely free on the
+        master or any of its mirrors, like Allocation.find_spot.
+
+        """
+        if self.missing:
+            return True
+
+        return any(s.is_free(start, end) for s in self.slots)
+
+    def percent_free(self, start=None, end=None):
+        """ Returns the availability of the master and the mirrors, like
+        Scheduler.availability for the timespan of the allocation.
+
+        """
+        if not self.quota:
+            return 0.0
+
+        total = sum(s.percent_free(start, end) for s in self.slots)
+        total += self.missing * 100.0
+
+        return total / self.quota
+
+
+def free_slots_by_allocation(session, allocations):
+    """ Returns the spots of each given allocation, keyed by id. """
+
+    allocations = [a for a in allocations if a.id is not None]
+
+    if not allocations:
+        return {}
+
+    keys = set((a.mirror_of, a._start) for a in allocations)
+
+    # the masters and mirrors of the allocations
+    query = session.query(Allocation)
+    query = query.filter(Allocation.mirror_of.in_(set(k[0] for k in keys)))
+    query = query.filter(Allocation._start.in_(set(k[1] for k in keys)))
+
+    siblings = defaultdict(list)
+    for allocation in query:
+        key = (allocation.mirror_of, allocation._start)
+
+        if key in keys:
+            siblings[key].append(allocation)
+
+    ids = [a.id for group in siblings.values() for a in group]
+
+    query = session.query(ReservedSlot.allocation_id, ReservedSlot.start)
+    query = query.filter(ReservedSlot.allocation_id.in_(ids))
+
+    reserved = defaultdict(list)
+    for allocation_id, start in query:
+        reserved[allocation_id].append(start)
+
+    result = {}
+
+    for allocation in allocations:
+        group = siblings[(allocation.mirror_of, allocation._start)]
+        master = next(a for a in group if a.is_master)
+
+        result[allocation.id] = Spots(master.quota, [
+            FreeSlots(a, reserved[a.id]) for a in group
+        ])
+
+    return result
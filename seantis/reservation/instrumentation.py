@@ -0,0 +1,352 @@
+""" Measures how many SQL statements the seantis.reservation views run and
+how much time they spend in the database and in Python.
+
+The instrumentation is off by default, as it adds some overhead to each
+statement. It is turned on in the product-config of seantis.reservation:
+
+    instrumentation on
+    instrumentation-repetitions 10
+
+If turned on, the engines created for the sites are observed using the
+cursor events of SQLAlchemy. The statements are counted per request and
+aggregated per view once the request ends, together with histograms of
+the request and SQL times.
+
+Statements of the same shape (the same SQL with different parameters) run
+more often than the configured number of repetitions during one request
+are reported as possible N+1 queries, as they are usually caused by a query
+run for each item of a list.
+
+Each request of a view is logged and the aggregated results are available
+as JSON through the instrumentation view.
+
+"""
+
+from logging import getLogger
+log = getLogger('seantis.reservation')
+
+import json
+import re
+import threading
+import time
+
+from collections import defaultdict
+
+from five import grok
+from sqlalchemy import event
+from zope.interface import Interface
+from ZPublisher.interfaces import IPubStart, IPubAfterTraversal, IPubEnd
+
+from seantis.reservation import utils
+from seantis.reservation.base import BaseView
+
+_stats = dict()  # the view statistics by view name
+_request = threading.local()  # the statistics of the current request
+
+locks = {
+    '_stats': threading.Lock()
+}
+
+# the upper bounds of the histogram buckets in milliseconds
+buckets = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# the number of shapes reported as possible N+1 queries per view
+max_repeated_shapes = 20
+
+# the parameters and literal values of a statement
+parameter = re.compile(r"%\([^)]+\)s|%s|'(?:[^']|'')*'|\b\d+\b")
+parameter_list = re.compile(r'\?(?:\s*,\s*\?)+')
+
+
+def is_enabled():
+    try:
+        value = utils.get_config('instrumentation') or 'off'
+    except utils.ConfigurationError:
+        return False
+
+    return value.strip().lower() in ('on', 'true', 'yes', '1')
+
+
+def max_repetitions():
+    try:
+        return int(utils.get_config('instrumentation-repetitions') or 10)
+    except utils.ConfigurationError:
+        return 10
+
+
+def shape(statement):
+    """ Returns the given statement without its parameters, so statements
+    which only differ by their parameters have the same shape.
+
+    """
+    statement = parameter.sub('?', statement)
+    statement = parameter_list.sub('?', statement)
+
+    return ' '.join(statement.split())
+
+
+class Histogram(object):
+    """ Counts values in the buckets defined above. """
+
+    def __init__(self):
+        self.counts = [0] * (len(buckets) + 1)
+
+    def add(self, milliseconds):
+        for index, bound in enumerate(buckets):
+            if milliseconds <= bound:
+                self.counts[index] += 1
+                return
+
+        self.counts[-1] += 1
+
+    def as_dict(self):
+        labels = ['<={}ms'.format(b) for b in buckets]
+        labels.append('>{}ms'.format(buckets[-1]))
+
+        return utils.OrderedDict(zip(labels, self.counts))
+
+
+class RequestStats(object):
+    """ The statements of a single request. """
+
+    def __init__(self):
+        self.started = time.time()
+        self.view = None
+        self.statements = 0
+        self.sql_time = 0.0
+        self.shapes = defaultdict(int)
+
+    def record(self, statement, duration):
+        self.statements += 1
+        self.sql_time += duration
+        self.shapes[shape(statement)] += 1
+
+    def repeated_shapes(self, repetitions):
+        return dict(
+            (s, count) for s, count in self.shapes.items()
+            if count > repetitions
+        )
+
+
+class ViewStats(object):
+    """ The aggregated statements and times of the requests of a view. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.requests = 0
+        self.statements = 0
+        self.max_statements = 0
+        self.total_time = 0.0
+        self.sql_time = 0.0
+        self.python_time = 0.0
+        self.request_times = Histogram()
+        self.sql_times = Histogram()
+        self.repeated_shapes = dict()
+
+    def record(self, stats, duration, repeated):
+        with self.lock:
+            self.requests += 1
+            self.statements += stats.statements
+            self.max_statements = max(self.max_statements, stats.statements)
+            self.total_time += duration
+            self.sql_time += stats.sql_time
+            self.python_time += duration - stats.sql_time
+            self.request_times.add(duration * 1000)
+            self.sql_times.add(stats.sql_time * 1000)
+
+            for statement, count in repeated.items():
+                if statement in self.repeated_shapes:
+                    self.repeated_shapes[statement] = max(
+                        self.repeated_shapes[statement], count
+                    )
+                elif len(self.repeated_shapes) < max_repeated_shapes:
+                    self.repeated_shapes[statement] = count
+
+    def as_dict(self):
+        with self.lock:
+            requests = self.requests or 1
+
+            return {
+                'requests': self.requests,
+                'statements': self.statements,
+                'average_statements': float(self.statements) / requests,
+                'max_statements': self.max_statements,
+                'total_time': self.total_time,
+                'sql_time': self.sql_time,
+                'python_time': self.python_time,
+                'average_time': self.total_time / requests,
+                'request_times': self.request_times.as_dict(),
+                'sql_times': self.sql_times.as_dict(),
+                'repeated_statements': self.repeated_shapes
+            }
+
+
+def stats_for(view):
+    with locks['_stats']:
+        if view not in _stats:
+            _stats[view] = ViewStats()
+
+        return _stats[view]
+
+
+def clear_stats():
+    """ Clears the statistics for testing. """
+
+    with locks['_stats']:
+        _stats.clear()
+
+    _request.stats = None
+
+
+# the start time is kept on the execution context, which is discarded
+# together with the statement, whether it succeeds or fails. Statements
+# executed without a context (e.g. by the dialect) are not recorded.
+def before_cursor_execute(
+    conn, cursor, statement, parameters, context, executemany
+):
+    if context is not None:
+        context.instrumentation_started = time.time()
+
+
+def after_cursor_execute(
+    conn, cursor, statement, parameters, context, executemany
+):
+    started = getattr(context, 'instrumentation_started', None)
+    stats = getattr(_request, 'stats', None)
+
+    if started is not None and stats is not None:
+        stats.record(statement, time.time() - started)
+
+
+listeners = (
+    ('before_cursor_execute', before_cursor_execute),
+    ('after_cursor_execute', after_cursor_execute)
+)
+
+
+def observe(engine):
+    for name, listener in listeners:
+        if not event.contains(engine, name, listener):
+            event.listen(engine, name, listener)
+
+
+def unobserve(engine):
+    for name, listener in listeners:
+        if event.contains(engine, name, listener):
+            event.remove(engine, name, listener)
+
+
+def instrument(engine):
+    """ Observes the statements of the given engine, if the instrumentation
+    is turned on. Returns True if the engine is observed.
+
+    """
+    if not is_enabled():
+        return False
+
+    observe(engine)
+    return True
+
+
+def view_name(published):
+    """ Returns the dotted name of the given seantis.reservation view or
+    None if the published object is not one.
+
+    The class name alone is not unique, the macros and the resource view
+    are both called View.
+
+    """
+    published = getattr(published, 'im_self', published)
+    module = getattr(type(published), '__module__', '')
+
+    if not module.startswith('seantis.reservation'):
+        return None
+
+    return '{}.{}'.format(module, type(published).__name__)
+
+
+def start_request():
+    _request.stats = RequestStats()
+
+
+def end_request(view):
+    """ Records the current request as a request of the given view and
+    returns its statistics.
+
+    """
+    stats = getattr(_request, 'stats', None)
+    _request.stats = None
+
+    if stats is None or view is None:
+        return None
+
+    duration = time.time() - stats.started
+    repeated = stats.repeated_shapes(max_repetitions())
+
+    stats_for(view).record(stats, duration, repeated)
+
+    log.info(
+        '{}: {} statements, {:.1f}ms sql, {:.1f}ms python'.format(
+            view, stats.statements, stats.sql_time * 1000,
+            (duration - stats.sql_time) * 1000
+        )
+    )
+
+    for statement, count in repeated.items():
+        log.warn('{}: possible N+1 query, run {} times: {}'.format(
+            view, count, statement[:500]
+        ))
+
+    return stats
+
+
+@grok.subscribe(IPubStart)
+def on_publication_start(event):
+    if is_enabled():
+        start_request()
+
+
+@grok.subscribe(IPubAfterTraversal)
+def on_publication_traversed(event):
+    stats = getattr(_request, 'stats', None)
+
+    if stats is not None:
+        stats.view = view_name(event.request.get('PUBLISHED'))
+
+
+@grok.subscribe(IPubEnd)
+def on_publication_end(event):
+    stats = getattr(_request, 'stats', None)
+
+    if stats is not None:
+        end_request(stats.view)
+
+
+class InstrumentationView(BaseView):
+    """ Returns the statistics of all instrumented views as JSON. Pass
+    reset=1 to reset the statistics after reading them.
+
+    """
+
+    permission = 'cmf.ManagePortal'
+
+    grok.name('instrumentation')
+    grok.require(permission)
+    grok.context(Interface)
+
+    def render(self):
+        with locks['_stats']:
+            stats = _stats.items()
+
+        result = dict((view, s.as_dict()) for view, s in stats)
+
+        if self.request.get('reset'):
+            for view, s in stats:
+                with s.lock:
+                    s.reset()
+
+        self.request.response.setHeader('Content-Type', 'application/json')
+        return json.dumps(result, sort_keys=True)
@@ -386,6 +386,42 @@ var CalendarGroups = function() {
             calendar.overlay_show(url);
         };
 
+        // the requests of the feeds shared by compared calendars, by url
+        var shared_feeds = {};
+
+        // loads the feed of the given url once for all calendars requesting
+        // it at the same time
+        var shared_feed = function(url, start, end) {
+            var key = url + '&start=' + start + '&end=' + end;
+
+            if (_.isUndefined(shared_feeds[key])) {
+                shared_feeds[key] = $.getJSON(url, {start: start, end: end});
+                shared_feeds[key].always(function() {
+                    _.defer(function() { delete shared_feeds[key]; });
+                });
+            }
+
+            return shared_feeds[key];
+        };
+
+        // returns the events of a compared calendar from the shared feed
+        var compared_events = function(calendar) {
+            return function(start, end, callback) {
+                var feed = shared_feed(
+                    calendar.compare.url,
+                    Math.round(start.getTime() / 1000),
+                    Math.round(end.getTime() / 1000)
+                );
+
+                feed.done(function(events) {
+                    callback(events[calendar.compare.uuid] || []);
+                });
+                feed.fail(function() {
+                    callback([]);
+                });
+            };
+        };
+
         // Hookup the fullcalendar
         _.each(seantis.calendars, function(cal) {
             var calendar = cal;
@@ -448,6 +484,11 @@ var CalendarGroups = function() {
             $.extend(options, seantis.locale.fullcalendar());
             $.extend(options, seantis.calendars.defaults);
             $.extend(options, calendar.options);
+
+            if (calendar.compare) {
+                options.events = compared_events(calendar);
+            }
+
             calendar.element.fullCalendar(options);
         });
 
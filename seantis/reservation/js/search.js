@@ -249,13 +249,25 @@ seantis.search.init_ajax_search = function() {
     button.data('hooked', true);
 };
 
-seantis.search.run_search = function() {
+seantis.search.init_pages = function() {
+    $('.searchresults a.searchresults-page').click(function(e) {
+        seantis.search.run_search($(this).data('after'));
+        e.preventDefault();
+    });
+};
+
+seantis.search.run_search = function(after) {
     var formdata = $('.searchbox form').serialize();
 
     // make sure the form is treated as submitted by the backend
     formdata += '&form.buttons.search=';
     formdata += $('.searchbox input[type="submit"]').val();
 
+    // the position after which the shown page starts
+    if (after) {
+        formdata += '&after=' + encodeURIComponent(after);
+    }
+
     $('.loading').show();
     $('.resultbox').hide();
 
@@ -275,6 +287,7 @@ seantis.search.init = function() {
     seantis.search.init_tips();
     seantis.search.update_remove_link();
     seantis.search.init_ajax_search();
+    seantis.search.init_pages();
 
     // deselect all groups with extra results by default
     // would be better to do on the server, but it is much easier here
@@ -5,6 +5,7 @@ from five import grok
 from zope.interface import Interface
 
 from seantis.reservation import _
+from seantis.reservation import free_slots
 from seantis.reservation import settings
 from seantis.reservation import utils
 from seantis.reservation.base import BaseView
@@ -71,15 +72,17 @@ class View(BaseView, ReservationUrls, ReservationDataView):
         """
         result = []
 
+        resources = utils.get_resource_objects_by_uuids(
+            set(r.resource for r in reservations)
+        )
+
         for reservation in reservations:
-            resource = utils.get_resource_by_uuid(reservation.resource)
+            resource = resources.get(utils.string_uuid(reservation.resource))
 
             if resource is None:
                 log.warn('Invalid UUID %s' % str(reservation.resource))
                 continue
 
-            resource = resource.getObject()
-
             data = {}
 
             data['token'] = reservation.token
@@ -134,6 +137,17 @@ class View(BaseView, ReservationUrls, ReservationDataView):
 
         tz = settings.timezone()
 
+        # calculate the availability of all allocations at once
+        availabilities = scheduler.allocation_availabilities(allocations)
+
+        # partly available allocations are checked for the searched times
+        if start_time or end_time:
+            spots = free_slots.free_slots_by_allocation(scheduler.session, (
+                a for a in allocations if a.partly_available
+            ))
+        else:
+            spots = {}
+
         for allocation in allocations:
 
             if start_time or end_time:
@@ -149,8 +163,14 @@ class View(BaseView, ReservationUrls, ReservationDataView):
                 )
                 s, e = None, None
 
+            availability, waitinglist_length = availabilities.get(
+                allocation.id, (None, None)
+            )
             availability, text, allocation_class = utils.event_availability(
-                self.context, self.request, scheduler, allocation, s, e
+                self.context, self.request, scheduler, allocation, s, e,
+                availability=availability,
+                waitinglist_length=waitinglist_length,
+                spots=spots.get(allocation.id)
             )
 
             date = ', '.join((
@@ -20,6 +20,8 @@ from z3c.form import button
 from zope.schema import getFields
 
 from seantis.reservation import _
+from seantis.reservation import cache
+from seantis.reservation import outbox
 from seantis.reservation import settings
 from seantis.reservation import utils
 from seantis.reservation.base import BaseViewlet
@@ -34,7 +36,7 @@ from seantis.reservation.interfaces import (
     ISeantisReservationSpecific,
     OverviewletManager,
 )
-from seantis.reservation.mail_templates import templates
+from seantis.reservation.mail_templates import compile_template, templates
 from seantis.reservation.reservations import (
     combine_reservations, CombinedReservations
 )
@@ -146,6 +148,17 @@ def get_managers_by_context(context):
 
 
 def get_manager_emails_by_context(context):
+    """ Returns the emails of the managers responsible for the given
+    context. The result is cached per folder path.
+
+    """
+    return list(cache.manager_emails.cached(
+        '/'.join(context.getPhysicalPath()), (),
+        lambda: tuple(resolve_manager_emails(context))
+    ))
+
+
+def resolve_manager_emails(context):
     managers = get_managers_by_context(context)
 
     if not managers:
@@ -187,6 +200,31 @@ def get_manager_emails(context):
 
 
 def get_email_content(context, email_type, language):
+    subject, body = get_compiled_email_content(context, email_type, language)
+    return subject.text, body.text
+
+
+def get_compiled_email_content(context, email_type, language):
+    """ Returns the compiled subject and body of the given email type. The
+    user templates found for a folder are cached per path and language.
+
+    """
+    user_template = cache.email_templates.cached(
+        ('/'.join(context.getPhysicalPath()), language), (),
+        lambda: get_user_template(context, language) or False
+    )
+
+    if user_template:
+        return user_template[email_type]
+
+    return templates[email_type].get_compiled(language)
+
+
+def get_user_template(context, language):
+    """ Returns the compiled subjects and bodies of the user template for
+    the given context and language by email type, or None.
+
+    """
     user_templates = utils.portal_type_by_context(
         context, portal_type='seantis.reservation.emailtemplate'
     )
@@ -195,24 +233,23 @@ def get_email_content(context, email_type, language):
         if t.language != language:
             continue
 
-        subject = getattr(t, email_type + '_subject')
-        body = getattr(t, email_type + '_content')
-
-        return subject, body
+        return dict(
+            (
+                email_type, (
+                    compile_template(getattr(t, email_type + '_subject')),
+                    compile_template(getattr(t, email_type + '_content'))
+                )
+            ) for email_type in templates
+        )
 
-    return templates[email_type].get(language)
+    return None
 
 
 def load_resources(reservations):
-    resources = dict()
+    uuids = set(r.resource for r in reservations)
+    found = utils.get_resource_objects_by_uuids(uuids)
 
-    for resource in (r.resource for r in reservations):
-        if resource in resources:
-            continue
-
-        resources[resource] = utils.get_resource_by_uuid(resource).getObject()
-
-    return resources
+    return dict((uuid, found[utils.string_uuid(uuid)]) for uuid in uuids)
 
 
 def may_send_mail(resource, mail, intended_for_admin):
@@ -260,7 +297,7 @@ def send_reservations_confirmed(reservations, language):
             lines.append('')
 
         # differs between resources
-        subject, body = get_email_content(
+        subject, body = get_compiled_email_content(
             resource, 'reservation_received', language
         )
 
@@ -311,7 +348,9 @@ def send_reservation_mail(
     else:
         recipients = [reservation.email]
 
-    subject, body = get_email_content(resource, email_type, language)
+    subject, body = get_compiled_email_content(
+        resource, email_type, language
+    )
 
     for recipient in recipients:
         mail = ReservationMail(
@@ -330,7 +369,11 @@ def send_reservation_mail(
 
 
 def send_mail(context, mail):
-    context.MailHost.send(mail.as_string(), immediate=False)
+    """ Puts the mail into the outbox, from where it is sent once the
+    transaction is committed.
+
+    """
+    outbox.enqueue(mail.sender, mail.recipient, mail.as_string())
 
 
 class ReservationMail(ReservationDataView, ReservationUrls):
@@ -349,6 +392,9 @@ class ReservationMail(ReservationDataView, ReservationUrls):
             if hasattr(self, k):
                 setattr(self, k, v)
 
+        self.subject = compile_template(self.subject)
+        self.body = compile_template(self.body)
+
         # get information for the body/subject string
 
         p = dict()
@@ -435,8 +481,8 @@ class ReservationMail(ReservationDataView, ReservationUrls):
         self.parameters = p
 
     def as_string(self):
-        subject = self.subject % self.parameters
-        body = self.body % self.parameters
+        subject = self.subject.render(self.parameters)
+        body = self.body.render(self.parameters)
         mail = create_email(self.sender, self.recipient, subject, body)
         return mail.as_string()
 
@@ -1,8 +1,9 @@
 import codecs
 import logging
+import re
 import six
 
-from os import path
+from os import listdir, path
 
 logger = logging.getLogger('seantis.reservation')
 folder = path.join(path.dirname(path.abspath(__file__)), 'emails')
@@ -13,35 +14,130 @@ def get_filename(key, language):
     return path.join(folder, filename)
 
 
+def get_languages(key):
+    """ Returns the languages the given template is translated to. """
+
+    expression = re.compile(r'^%s\.([a-z_A-Z-]+)\.txt$' % re.escape(key))
+    matches = (expression.match(filename) for filename in listdir(folder))
+
+    return [m.group(1) for m in matches if m]
+
+
+# the template variables (like %(resource)s) and escaped percent signs
+placeholder = re.compile(
+    r'%\(([a-z_]+)\)([#0 +-]*[0-9]*(?:\.[0-9]+)?[diouxXeEfFgGcrs])|%%'
+)
+
+
+class CompiledTemplate(object):
+    """ A subject or body of an email with the template variables parsed
+    in advance, so rendering it only needs to join the parts.
+
+    The result is the same as using the % operator on the text. Texts which
+    contain other uses of the percent sign are rendered with the % operator,
+    so they fail the same way.
+
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.fields = set()
+        self.parts = []
+
+        position = 0
+        literal = u''
+
+        for match in placeholder.finditer(text):
+            literal += text[position:match.start()]
+            position = match.end()
+
+            if match.group(0) == '%%':
+                literal += u'%'
+                continue
+
+            name, conversion = match.groups()
+            self.fields.add(name)
+
+            self.parts.append(literal)
+            self.parts.append((name, conversion != 's' and '%' + conversion))
+            literal = u''
+
+        self.parts.append(literal + text[position:])
+
+        if '%' in placeholder.sub('', text):
+            self.parts = None
+
+    def __contains__(self, name):
+        return name in self.fields
+
+    def render(self, parameters):
+        if self.parts is None:
+            return self.text % parameters
+
+        result = []
+
+        for part in self.parts:
+            if isinstance(part, six.string_types):
+                result.append(part)
+            elif not part[1]:
+                result.append(six.text_type(parameters[part[0]]))
+            else:
+                result.append(part[1] % parameters[part[0]])
+
+        return u''.join(result)
+
+
+def compile_template(text):
+    if isinstance(text, CompiledTemplate):
+        return text
+
+    return CompiledTemplate(text)
+
+
 class MailTemplate(object):
+    """ A template bundled with seantis.reservation. All translations are
+    parsed and compiled when the template is created.
+
+    """
 
     def __init__(self, template):
         self.templates = dict()
+        self.compiled = dict()
         self.key = template
+
+        for language in get_languages(template):
+            self.load_language(language)
+
         assert self.is_translated('en')
 
     def is_translated(self, language):
-        return path.exists(get_filename(self.key, language))
+        return language in self.templates
 
     def load_language(self, language):
         with codecs.open(get_filename(self.key, language), "r", "utf-8") as f:
             self.templates[language] = self.parse_file(f)
 
-        return self.templates[language]
-
-    def get(self, language):
+        self.compiled[language] = tuple(
+            CompiledTemplate(text) for text in self.templates[language]
+        )
 
-        if language in self.templates:
-            return self.templates[language]
+        return self.templates[language]
 
+    def get_language(self, language):
         if self.is_translated(language):
-            return self.load_language(language)
+            return language
 
         logger.warning(
             'Email template for language %s does not exist', language
         )
 
-        return self.get('en')
+        return 'en'
+
+    def get(self, language):
+        return self.templates[self.get_language(language)]
+
+    def get_compiled(self, language):
+        return self.compiled[self.get_language(language)]
 
     def get_subject(self, language):
         return self.get(language)[0]
@@ -1,136 +1,425 @@
+""" Removes the expired reservation sessions and throttle entries of the
+seantis.reservation databases.
+
+Reservations which are not confirmed by the user in time are removed by a
+maintenance thread, which runs once per interval for each database used by
+the instance. The expired sessions are removed in batches, committing after
+each batch. Reservations locked by another transaction (for example one
+confirming them right now) are skipped and their session is left alone
+until the next run. The expired throttle entries (see
+seantis.reservation.throttle) and the mails given up on a while ago (see
+seantis.reservation.outbox) are removed afterwards. The thread also hands
+the sites with mails waiting in the outbox to the mail workers, which
+might not know about them after a restart.
+
+The thread may be configured in the product-config of seantis.reservation:
+
+    maintenance-thread on (default) | off
+    maintenance-interval 900
+    maintenance-batch-size 100
+
+Instead of the thread, the cleanup may be run by the console script
+seantis-reservation-maintenance, which connects to a database directly
+(e.g. from cron, or as a separate process with --interval). The
+remove-expired-sessions view does the same for the database of a site.
+
+The throughput of the cleanup is available as JSON through the
+maintenance-metrics view.
+
+"""
+
+from __future__ import print_function
+
 from logging import getLogger
 log = getLogger('seantis.reservation')
 
-import re
+import argparse
+import json
 import threading
+import time
+import transaction
+
+from contextlib import contextmanager
+from datetime import timedelta
 
 from five import grok
 
+from libres.db.models import Reservation, ReservedSlot
+from sqlalchemy import func, null
+from Testing.makerequest import makerequest
 from zope.component import getUtility
-from zope.component.hooks import getSite
+from zope.component.hooks import getSite, setSite
 from zope.interface import Interface
 
-from ZServer.ClockServer import ClockServer
-
+from seantis.reservation import outbox
+from seantis.reservation import summary
+from seantis.reservation import throttle
+from seantis.reservation import utils
 from seantis.reservation.base import BaseView
 from seantis.reservation.interfaces import IResourceViewedEvent
-from seantis.reservation.session import ILibresUtility
+from seantis.reservation.session import ILibresUtility, Session
 
-_connections = set()  # seantis.reservation database connections
-_clockservers = dict()  # list of registered Zope Clockservers
+_connections = dict()  # the site paths by seantis.reservation dsn
+_metrics = dict()  # the cleanup metrics by site path
+_runner = None  # the maintenance thread
 
-# probably not needed as most operations are atomic and therefore protected
-# by the GIL, but it's better to be safe than sorry.
 locks = {
-    '_clockservers': threading.Lock(),
-    '_connections': threading.Lock()
+    '_connections': threading.Lock(),
+    '_metrics': threading.Lock(),
+    '_runner': threading.Lock()
 }
 
+# the defaults of the configurable settings
+default_interval = 15 * 60
+default_batch_size = 100
 
-# The primary hook to setup maintenance clockservers is the reservation view
-# event. It's invoked way too often, but the invocation is fast and it is
-# guaranteed to be run on a plone site with seantis.reservation installed,
-# setup and in use. Other events like zope startup and traversal events are
-# not safe enough to use if one has to rely on a site being setup.
-@grok.subscribe(IResourceViewedEvent)
-def on_resource_viewed(event):
-    period = 15 * 60  # 15 minutes
-    register_once_per_connection('/remove-expired-sessions', getSite(), period)
+# the time after which unconfirmed reservations expire
+expiration = timedelta(minutes=15)
 
 
-def clear_clockservers():
-    """ Clears the clockservers and connections for testing. """
+def get_setting(key, default):
+    try:
+        return int(utils.get_config(key) or default)
+    except utils.ConfigurationError:
+        return default
 
-    with locks['_connections']:
-        _connections.clear()
 
-    with locks['_clockservers']:
-        for cs in _clockservers.values():
-            cs.close()
-        _clockservers.clear()
+def is_thread_enabled():
+    try:
+        value = utils.get_config('maintenance-thread') or 'on'
+    except utils.ConfigurationError:
+        return False
 
+    return value.strip().lower() not in ('off', 'false', 'no', '0')
 
-def register_once_per_connection(method, site, period):
-    """ Registers the given method with a clockserver while making sure
-    that the method is only registered once for each seantis.reservation db
-    connection defined via the ILibresUtility.
 
-        method => relative to the site root, starts with '/'
-                  e.g /remove-expired-sessions
+class CleanupMetrics(object):
+    """ Counts what the cleanup of a database removed and how long it took.
+    """
 
-        site   => site with seantis.reservation setup in it
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.runs = 0
+        self.batches = 0
+        self.sessions = 0
+        self.reservations = 0
+        self.skipped = 0
+        self.errors = 0
+        self.total_duration = 0.0
+        self.last_run = None
+        self.last_duration = None
+
+    def record_batch(self, sessions, reservations, skipped):
+        with self.lock:
+            self.batches += 1
+            self.sessions += sessions
+            self.reservations += reservations
+            self.skipped += skipped
+
+    def record_run(self, started, duration, failed=False):
+        with self.lock:
+            self.runs += 1
+            self.errors += failed and 1 or 0
+            self.total_duration += duration
+            self.last_run = started
+            self.last_duration = duration
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'runs': self.runs,
+                'batches': self.batches,
+                'sessions': self.sessions,
+                'reservations': self.reservations,
+                'skipped': self.skipped,
+                'errors': self.errors,
+                'total_duration': self.total_duration,
+                'last_run': self.last_run,
+                'last_duration': self.last_duration,
+                'reservations_per_second': self.total_duration and (
+                    self.reservations / self.total_duration
+                ) or 0.0
+            }
+
+
+def metrics_for(path):
+    """ Returns the metrics of the given site, creating them if necessary.
+    """
+    with locks['_metrics']:
+        if path not in _metrics:
+            _metrics[path] = CleanupMetrics()
 
-        period => interval by which the method is called by the clockserver
+        return _metrics[path]
 
-    Returns True if a new server was registered, False if the connection
-    was already present.
+
+def expired_sessions(session, expiration_date):
+    """ Returns the ids of the sessions whose pending reservations have all
+    been created or modified before the given date, like libres'
+    find_expired_reservation_sessions.
 
     """
+    query = session.query(Reservation.session_id)
+    query = query.filter(Reservation.session_id != null())
+    query = query.filter(Reservation.status == u'pending')
+    query = query.group_by(Reservation.session_id)
+    query = query.having(func.greatest(
+        func.max(Reservation.created), func.max(Reservation.modified)
+    ) < expiration_date)
 
-    assert method.startswith('/')
+    return [row[0] for row in query]
 
-    connection = getUtility(ILibresUtility).get_dsn(site)
 
-    if connection in _connections:
-        return False
+def remove_batch(session, session_ids):
+    """ Removes the reservations of the given sessions, skipping sessions
+    with reservations locked by other transactions. Returns the number of
+    sessions and reservations removed and the number of sessions skipped.
 
-    method = '/'.join(site.getPhysicalPath()) + method
+    """
+    query = session.query(Reservation.session_id, func.count())
+    query = query.filter(Reservation.session_id.in_(session_ids))
+    totals = dict(query.group_by(Reservation.session_id).all())
 
-    with locks['_connections']:
-        _connections.add(connection)
+    query = session.query(
+        Reservation.id, Reservation.session_id, Reservation.token
+    )
+    query = query.filter(Reservation.session_id.in_(session_ids))
+    locked = utils.skip_locked(session, query).all()
 
-    register_server(method, period)
+    counts = dict()
+    for row in locked:
+        counts[row.session_id] = counts.get(row.session_id, 0) + 1
 
-    return True
+    # a session is either removed as a whole or left alone
+    removable = set(s for s, count in counts.items() if count == totals[s])
+    rows = [row for row in locked if row.session_id in removable]
+
+    if not rows:
+        return 0, 0, len(session_ids)
+
+    ids = set(row.id for row in rows)
+    tokens = set(row.token for row in rows)
+
+    days = summary.reservation_days(session, tokens)
 
+    slots = session.query(ReservedSlot)
+    slots = slots.filter(ReservedSlot.reservation_token.in_(tokens))
+    slots.delete('fetch')
 
-def register_server(method, period):
-    """ Registers the given method with a clockserver.
+    reservations = session.query(Reservation)
+    reservations = reservations.filter(Reservation.id.in_(ids))
+    reservations.delete('fetch')
 
-    Note that due to it's implementation there's no guarantee that the method
-    will be called on time every time. The clockserver checks if a call is due
-    every time a request comes in, or every 30 seconds when the asyncore.pollss
-    method reaches it's timeout (see Lifetime/__init__.py and
-    Python Stdlib/asyncore.py).
+    if days:
+        summary.update_days(session, days)
+
+    return len(removable), len(ids), len(session_ids) - len(removable)
+
+
+def remove_expired_sessions(
+    session, commit, expiration_date=None, batch_size=None, metrics=None
+):
+    """ Removes the expired reservation sessions in batches of the given
+    number of sessions, calling commit after each batch. Returns the number
+    of sessions and reservations removed.
 
     """
+    expiration_date = expiration_date or (utils.utcnow() - expiration)
+    batch_size = batch_size or default_batch_size
 
-    assert method not in _clockservers, "%s is already being used" % method
+    session_ids = expired_sessions(session, expiration_date)
+    removed_sessions, removed_reservations = 0, 0
 
-    with locks['_clockservers']:
-        _clockservers[method] = ClockServer(
-            method, period, host='localhost', logger=ClockLogger(method)
+    for offset in range(0, len(session_ids), batch_size):
+        sessions, reservations, skipped = remove_batch(
+            session, session_ids[offset:offset + batch_size]
         )
 
-    return _clockservers[method]
+        commit()
+
+        removed_sessions += sessions
+        removed_reservations += reservations
 
+        if metrics is not None:
+            metrics.record_batch(sessions, reservations, skipped)
 
-logexpr = re.compile(r'GET [^\s]+ HTTP/[^\s]+ ([0-9]+)')
+    return removed_sessions, removed_reservations
 
 
-class ClockLogger(object):
-    """ Logs the clock runs by evaluating the log strings. Looks for http
-    return codes to do so.
+def run_cleanup(path, session, commit, batch_size=None):
+    """ Runs the cleanup of the database of the given site path (or dsn),
+    recording the metrics.
 
     """
+    metrics = metrics_for(path)
+    started = time.time()
+
+    try:
+        sessions, reservations = remove_expired_sessions(
+            session, commit, batch_size=batch_size, metrics=metrics
+        )
+
+        entries = throttle.remove_expired_entries(session)
+        messages = outbox.remove_dead_messages(session)
+        commit()
+    except:
+        metrics.record_run(started, time.time() - started, failed=True)
+        raise
+
+    duration = time.time() - started
+    metrics.record_run(started, duration)
+
+    log.info(
+        'removed {} expired reservation sessions ({} reservations), {} '
+        'throttle entries and {} dead mails of {} in {:.3f}s'.format(
+            sessions, reservations, entries, messages, path, duration
+        )
+    )
+
+    return sessions, reservations
+
+
+@contextmanager
+def opened_site(path):
+    """ Opens the site with the given path with a separate ZODB connection,
+    for use outside of requests. Aborts the transaction when done.
+
+    """
+
+    # Zope2 is only imported when needed as it may not be configured
+    # during imports in testing
+    import Zope2
+    app = makerequest(Zope2.app())
+
+    try:
+        site = app.unrestrictedTraverse(path)
+        setSite(site)
+
+        yield site
+    finally:
+        transaction.abort()
+        setSite(None)
+        app._p_jar.close()
+
+
+class Runner(threading.Thread):
+    """ Runs the cleanup of all registered databases once per interval.
+
+    The runs are scheduled from the time the thread started, so they don't
+    drift. If a run takes longer than the interval, the missed runs are
+    skipped.
+
+    """
+
+    def __init__(self, interval, batch_size):
+        super(Runner, self).__init__(name='seantis.reservation.maintenance')
+        self.daemon = True
+
+        self.interval = interval
+        self.batch_size = batch_size
+        self.stopped = threading.Event()
 
-    def __init__(self, method):
-        self.method = method
+    def run(self):
+        next_run = time.time() + self.interval
 
-    def return_code(self, msg):
-        groups = re.findall(logexpr, msg)
-        return groups and int(groups[0]) or None
+        while not self.stopped.wait(max(next_run - time.time(), 0)):
+            with locks['_connections']:
+                paths = _connections.values()
 
-    def log(self, msg):
-        code = self.return_code(msg)
+            for path in paths:
+                self.cleanup(path)
 
-        if not code:
-            log.error("ClockServer for %s returned nothing" % self.method)
+            next_run += self.interval
 
-        if code == 200:
-            log.info("ClockServer for %s run successfully" % self.method)
-        else:
-            log.warn("ClockServer for %s returned %i" % (self.method, code))
+            if next_run < time.time():
+                next_run = time.time() + self.interval
+
+    def cleanup(self, path):
+        try:
+            with opened_site(path):
+                session = Session()
+
+                run_cleanup(path, session, transaction.commit, self.batch_size)
+                outbox.resume(session)
+        except:
+            log.exception('failed to remove the expired sessions of {}'.format(
+                path
+            ))
+
+    def stop(self):
+        self.stopped.set()
+
+
+def start_runner():
+    """ Starts the maintenance thread if it is enabled and not running yet.
+    """
+    global _runner
+
+    if not is_thread_enabled():
+        return False
+
+    with locks['_runner']:
+        if _runner is None:
+            _runner = Runner(
+                get_setting('maintenance-interval', default_interval),
+                get_setting('maintenance-batch-size', default_batch_size)
+            )
+            _runner.start()
+
+    return True
+
+
+def stop_runner():
+    """ Stops the maintenance thread and forgets the registered sites for
+    testing.
+
+    """
+    global _runner
+
+    with locks['_runner']:
+        if _runner is not None:
+            _runner.stop()
+            _runner = None
+
+    with locks['_connections']:
+        _connections.clear()
+
+    with locks['_metrics']:
+        _metrics.clear()
+
+
+def register_site(site):
+    """ Registers the given site for the cleanup, while making sure that
+    each seantis.reservation database connection defined via the
+    ILibresUtility is only cleaned up through one site.
+
+    Returns True if the site was registered, False if the connection was
+    already present.
+
+    """
+    connection = getUtility(ILibresUtility).get_dsn(site)
+
+    with locks['_connections']:
+        if connection in _connections:
+            return False
+
+        _connections[connection] = '/'.join(site.getPhysicalPath())
+
+    start_runner()
+
+    return True
+
+
+# The primary hook to register the sites is the reservation view event. It's
+# invoked way too often, but the invocation is fast and it is guaranteed to
+# be run on a plone site with seantis.reservation installed, setup and in
+# use. Other events like zope startup and traversal events are not safe
+# enough to use if one has to rely on a site being setup.
+@grok.subscribe(IResourceViewedEvent)
+def on_resource_viewed(event):
+    register_site(getSite())
 
 
 class RemoveExpiredSessions(BaseView):
@@ -146,11 +435,90 @@ class RemoveExpiredSessions(BaseView):
     grok.context(Interface)
 
     def render(self):
-        # LIBRES it might make sense to have some scheduler-less access here.
-        scheduler = getUtility(ILibresUtility).scheduler('maintenance', 'UTC')
-        removed = scheduler.queries.remove_expired_reservation_sessions()
+        sessions, reservations = run_cleanup(
+            '/'.join(getSite().getPhysicalPath()), Session(),
+            transaction.commit,
+            get_setting('maintenance-batch-size', default_batch_size)
+        )
+
+        # don't give out the session ids to the public
+        return "removed %i reservation sessions" % sessions
 
-        # don't give out the session ids to the public, log instead
-        log.info('removed the following reservation sessions: %s' % removed)
 
-        return "removed %i reservation sessions" % len(removed)
+class MaintenanceMetrics(BaseView):
+    """ Returns the cleanup metrics of all sites as JSON. """
+
+    permission = 'cmf.ManagePortal'
+
+    grok.name('maintenance-metrics')
+    grok.require(permission)
+    grok.context(Interface)
+
+    def render(self):
+        with locks['_metrics']:
+            metrics = _metrics.items()
+
+        result = dict((path, m.as_dict()) for path, m in metrics)
+
+        self.request.response.setHeader('Content-Type', 'application/json')
+        return json.dumps(result, sort_keys=True)
+
+
+def main(argv=None):
+    """ Removes the expired reservation sessions of the given database,
+    once or repeatedly.
+
+    """
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+
+    parser = argparse.ArgumentParser(description=main.__doc__.strip())
+    parser.add_argument('dsn', help="the seantis.reservation database")
+    parser.add_argument(
+        '--interval', type=int, default=None,
+        help="run every given number of seconds instead of once"
+    )
+    parser.add_argument(
+        '--batch-size', type=int, default=default_batch_size,
+        help="the number of sessions removed per transaction"
+    )
+
+    args = parser.parse_args(argv)
+
+    engine = create_engine(args.dsn, isolation_level='READ COMMITTED')
+    session = sessionmaker(bind=engine)()
+
+    # hide the credentials of the dsn in the output
+    name = engine.url.database
+
+    def cleanup():
+        try:
+            sessions, reservations = run_cleanup(
+                name, session, session.commit, args.batch_size
+            )
+        except:
+            session.rollback()
+            raise
+
+        print('removed {} sessions ({} reservations), {}'.format(
+            sessions, reservations, json.dumps(metrics_for(name).as_dict())
+        ))
+
+    if not args.interval:
+        cleanup()
+        return
+
+    next_run = time.time()
+
+    while True:
+        time.sleep(max(next_run - time.time(), 0))
+
+        try:
+            cleanup()
+        except Exception:
+            log.exception('failed to remove the expired sessions')
+
+        next_run += args.interval
+
+        if next_run < time.time():
+            next_run = time.time() + args.interval
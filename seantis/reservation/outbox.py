@@ -0,0 +1,426 @@
+""" Stores the reservation mails in the database and sends them in the
+background.
+
+Instead of sending mails while the request commits, the rendered messages
+are written to the outbox table in the same transaction as the reservations
+they are about. Once the transaction is committed, a worker thread sends
+the messages of the site in batches, using a single SMTP connection per
+batch. Messages which can't be sent are retried later, waiting longer after
+each failed attempt. To do so, the workers check the outbox of each site
+with pending messages periodically. After a restart, the maintenance thread
+(see seantis.reservation.maintenance) tells the workers which sites have
+pending messages. Messages given up on are removed after 30 days.
+
+The number of worker threads may be configured in the product-config of
+seantis.reservation (mail-workers). With no workers, the outbox needs to be
+flushed by calling the flush-mail-outbox view as a manager (e.g. using a
+clockserver with the credentials of a manager).
+
+"""
+
+from logging import getLogger
+log = getLogger('seantis.reservation')
+
+import Queue
+import smtplib
+import threading
+import transaction
+
+from datetime import timedelta
+from email.Utils import parseaddr
+
+from Acquisition import aq_base
+from five import grok
+from libres.db.models import ORMBase
+from libres.db.models.types import UTCDateTime
+from Products.MailHost.MailHost import MailHost
+from sqlalchemy import types
+from sqlalchemy.schema import Column
+from zope.component.hooks import getSite
+from zope.interface import Interface
+
+from seantis.reservation import utils
+from seantis.reservation.base import BaseView
+
+_sites = set()  # the paths of the sites with messages in the outbox
+_workers = list()  # the running worker threads
+_queue = Queue.Queue()
+_pending = threading.local()
+
+locks = {
+    '_sites': threading.Lock(),
+    '_workers': threading.Lock()
+}
+
+# the number of messages sent over a single SMTP connection
+batch_size = 50
+
+# the number of attempts after which a message is no longer sent
+max_attempts = 10
+
+# the number of seconds after which the workers look for due messages
+retry_interval = 60
+
+# the time after which the messages given up on are removed
+retention = timedelta(days=30)
+
+
+class OutboxMessage(ORMBase):
+    """ A rendered mail waiting to be sent. """
+
+    __tablename__ = 'mail_outbox'
+
+    id = Column(types.Integer(), primary_key=True, autoincrement=True)
+
+    # the physical path of the site the message was sent from
+    site = Column(types.Text(), nullable=False)
+
+    sender = Column(types.Text(), nullable=False)
+    recipient = Column(types.Text(), nullable=False)
+    message = Column(types.Text(), nullable=False)
+
+    created = Column(UTCDateTime(timezone=False), nullable=False)
+    next_attempt = Column(UTCDateTime(timezone=False), nullable=False)
+    attempts = Column(types.Integer(), nullable=False, default=0)
+    last_error = Column(types.Text(), nullable=True)
+
+
+def get_session():
+    from seantis.reservation.session import Session
+    return Session()
+
+
+def site_path(site):
+    return '/'.join(site.getPhysicalPath())
+
+
+def backoff(attempts):
+    """ Returns the time to wait after the given number of failed attempts.
+    """
+    return timedelta(minutes=min(2 ** attempts, 12 * 60))
+
+
+def enqueue(sender, recipient, message, site=None):
+    """ Adds the given message to the outbox. It is sent once the current
+    transaction is committed.
+
+    """
+    path = site_path(site or getSite())
+    now = utils.utcnow()
+
+    get_session().add(OutboxMessage(
+        site=path, sender=sender, recipient=recipient, message=message,
+        created=now, next_attempt=now, attempts=0
+    ))
+
+    # wake the workers once per transaction and site
+    current = transaction.get()
+
+    if getattr(_pending, 'transaction', None) is not current:
+        _pending.transaction = current
+        _pending.sites = set()
+
+    if path not in _pending.sites:
+        _pending.sites.add(path)
+        current.addAfterCommitHook(wake, args=(path, ))
+
+
+def wake(success, path):
+    """ Tells the workers about new messages of the given site. """
+
+    if not success:
+        return
+
+    with locks['_sites']:
+        _sites.add(path)
+
+    if start_workers():
+        _queue.put(path)
+
+
+def pending_messages(session, path):
+    """ Returns the messages of the given site which will be sent. """
+
+    query = session.query(OutboxMessage)
+    query = query.filter(OutboxMessage.site == path)
+    query = query.filter(OutboxMessage.attempts < max_attempts)
+
+    return query
+
+
+def resume(session):
+    """ Tells the workers about all sites with pending messages. Otherwise
+    only the process which wrote the messages knows about them, until it
+    is restarted. Called by the maintenance thread.
+
+    """
+    query = session.query(OutboxMessage.site)
+    query = query.filter(OutboxMessage.attempts < max_attempts)
+
+    paths = [path for (path, ) in query.distinct()]
+
+    if not paths:
+        return
+
+    with locks['_sites']:
+        _sites.update(paths)
+
+    if start_workers():
+        for path in paths:
+            _queue.put(path)
+
+
+def remove_dead_messages(session):
+    """ Removes the messages which were given up on and are older than the
+    retention period. Returns the number of messages removed.
+
+    """
+    query = session.query(OutboxMessage)
+    query = query.filter(OutboxMessage.attempts >= max_attempts)
+    query = query.filter(OutboxMessage.created <= utils.utcnow() - retention)
+
+    return query.delete(synchronize_session=False)
+
+
+def due_messages(session, path, limit):
+    """ Returns the messages of the given site which should be sent now,
+    locking them. If supported, messages locked by another ZEO client are
+    skipped instead of waited for.
+
+    """
+    query = pending_messages(session, path)
+    query = query.filter(OutboxMessage.next_attempt <= utils.utcnow())
+    query = query.order_by(OutboxMessage.id).limit(limit)
+
+    return utils.skip_locked(session, query).all()
+
+
+class SMTPDelivery(object):
+    """ Sends messages over a single connection to the server configured
+    on the MailHost.
+
+    """
+
+    def __init__(self, mailhost):
+        self.mailhost = mailhost
+        self.connection = None
+
+    def __enter__(self):
+        mailhost = self.mailhost
+
+        self.connection = smtplib.SMTP(
+            mailhost.smtp_host, int(mailhost.smtp_port)
+        )
+
+        if getattr(mailhost, 'force_tls', False):
+            self.connection.starttls()
+
+        if mailhost.smtp_uid:
+            self.connection.login(mailhost.smtp_uid, mailhost.smtp_pwd)
+
+        return self
+
+    def __exit__(self, *args):
+        try:
+            self.connection.quit()
+        except smtplib.SMTPException:
+            self.connection.close()
+
+    def send(self, message):
+        self.connection.sendmail(
+            parseaddr(message.sender)[1],
+            [parseaddr(message.recipient)[1]],
+            message.message
+        )
+
+
+class MailHostDelivery(object):
+    """ Hands the messages to a MailHost which is not the standard one
+    (for example a queueing or a testing MailHost).
+
+    """
+
+    def __init__(self, mailhost):
+        self.mailhost = mailhost
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def send(self, message):
+        self.mailhost.send(message.message, immediate=True)
+
+
+def get_delivery(site):
+    mailhost = site.MailHost
+
+    if type(aq_base(mailhost)) is MailHost:
+        return SMTPDelivery(mailhost)
+    else:
+        return MailHostDelivery(mailhost)
+
+
+def flush(site):
+    """ Sends the due messages of the given site in batches, committing
+    after each batch. Returns the number of messages sent.
+
+    """
+    path = site_path(site)
+    session = get_session()
+    sent = 0
+
+    while True:
+        messages = due_messages(session, path, batch_size)
+
+        if not messages:
+            break
+
+        sent += send_batch(site, session, messages)
+        transaction.commit()
+
+        if len(messages) < batch_size:
+            break
+
+    return sent
+
+
+def send_batch(site, session, messages):
+    """ Sends the given messages, removing the ones sent from the outbox
+    and rescheduling the others. Returns the number of messages sent.
+
+    """
+    sent = 0
+    remaining = list(messages)
+
+    try:
+        with get_delivery(site) as delivery:
+            while remaining:
+                message = remaining.pop(0)
+
+                try:
+                    delivery.send(message)
+                except message_errors as e:
+                    reschedule(message, e)
+                else:
+                    session.delete(message)
+                    sent += 1
+
+    except (smtplib.SMTPException, IOError) as e:
+        log.warn('could not send {} messages: {}'.format(len(remaining), e))
+
+        for message in remaining:
+            reschedule(message, e)
+
+    session.flush()
+    return sent
+
+
+# errors concerning a single message, as opposed to the connection
+message_errors = (
+    smtplib.SMTPRecipientsRefused,
+    smtplib.SMTPSenderRefused,
+    smtplib.SMTPDataError
+)
+
+
+def reschedule(message, error):
+    message.attempts += 1
+    message.last_error = unicode(error)
+    message.next_attempt = utils.utcnow() + backoff(message.attempts)
+
+    if message.attempts >= max_attempts:
+        log.error('giving up on message {} to {}: {}'.format(
+            message.id, message.recipient, error
+        ))
+
+
+def flush_in_worker(path):
+    """ Flushes the outbox of the given site with a separate ZODB
+    connection.
+
+    """
+    from seantis.reservation.maintenance import opened_site
+
+    with opened_site(path) as site:
+        flush(site)
+
+        # the site is checked until all messages are sent or given up
+        if not pending_messages(get_session(), path).first():
+            with locks['_sites']:
+                _sites.discard(path)
+
+
+def worker():
+    while True:
+        try:
+            path = _queue.get(timeout=retry_interval)
+        except Queue.Empty:
+            with locks['_sites']:
+                retried = list(_sites)
+
+            for path in retried:
+                flush_safely(path)
+
+            continue
+
+        try:
+            flush_safely(path)
+        finally:
+            _queue.task_done()
+
+
+def flush_safely(path):
+    try:
+        flush_in_worker(path)
+    except Exception:
+        log.exception('failed to flush the outbox of {}'.format(path))
+
+
+def max_workers():
+    try:
+        return int(utils.get_config('mail-workers') or 1)
+    except utils.ConfigurationError:
+        return 1
+
+
+def start_workers():
+    """ Starts the configured number of workers if necessary. Returns False
+    if there are no workers.
+
+    """
+    with locks['_workers']:
+        while len(_workers) < max_workers():
+            thread = threading.Thread(
+                target=worker, name='seantis.reservation.outbox'
+            )
+            thread.daemon = True
+            thread.start()
+
+            _workers.append(thread)
+
+        return bool(_workers)
+
+
+class FlushOutbox(BaseView):
+    """ Sends the due messages of the site, committing after each batch.
+    Reserved to managers, as the messages are normally sent by the workers.
+
+    """
+
+    permission = "cmf.ManagePortal"
+
+    grok.name('flush-mail-outbox')
+    grok.require(permission)
+
+    grok.context(Interface)
+
+    def render(self):
+        site = getSite()
+        path = site_path(site)
+
+        sent = flush(site)
+        log.info('sent {} messages from the outbox of {}'.format(sent, path))
+
+        return "sent {} messages".format(sent)
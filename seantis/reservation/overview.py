@@ -4,8 +4,11 @@ from datetime import timedelta, datetime
 from five import grok
 from zope.interface import Interface
 
-from seantis.reservation.resource import CalendarRequest, get_queries
+from seantis.reservation.resource import CalendarRequest
+from seantis.reservation import exposure
+from seantis.reservation import summary
 from seantis.reservation import utils
+from seantis.reservation.session import Session
 from seantis.reservation.base import BaseView, BaseViewlet
 from seantis.reservation.interfaces import IOverview, OverviewletManager
 
@@ -69,6 +72,8 @@ class Overview(BaseView, CalendarRequest):
     grok.name('overview')
     grok.require('zope2.View')
 
+    cache_per_user = True
+
     def uuids(self):
         # The uuids are transmitted by the fullcalendar call, which seems to
         # mangle the the uuid options as follows:
@@ -79,6 +84,9 @@ class Overview(BaseView, CalendarRequest):
 
         return uuids
 
+    def resource_uuids(self):
+        return self.uuids()
+
     def render(self):
         result = CalendarRequest.render(self)
         return result
@@ -93,8 +101,9 @@ class Overview(BaseView, CalendarRequest):
         events = []
 
         uuids = uuids or self.uuids()
-        queries = get_queries(uuids)
-        days = queries.availability_by_day(start, end, uuids)
+        days = summary.availability_by_day(
+            Session(), start, end, uuids, exposure.for_days(uuids)
+        )
 
         for day, result in days.items():
 
@@ -0,0 +1,216 @@
+""" Configures the connection pools of the seantis.reservation databases and
+keeps track of how they are used.
+
+Each site gets its own engine and therefore its own pool. The pool may be
+tuned using the product-config of seantis.reservation, next to the dsn.
+The settings apply to all sites, unless they are overridden for a single
+site using the site id as suffix (like dsn-mysite):
+
+    pool-size 5
+    pool-size-mysite 10
+    max-overflow 5
+    pool-timeout 30
+    pool-recycle 3600
+    pool-pre-ping true
+
+The pool metrics of all sites are available as JSON through the pool-metrics
+view, which helps to see if the threads of an instance are queueing for
+database connections.
+
+"""
+
+import json
+import threading
+import time
+
+from five import grok
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+from zope.interface import Interface
+
+from seantis.reservation import utils
+from seantis.reservation.base import BaseView
+
+_metrics = dict()  # the pool metrics by site id
+
+locks = {
+    '_metrics': threading.Lock()
+}
+
+# the pool settings and their defaults, which are the same as in libres
+pool_settings = (
+    ('pool_size', 'pool-size', int, 5),
+    ('max_overflow', 'max-overflow', int, 5),
+    ('pool_timeout', 'pool-timeout', int, None),
+    ('pool_recycle', 'pool-recycle', int, None),
+    ('pool_pre_ping', 'pool-pre-ping', lambda v: v.lower() in (
+        'true', 'yes', 'on', '1'
+    ), None),
+)
+
+
+def pool_config(site_id):
+    """ Returns the engine arguments for the pool of the given site.
+    Settings which are not configured are left out, so the defaults of
+    SQLAlchemy apply (pool-pre-ping requires SQLAlchemy 1.2).
+
+    """
+    config = dict()
+
+    for argument, key, convert, default in pool_settings:
+        value = utils.get_config('%s-%s' % (key, site_id))
+
+        if value is None:
+            value = utils.get_config(key)
+
+        if value is None:
+            value = default
+        elif isinstance(value, basestring):
+            value = convert(value.strip())
+
+        if value is not None:
+            config[argument] = value
+
+    return config
+
+
+class PoolMetrics(object):
+    """ Counts the checkouts of a pool together with the time spent waiting
+    for a connection, which includes the time needed to open a new one.
+
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pool = None
+        self.reset()
+
+    def reset(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.peak_checkedout = 0
+        self.peak_overflow = 0
+
+    def record_checkout(self, pool, wait):
+        with self.lock:
+            self.checkouts += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            self.peak_checkedout = max(self.peak_checkedout, pool.checkedout())
+            self.peak_overflow = max(self.peak_overflow, pool.overflow())
+
+    def record_timeout(self, pool, wait):
+        with self.lock:
+            self.timeouts += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+    def as_dict(self):
+        with self.lock:
+            result = {
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'total_wait': self.total_wait,
+                'max_wait': self.max_wait,
+                'average_wait': self.checkouts and (
+                    self.total_wait / self.checkouts
+                ) or 0.0,
+                'peak_checkedout': self.peak_checkedout,
+                'peak_overflow': self.peak_overflow,
+            }
+
+        if self.pool is not None:
+            result.update({
+                'size': self.pool.size(),
+                'checkedin': self.pool.checkedin(),
+                'checkedout': self.pool.checkedout(),
+                'overflow': self.pool.overflow(),
+            })
+
+        return result
+
+
+class MeteredQueuePool(QueuePool):
+    """ A QueuePool recording the checkouts in its metrics. """
+
+    metrics = None
+
+    def _do_get(self):
+        if self.metrics is None:
+            return super(MeteredQueuePool, self)._do_get()
+
+        started = time.time()
+
+        try:
+            connection = super(MeteredQueuePool, self)._do_get()
+        except exc.TimeoutError:
+            self.metrics.record_timeout(self, time.time() - started)
+            raise
+
+        self.metrics.record_checkout(self, time.time() - started)
+        return connection
+
+    def recreate(self):
+        # called when the engine is disposed, the metrics carry over
+        pool = super(MeteredQueuePool, self).recreate()
+        pool.metrics = self.metrics
+
+        if self.metrics is not None:
+            self.metrics.pool = pool
+
+        return pool
+
+
+def metrics_for(site_id):
+    """ Returns the metrics of the given site, creating them if necessary.
+    """
+    with locks['_metrics']:
+        if site_id not in _metrics:
+            _metrics[site_id] = PoolMetrics()
+
+        return _metrics[site_id]
+
+
+def observe(engine, site_id):
+    """ Attaches the metrics of the given site to the pool of the engine. """
+
+    metrics = metrics_for(site_id)
+    metrics.pool = engine.pool
+
+    engine.pool.metrics = metrics
+
+
+def clear_metrics():
+    """ Clears the metrics for testing. """
+
+    with locks['_metrics']:
+        _metrics.clear()
+
+
+class PoolMetricsView(BaseView):
+    """ Returns the pool metrics of all sites as JSON. Pass reset=1 to
+    reset the counters after reading them.
+
+    """
+
+    permission = 'cmf.ManagePortal'
+
+    grok.name('pool-metrics')
+    grok.require(permission)
+    grok.context(Interface)
+
+    def render(self):
+        with locks['_metrics']:
+            metrics = _metrics.items()
+
+        result = dict((site_id, m.as_dict()) for site_id, m in metrics)
+
+        if self.request.get('reset'):
+            for site_id, m in metrics:
+                with m.lock:
+                    m.reset()
+
+        self.request.response.setHeader('Content-Type', 'application/json')
+        return json.dumps(result, sort_keys=True)
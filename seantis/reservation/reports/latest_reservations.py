@@ -1,18 +1,28 @@
+import pytz
+
 from datetime import datetime, timedelta
+from uuid import UUID
 
 from five import grok
+from plone.memoize import view
 from zope.interface import Interface
 
-from sqlalchemy import desc
+from sqlalchemy import and_, desc, func, or_, types
+from sqlalchemy.dialects.postgresql import array_agg
 
 from seantis.reservation import Session
 from seantis.reservation import _
 from seantis.reservation import utils
-from seantis.reservation.reservations import combine_reservations
-from libres.db.models import Reservation
+from seantis.reservation.reservations import BoundTimespan
+from libres.db.models import Allocation, Reservation
 from seantis.reservation.base import BaseView
 from seantis.reservation.reports import GeneralReportParametersMixin
 
+# the number of reservation tokens shown per page, if not configured
+default_page_size = 100
+
+epoch = datetime(1970, 1, 1, tzinfo=pytz.utc)
+
 
 def human_date(date):
     # timezones are currently naive and implicity the one used by
@@ -65,11 +75,17 @@ class LatestReservationsReportView(BaseView, GeneralReportParametersMixin):
         return utils.safe_parse_int(self.request.get('end'), 30)
 
     @property
+    def after(self):
+        return decode_page_key(self.request.get('after'))
+
+    @property
+    @view.memoize
     def results(self):
         return latest_reservations(
             resources=self.resources,
             reservations=self.reservations or '*',
             daterange=self.daterange,
+            after=self.after
         )
 
     @property
@@ -95,12 +111,15 @@ class LatestReservationsReportView(BaseView, GeneralReportParametersMixin):
             utils.localize_date(until, long_format=False)
         ))
 
-    def build_url(self, start, end):
+    def build_url(self, start, end, after=None):
         params = [
             ('start', str(start)),
             ('end', str(end))
         ]
 
+        if after is not None:
+            params.append(('after', encode_page_key(*after)))
+
         return super(LatestReservationsReportView, self).build_url(
             extra_parameters=params
         )
@@ -122,31 +141,187 @@ class LatestReservationsReportView(BaseView, GeneralReportParametersMixin):
 
         return self.build_url(start, end)
 
+    @property
+    def more_url(self):
+        next_page = self.results.next_page
+
+        if next_page is None:
+            return None
+
+        return self.build_url(self.start, self.end, next_page)
+
     def reservation_title(self, reservation):
         human_date_text = utils.translate(
             self.context, self.request, human_date(reservation.created)
         )
         return '{} - {}'.format(human_date_text, reservation.title)
 
-    def unique(self, reservations):
-        return tuple(combine_reservations(reservations))
 
+def encode_page_key(created, token):
+    """ Returns the given keyset position as text for use in urls. """
+
+    delta = created - epoch
+    microseconds = (
+        delta.days * 24 * 3600 + delta.seconds
+    ) * 10 ** 6 + delta.microseconds
+
+    return '{}-{}'.format(microseconds, token.hex)
+
+
+def decode_page_key(text):
+    """ Returns the keyset position encoded by encode_page_key or None if
+    the text is not a valid position.
+
+    """
+    if not text:
+        return None
+
+    try:
+        microseconds, token = text.split('-', 1)
+        return (
+            epoch + timedelta(microseconds=int(microseconds)),
+            UUID(token)
+        )
+    except ValueError:
+        return None
+
+
+def configured_page_size():
+    try:
+        return int(
+            utils.get_config('latest-reservations-page-size')
+            or default_page_size
+        )
+    except utils.ConfigurationError:
+        return default_page_size
+
+
+class LatestReservations(utils.OrderedDict):
+    """ The reservation tokens of a page, ordered by the time the latest
+    reservation of the token was made.
+
+    The next_page is the position after which the next page starts (None
+    on the last page).
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(LatestReservations, self).__init__(*args, **kwargs)
+        self.next_page = None
+
+
+class LatestToken(object):
+    """ The reservations of a token, as returned by latest_tokens. Usable
+    like the combined reservations of the token by the reservation macros.
+
+    """
+
+    def __init__(self, row):
+        self.token = row.token
+        self.created = row.created
+        self.title = row.email
+        self.status = row.status
+        self.resource = UUID(row.resource)
+        self.quota = row.quota
+        self.data = row.data
+
+        self.combined_timespans = [
+            BoundTimespan(start, end, row.token, id)
+            for start, end, id in zip(row.starts, row.ends, row.ids)
+        ]
+
+    def timespans(self):
+        return [(t[0], t[1]) for t in self.combined_timespans]
+
+    def bound_timespans(self):
+        return self.combined_timespans
+
+
+def latest_tokens(session, resources, daterange, reservations='*'):
+    """ Returns a query with one row per reservation token made in the
+    given daterange, newest first.
+
+    Each row contains the time of the latest reservation and the
+    reservation data of the token, together with the start, end and
+    reservation id of each timespan reserved. Reservations of groups
+    yield a timespan for each allocation in the group.
+
+    """
+
+    created = func.max(Reservation.created)
+
+    # reservations of single allocations store their end date minus one
+    # microsecond, like libres' Reservation.timespans we add it back
+    start = func.coalesce(Allocation._start, Reservation.start)
+    end = func.coalesce(
+        Allocation._end, Reservation.end + timedelta(microseconds=1)
+    )
+
+    query = session.query(
+        Reservation.token.label('token'),
+        created.label('created'),
+        func.min(Reservation.email).label('email'),
+        # pending if any reservation of the token is still pending
+        func.max(Reservation.status.cast(types.Text)).label('status'),
+        func.min(Reservation.resource.cast(types.Text)).label('resource'),
+        func.max(Reservation.quota).label('quota'),
+        func.min(Reservation.data).label('data'),
+        array_agg(start).label('starts'),
+        array_agg(end).label('ends'),
+        array_agg(Reservation.id).label('ids')
+    )
+
+    query = query.outerjoin(Allocation, and_(
+        Reservation.target_type == u'group',
+        Allocation.group == Reservation.target,
+        Allocation.resource == Allocation.mirror_of
+    ))
 
-def latest_reservations(resources, daterange, reservations='*'):
-    query = Session().query(Reservation)
     query = query.filter(Reservation.resource.in_(resources.keys()))
     query = query.filter(Reservation.created > daterange[0])
     query = query.filter(Reservation.created <= daterange[1])
-    query = query.order_by(desc(Reservation.created))
 
     if reservations != '*':
         query = query.filter(Reservation.token.in_(reservations))
 
-    result = utils.OrderedDict()
-    for reservation in query.all():
-        if reservation.token in result:
-            result[reservation.token].append(reservation)
-        else:
-            result[reservation.token] = [reservation]
+    query = query.group_by(Reservation.token)
+
+    return query.order_by(desc(created), desc(Reservation.token))
+
+
+def latest_reservations(
+    resources, daterange, reservations='*', after=None, page_size=None
+):
+    """ Returns a page of the reservation tokens made in the given
+    daterange. The pages are keyed by the (created, token) of the last
+    token on the previous page, passed as 'after'.
+
+    """
+
+    session = Session()
+    page_size = page_size or configured_page_size()
+
+    tokens = latest_tokens(session, resources, daterange, reservations)
+
+    if after is not None:
+        created, token = after
+        latest = func.max(Reservation.created)
+
+        tokens = tokens.having(or_(
+            latest < created,
+            and_(latest == created, Reservation.token < token)
+        ))
+
+    # one more row than needed tells if there's a next page
+    rows = tokens.limit(page_size + 1).all()
+
+    result = LatestReservations()
+
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        result.next_page = (rows[-1].created, rows[-1].token)
+
+    for row in rows:
+        result[row.token] = LatestToken(row)
 
     return result
@@ -1,7 +1,6 @@
 import json
-import sedate
 
-from calendar import Calendar
+from calendar import monthrange
 from datetime import date, timedelta, datetime
 
 from five import grok
@@ -12,13 +11,11 @@ from seantis.reservation import _
 from seantis.reservation import Session
 from seantis.reservation import settings
 from seantis.reservation import utils
-from libres import modules
 from libres.db.models import Allocation, Reservation
+from sqlalchemy import and_, case, func, or_
 from seantis.reservation.reports import GeneralReportParametersMixin
 from seantis.reservation.interfaces import ISeantisReservationSpecific
 
-calendar = Calendar()
-
 
 class MonthlyReportView(
     grok.View, GeneralReportParametersMixin
@@ -138,6 +135,67 @@ class MonthlyReportView(
         return False
 
 
+def local_time(column, timezone):
+    """ Converts the given UTC column to the local time of the timezone. """
+    return func.timezone(timezone.zone, func.timezone('UTC', column))
+
+
+def report_rows(session, period_start, period_end, uuids, tokens, timezone):
+    """ Returns the reserved timespans of the given resources in the given
+    period, together with the local day they start on.
+
+    Reservations of allocations result in one row, reservations of groups
+    in one row per allocation of the group in the period. The start and end
+    of the rows are naive datetimes in the given timezone.
+
+    """
+
+    is_allocation = Reservation.target_type == u'allocation'
+
+    start = local_time(case(
+        [(is_allocation, Reservation.start)], else_=Allocation._start
+    ), timezone)
+    end = local_time(case(
+        [(is_allocation, Reservation.end)], else_=Allocation._end
+    ), timezone)
+
+    query = session.query(
+        func.date_part('day', start).label('day'),
+        start.label('start'),
+        end.label('end'),
+        Reservation.id,
+        Reservation.token,
+        Reservation.email,
+        Reservation.data,
+        Reservation.quota,
+        Reservation.status,
+        Reservation.resource
+    )
+
+    # the allocations of a group don't overlap, so a reservation of an
+    # allocation is joined with the allocation it lies in
+    query = query.join(Allocation, and_(
+        Allocation.group == Reservation.target,
+        or_(
+            Reservation.target_type == u'group',
+            and_(
+                Allocation._start <= Reservation.start,
+                Reservation.start <= Allocation._end
+            )
+        )
+    ))
+
+    query = query.filter(period_start <= Allocation._start)
+    query = query.filter(Allocation._start <= period_end)
+    query = query.filter(Allocation.resource == Allocation.mirror_of)
+    query = query.filter(Allocation.resource.in_(uuids))
+
+    if tokens != '*':
+        query = query.filter(Reservation.token.in_(tokens))
+
+    return query.order_by(Reservation.status, start, Reservation.id)
+
+
 def monthly_report(year, month, resources, reservations='*'):
 
     titles = dict()
@@ -151,16 +209,29 @@ def monthly_report(year, month, resources, reservations='*'):
     # this order is used for every day in the month
     ordered_uuids = [i[0] for i in sorted(titles.items(), key=lambda i: i[1])]
 
-    # build the hierarchical structure of the report data
-    report = utils.OrderedDict()
-    last_day = 28
+    # the reservations are fetched in a single query, bucketed by day
+    last_day = monthrange(year, month)[1]
+
+    period_start = timezone.localize(datetime(year, month, 1))
+    period_end = timezone.localize(datetime(year, month, last_day))
+    period_end += timedelta(days=1, microseconds=-1)
+
+    rows = report_rows(
+        Session(), period_start, period_end, resources.keys(),
+        reservations, timezone
+    ).all()
 
-    for d in sorted((d for d in calendar.itermonthdates(year, month))):
-        if not d.month == month:
-            continue
+    if not rows:
+        return {}
+
+    # build the hierarchical structure of the report data for the used days
+    report = utils.OrderedDict()
+    lists = {
+        u'approved': _(u'Approved'),
+        u'pending': _(u'Pending'),
+    }
 
-        day = d.day
-        last_day = max(last_day, day)
+    for day in sorted(set(int(row.day) for row in rows)):
         report[day] = utils.OrderedDict()
 
         for uuid in ordered_uuids:
@@ -169,94 +240,40 @@ def monthly_report(year, month, resources, reservations='*'):
             report[day][uuid][u'approved'] = list()
             report[day][uuid][u'pending'] = list()
             report[day][uuid][u'url'] = resources[uuid].absolute_url()
-            report[day][uuid][u'lists'] = {
-                u'approved': _(u'Approved'),
-                u'pending': _(u'Pending'),
-            }
-
-    # gather the reservations with as much bulk loading as possible
-    period_start = datetime(year, month, 1, tzinfo=timezone)
-    period_end = datetime(year, month, last_day, tzinfo=timezone)
-    period_end += timedelta(days=1, microseconds=-1)
-
-    # get a list of relevant allocations in the given period
-    query = Session().query(Allocation)
-    query = query.filter(period_start <= Allocation._start)
-    query = query.filter(Allocation._start <= period_end)
-    query = query.filter(Allocation.resource == Allocation.mirror_of)
-    query = query.filter(Allocation.resource.in_(resources.keys()))
-
-    allocations = query.all()
-
-    # quit if there are no allocations at this point
-    if not allocations:
-        return {}
-
-    # store by group as it will be needed multiple times over later
-    groups = dict()
-    for allocation in allocations:
-        groups.setdefault(allocation.group, list()).append(allocation)
-
-    # using the groups get the relevant reservations
-    query = Session().query(Reservation)
-    query = query.filter(Reservation.target.in_(groups.keys()))
-
-    if reservations != '*':
-        query = query.filter(Reservation.token.in_(reservations))
-
-    query = query.order_by(Reservation.status)
-
-    reservations = query.all()
+            report[day][uuid][u'lists'] = lists
 
     @utils.memoize
     def json_timespans(start, end):
         return json.dumps([dict(start=start, end=end)])
 
-    used_days = dict([(i, False) for i in range(1, 32)])
-    timezone = settings.timezone()
-
-    def add_reservation(start, end, reservation):
-        day = start.day
-
-        used_days[day] = True
+    @utils.memoize
+    def format_time(value):
+        return utils.localize_date(value, time_only=True)
 
-        end += timedelta(microseconds=1)
+    quota_statements = dict()
 
-        start = sedate.to_timezone(start, timezone=timezone)
-        end = sedate.to_timezone(end, timezone=timezone)
+    for row in rows:
+        uuid = utils.string_uuid(row.resource)
 
-        start = utils.localize_date(start, time_only=True)
-        end = utils.localize_date(end, time_only=True)
+        start = format_time(row.start)
+        end = format_time(row.end + timedelta(microseconds=1))
 
-        context = resources[utils.string_uuid(reservation.resource)]
+        if row.quota not in quota_statements:
+            quota_statements[row.quota] = \
+                utils.get_reservation_quota_statement(row.quota)
 
-        reservation_lists = report[day][utils.string_uuid(
-            reservation.resource
-        )]
-        reservation_lists[reservation.status].append(
+        report[int(row.day)][uuid][row.status].append(
             dict(
                 start=start,
                 end=end,
-                email=reservation.email,
-                data=reservation.data,
+                email=row.email,
+                data=row.data,
                 timespans=json_timespans(start, end),
-                id=reservation.id,
-                token=reservation.token,
-                quota=utils.get_reservation_quota_statement(reservation.quota),
-                resource=context,
+                id=row.id,
+                token=row.token,
+                quota=quota_statements[row.quota],
+                resource=resources[uuid],
             )
         )
 
-    for reservation in reservations:
-        if reservation.target_type == u'allocation':
-            add_reservation(reservation.start, reservation.end, reservation)
-        else:
-            for allocation in groups[reservation.target]:
-                add_reservation(allocation.start, allocation.end, reservation)
-
-    # remove unused days
-    for day in report:
-        if not used_days[day]:
-            del report[day]
-
     return report
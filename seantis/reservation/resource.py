@@ -6,6 +6,7 @@ import libres
 import pytz
 
 from datetime import datetime, date
+from urllib import urlencode
 
 from Products.ATContentTypes.interface import IATFolder
 
@@ -20,9 +21,13 @@ from zope.component import getUtility
 from zope.event import notify
 from zope.interface import implements, Interface
 from zope.lifecycleevent.interfaces import IObjectRemovedEvent
+from libres.db.models import Allocation
+from sqlalchemy import func
 
 from seantis.reservation import _
+from seantis.reservation import cache
 from seantis.reservation import exposure
+from seantis.reservation import serializer
 from seantis.reservation import settings
 from seantis.reservation import utils
 from seantis.reservation.base import BaseView
@@ -34,19 +39,14 @@ from seantis.reservation.interfaces import IOverview
 from seantis.reservation.session import ILibresUtility
 
 
-class LibresExposure(object):
-
-    def __init__(self, fn):
-        self.is_allocation_exposed = fn
+def get_queries(resources):
+    """ Returns the libres queries of the current site. The exposure of the
+    given resources is looked up in advance (see exposure.for_request).
 
+    """
+    exposure.for_request().add(resources)
 
-def get_queries(resources):
     libres_util = getUtility(ILibresUtility)
-    libres_util.context.set_service(
-        'exposure',
-        lambda ctx: LibresExposure(exposure.for_allocations(resources))
-    )
-
     return libres.db.queries.Queries(libres_util.context)
 
 
@@ -65,11 +65,6 @@ class Resource(Container):
         uuid = utils.string_uuid(self.uuid())
 
         libres_util = getUtility(ILibresUtility)
-        libres_util.context.set_service(
-            'exposure',
-            lambda ctx: LibresExposure(exposure.for_allocations([uuid]))
-        )
-
         return libres_util.scheduler(uuid, settings.timezone().zone)
 
     def timeframes(self):
@@ -138,6 +133,29 @@ class YourReservationsViewlet(object):
         return viewlet.render()
 
 
+def compared_uuids(request):
+    uuids = request.get('compare_to', [])
+    if not hasattr(uuids, '__iter__'):
+        uuids = [uuids]
+
+    return uuids
+
+
+def compared_resources(context, request):
+    """ Returns the given resource and the resources it is compared to (as
+    passed by the compare_to parameter), in the order of the parameter.
+
+    """
+    uuids = compared_uuids(request)
+    found = utils.get_resource_objects_by_uuids(uuids)
+
+    resources = [context]
+    for uuid in uuids:
+        resources.append(found[utils.string_uuid(uuid)])
+
+    return resources
+
+
 class View(BaseView, YourReservationsViewlet):
     permission = 'zope2.View'
 
@@ -170,14 +188,7 @@ class View(BaseView, YourReservationsViewlet):
 
     @view.memoize
     def resources(self):
-        uids = self.request.get('compare_to', [])
-        if not hasattr(uids, '__iter__'):
-            uids = [uids]
-
-        resources = [self.context]
-        for uid in uids:
-            resource = utils.get_resource_by_uuid(uid)
-            resources.append(resource.getObject())
+        resources = compared_resources(self.context, self.request)
 
         template = 'seantis-reservation-calendar-%i'
         for ix, resource in enumerate(resources):
@@ -227,7 +238,8 @@ class View(BaseView, YourReservationsViewlet):
         this.seantis.calendars.push({
             id:'#%s',
             options:%s,
-            addurl:'%s'
+            addurl:'%s',
+            compare:%s
         })
         """
         baseurl = resource.absolute_url_path()
@@ -236,6 +248,15 @@ class View(BaseView, YourReservationsViewlet):
 
         options = {}
         options['events'] = eventurl
+
+        # compared calendars share a single feed, loaded once for all
+        if self.calendar_count > 1:
+            compare = {
+                'url': self.compare_url,
+                'uuid': utils.string_uuid(resource.uuid())
+            }
+        else:
+            compare = None
         options['minTime'] = first_hour or resource.first_hour
         options['maxTime'] = last_hour or resource.last_hour
 
@@ -279,13 +300,23 @@ class View(BaseView, YourReservationsViewlet):
             }
 
         return template % (
-            resource._v_calendar_id, json.dumps(options), addurl
+            resource._v_calendar_id, json.dumps(options), addurl,
+            json.dumps(compare)
         )
 
     @property
     def calendar_count(self):
         return len(self.resources())
 
+    @property
+    def compare_url(self):
+        query = urlencode([
+            ('compare_to', utils.string_uuid(r.uuid()))
+            for r in self.resources()[1:]
+        ])
+
+        return self.context.absolute_url_path() + '/compare-slots?' + query
+
 
 class GroupView(BaseView, AllocationGroupView):
     permission = 'zope2.View'
@@ -361,14 +392,30 @@ class CalendarRequest(object):
             datetime.fromtimestamp(float(end), pytz.utc)
         )
 
+    # set to True if the feed contains resources other than the context
+    cache_per_user = False
+
     def render(self, **kwargs):
         start, end = self.range
         if not all((start, end)):
             return json.dumps([])
 
-        events = self.events()
+        uuids = [utils.string_uuid(uuid) for uuid in self.resource_uuids()]
+        key = cache.feed_key(
+            self.context, self.request, self.__name__, uuids, start, end,
+            per_user=self.cache_per_user
+        )
+
+        return cache.feeds.cached(
+            key, uuids, lambda: serializer.dumps(self.events())
+        )
+
+    def resource_uuids(self):
+        """ Returns the uuids of the resources shown by the feed. The cached
+        feed is invalidated if any of these resources changes.
 
-        return json.dumps(events, cls=utils.UUIDEncoder)
+        """
+        raise NotImplementedError
 
     def events(self):
         raise NotImplementedError
@@ -384,6 +431,9 @@ class Slots(BaseView, CalendarRequest):
     def render(self):
         return CalendarRequest.render(self)
 
+    def resource_uuids(self):
+        return [self.context.uuid()]
+
     @property
     def resource(self):
         return self.context
@@ -392,43 +442,86 @@ class Slots(BaseView, CalendarRequest):
     def scheduler(self):
         return self.context.scheduler()
 
-    def urls(self, allocation):
+    def urls(self, allocation, resource=None, in_group=None):
         """Returns the options for the js contextmenu for the given allocation
-        as well as other links associated with the event.
+        as well as other links associated with the event. The allocation
+        belongs to the context, unless another resource is given.
+
+        Whether the allocation is in a group is looked up, unless given.
+
+        """
+
+        resource = resource or self.context
+
+        if in_group is None:
+            in_group = allocation.in_group
+
+        is_separate = allocation.partly_available or not in_group
+
+        templates = self.url_templates(resource, is_separate, in_group)
+
+        return templates.render(dict(
+            id=allocation.id,
+            group=allocation.group,
+            start=utils.utctimestamp(
+                allocation.display_start(settings.timezone())),
+            end=utils.utctimestamp(
+                allocation.display_end(settings.timezone())),
+            date=allocation.start.strftime('%Y-%m-%d')
+        ))
+
+    @utils.cached_property
+    def _url_templates(self):
+        return {}
+
+    def url_templates(self, resource, is_separate, in_group):
+        """Returns the templates of the urls of the allocations of the given
+        resource, which are the same for all allocations with the same
+        properties. They are built once per request.
 
         """
 
-        items = utils.EventUrls(self.context, self.request, exposure)
+        key = (resource.uuid(), is_separate, in_group)
+
+        if key not in self._url_templates:
+            self._url_templates[key] = self.build_url_templates(
+                resource, is_separate, in_group
+            )
+
+        return self._url_templates[key]
+
+    def build_url_templates(self, resource, is_separate, in_group):
+        items = utils.EventUrlTemplates(resource, self.request, exposure)
 
-        start = utils.utctimestamp(
-            allocation.display_start(settings.timezone()))
-        end = utils.utctimestamp(
-            allocation.display_end(settings.timezone()))
+        allocation_id = utils.urlfield('id')
+        group = utils.urlfield('group')
+        start = utils.urlfield('start')
+        end = utils.urlfield('end')
 
-        items.move_url('edit-allocation', dict(id=allocation.id))
+        items.move_url('edit-allocation', dict(id=allocation_id))
 
         # Reservation
         res_add = lambda n, v, p, t: \
             items.menu_add(_(u'Reservations'), n, v, p, t)
-        if allocation.is_separate:
+        if is_separate:
             res_add(
                 _(u'Reserve'), 'reserve',
-                dict(id=allocation.id, start=start, end=end), 'overlay'
+                dict(id=allocation_id, start=start, end=end), 'overlay'
             )
             items.default_url(
-                'reserve', dict(id=allocation.id, start=start, end=end)
+                'reserve', dict(id=allocation_id, start=start, end=end)
             )
         else:
             res_add(
-                _(u'Reserve'), 'reserve-group', dict(group=allocation.group),
+                _(u'Reserve'), 'reserve-group', dict(group=group),
                 'overlay'
             )
             items.default_url(
-                'reserve', dict(group=allocation.group)
+                'reserve', dict(group=group)
             )
 
         res_add(
-            _(u'Manage'), 'reservations', dict(group=allocation.group),
+            _(u'Manage'), 'reservations', dict(group=group),
             'inpage'
         )
 
@@ -437,41 +530,66 @@ class Slots(BaseView, CalendarRequest):
             items.menu_add(_('Entry'), n, v, p, t)
 
         entry_add(
-            _(u'Edit'), 'edit-allocation', dict(id=allocation.id), 'overlay'
+            _(u'Edit'), 'edit-allocation', dict(id=allocation_id), 'overlay'
         )
 
         entry_add(
-            _(u'Remove'), 'remove-allocation', dict(id=allocation.id),
+            _(u'Remove'), 'remove-allocation', dict(id=allocation_id),
             'overlay'
         )
 
-        if allocation.in_group:
+        if in_group:
             # menu entries for group items
             group_add = lambda n, v, p, t: \
                 items.menu_add(_('Recurrences'), n, v, p, t)
 
             group_add(
-                _(u'List'), 'group', dict(name=allocation.group), 'overlay'
+                _(u'List'), 'group', dict(name=group), 'overlay'
             )
 
             group_add(
                 _(u'Remove'), 'remove-allocation',
-                dict(group=allocation.group),
+                dict(group=group),
                 'overlay'
             )
 
         # view selections
-        if 'agendaDay' in self.context.available_views:
+        if 'agendaDay' in resource.available_views:
             items.menu_add(
                 _(u'Reservations'), _(u'Daily View'), 'view',
                 dict(
                     selected_view='agendaDay',
-                    specific_date=allocation.start.strftime('%Y-%m-%d')
+                    specific_date=utils.urlfield('date')
                 ), 'window'
             )
 
         return items
 
+    def grouped(self, session, allocations):
+        """Returns the (resource, group) keys of the given master allocations
+        which share their group with other allocations.
+
+        """
+
+        groups = set(a.group for a in allocations)
+
+        if not groups:
+            return set()
+
+        query = session.query(
+            Allocation.resource, Allocation.group, func.count()
+        )
+        query = query.filter(
+            Allocation.resource.in_(set(a.resource for a in allocations))
+        )
+        query = query.filter(Allocation.group.in_(groups))
+        query = query.group_by(Allocation.resource, Allocation.group)
+
+        return set(
+            (resource, group) for resource, group, count in query
+            if count > 1
+        )
+
     def events(self):
         resource = self.context
         scheduler = resource.scheduler()
@@ -479,48 +597,148 @@ class Slots(BaseView, CalendarRequest):
 
         is_exposed = exposure.for_allocations([resource])
 
+        allocations = [
+            a for a in scheduler.allocations_in_range(*self.range)
+            if is_exposed(a)
+        ]
+
+        # calculate the availability and the groups of all allocations
+        availabilities = scheduler.allocation_availabilities(allocations)
+        grouped = self.grouped(scheduler.session, allocations)
+
         # get an event for each exposed allocation
-        events = []
-        for alloc in scheduler.allocations_in_range(*self.range):
+        return [
+            self.event(
+                resource, scheduler, alloc, availabilities, grouped, translate
+            )
+            for alloc in allocations
+        ]
+
+    def event(
+        self, resource, scheduler, alloc, availabilities, grouped, translate
+    ):
+        """ Returns the event of the given allocation of the given resource,
+        using the availabilities returned by allocation_availabilities and
+        the groups returned by grouped.
+
+        """
+
+        start = alloc.display_start(settings.timezone())
+        end = alloc.display_end(settings.timezone())
+
+        # get the urls
+        in_group = (alloc.resource, alloc.group) in grouped
+        urls = self.urls(alloc, resource, in_group)
+
+        # calculate the availability for title and class
+        availability, waitinglist_length = availabilities[alloc.id]
+        availability, title, klass = utils.event_availability(
+            resource, self.request, scheduler, alloc,
+            availability=availability,
+            waitinglist_length=waitinglist_length
+        )
+
+        if alloc.partly_available:
+            partitions = alloc.availability_partitions()
+        else:
+            # if the allocation is not partly available there can only
+            # be one partition meant to be shown as empty unless the
+            # availability is zero
+            partitions = [(100, availability == 0.0)]
+
+        event_header = alloc.whole_day and translate(_(u'Whole Day'))
+
+        return dict(
+            title=title,
+            start=start.isoformat(),
+            end=end.isoformat(),
+            className=klass,
+            url=urls.default,
+            menu=urls.menu,
+            menuorder=urls.order,
+            allocation=alloc.id,
+            partitions=partitions,
+            group=alloc.group,
+            allDay=False,
+            moveurl=urls.move,
+            header=event_header
+        )
+
+
+class CompareSlots(Slots):
+    """ The events of a resource and the resources it is compared to (see
+    View.compare_url), keyed by resource uuid.
+
+    The allocations of all resources are loaded with a single query and
+    their exposure and availability is computed once, so the compared
+    calendars are filled by a single request.
+
+    """
 
-            if not is_exposed(alloc):
-                continue
+    permission = 'zope2.View'
+
+    grok.context(IResourceBase)
+    grok.require(permission)
+    grok.name('compare-slots')
+
+    # the feed contains resources other than the context
+    cache_per_user = True
+
+    def render(self):
+        return CalendarRequest.render(self)
+
+    @view.memoize
+    def resources(self):
+        return compared_resources(self.context, self.request)
+
+    def resource_uuids(self):
+        return [r.uuid() for r in self.resources()]
 
-            start = alloc.display_start(settings.timezone())
-            end = alloc.display_end(settings.timezone())
+    def allocations_in_range(self, scheduler, resources, start, end):
+        """ Returns the master allocations of the given resources in the
+        given range.
 
-            # get the urls
-            urls = self.urls(alloc)
+        """
+        start, end = scheduler._prepare_range(start, end)
+
+        query = scheduler.session.query(Allocation)
+        query = query.filter(Allocation.mirror_of.in_(resources))
+        query = query.filter(Allocation.resource == Allocation.mirror_of)
+        query = scheduler.queries.allocations_in_range(query, start, end)
+
+        return query.order_by(Allocation._start)
+
+    def events(self):
+        translate = utils.translator(self.context, self.request)
 
-            # calculate the availability for title and class
-            availability, title, klass = utils.event_availability(
-                resource, self.request, scheduler, alloc
+        resources = dict(
+            (utils.string_uuid(r.uuid()), r) for r in self.resources()
+        )
+        schedulers = dict(
+            (uuid, r.scheduler()) for uuid, r in resources.items()
+        )
+
+        is_exposed = exposure.for_allocations(resources.values())
+
+        scheduler = schedulers[utils.string_uuid(self.context.uuid())]
+        allocations = [
+            a for a in self.allocations_in_range(
+                scheduler, resources.keys(), *self.range
             )
+            if is_exposed(a)
+        ]
+
+        # calculate the availability and the groups of all allocations
+        availabilities = scheduler.allocation_availabilities(allocations)
+        grouped = self.grouped(scheduler.session, allocations)
+
+        events = dict((uuid, []) for uuid in resources)
+        for alloc in allocations:
+            uuid = utils.string_uuid(alloc.mirror_of)
 
-            if alloc.partly_available:
-                partitions = alloc.availability_partitions()
-            else:
-                # if the allocation is not partly available there can only
-                # be one partition meant to be shown as empty unless the
-                # availability is zero
-                partitions = [(100, availability == 0.0)]
-
-            event_header = alloc.whole_day and translate(_(u'Whole Day'))
-
-            events.append(dict(
-                title=title,
-                start=start.isoformat(),
-                end=end.isoformat(),
-                className=klass,
-                url=urls.default,
-                menu=urls.menu,
-                menuorder=urls.order,
-                allocation=alloc.id,
-                partitions=partitions,
-                group=alloc.group,
-                allDay=False,
-                moveurl=urls.move,
-                header=event_header
+            events[uuid].append(self.event(
+                resources[uuid], schedulers[uuid], alloc, availabilities,
+                grouped, translate
             ))
 
         return events
@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 
 import functools
+import hashlib
 import six
 import sys
+import threading
+import time
 
 from logging import getLogger
 log = getLogger('seantis.reservation')
@@ -33,8 +36,26 @@ from byteplay import (
 
 import seantis.reservation
 
+from plone import api
+
+from seantis.reservation import cache
 from seantis.reservation import utils
-from seantis.reservation.error import CustomReservationError
+from seantis.reservation.error import (
+    CustomReservationError,
+    ScriptBudgetExceeded
+)
+
+# the name under which the expressions are compiled
+filename = '<dynamic>'
+
+_compiled = dict()  # the validated code objects by hash of source and mode
+
+locks = {
+    '_compiled': threading.Lock()
+}
+
+# the number of code objects kept before the cache is emptied
+max_compiled = 100
 
 allowed_op_codes = set([
     POP_TOP, ROT_TWO, ROT_THREE, ROT_FOUR, DUP_TOP, DUP_TOPX,
@@ -60,7 +81,7 @@ allowed_op_codes = set([
 
 def validate_expression(expression, mode='eval'):
     try:
-        code = compile(expression, '<dynamic>', mode)
+        code = compile(expression, filename, mode)
     except (SyntaxError, TypeError):
         raise
 
@@ -76,7 +97,110 @@ def validate_expression(expression, mode='eval'):
     return code
 
 
-def evaluate_expression(expression, globals_=None, locals_=None, mode='eval'):
+def compile_expression(expression, mode='eval'):
+    """ Returns the validated code of the given expression. The code is
+    cached by a hash of the expression, so each expression is only compiled
+    and validated once per process.
+
+    """
+    source = expression
+    if isinstance(source, six.text_type):
+        source = source.encode('utf-8')
+
+    key = (hashlib.sha1(source).hexdigest(), mode)
+
+    with locks['_compiled']:
+        code = _compiled.get(key)
+
+    if code is None:
+        code = validate_expression(expression, mode=mode)
+
+        with locks['_compiled']:
+            if len(_compiled) >= max_compiled:
+                _compiled.clear()
+
+            _compiled[key] = code
+
+    return code
+
+
+def clear_compiled():
+    """ Clears the compiled expressions for testing. """
+
+    with locks['_compiled']:
+        _compiled.clear()
+
+
+def get_limit(key, default, convert):
+    try:
+        return convert(utils.get_config(key) or default)
+    except utils.ConfigurationError:
+        return default
+
+
+class ScriptBudget(object):
+    """ Limits the time and the number of lines an expression may run.
+
+    The lines of the expression (and of the functions defined in it) are
+    traced while it runs. Once either limit is exceeded, the expression is
+    interrupted with a ScriptBudgetExceeded error. The time spent in the
+    functions called by the expression is only checked once they return.
+
+    The budget guards against runaway scripts, not against malicious ones,
+    as a script catching the error is no longer traced.
+
+    """
+
+    def __init__(self, seconds=None, lines=None):
+        self.seconds = seconds or get_limit('script-time-limit', 1.0, float)
+        self.lines = lines or get_limit('script-line-limit', 100000, int)
+
+        self.started = None
+        self.executed = 0
+        self.exceeded = False
+
+    def trace(self, frame, event, arg):
+        if frame.f_code.co_filename != filename:
+            return None
+
+        return self.trace_lines
+
+    def trace_lines(self, frame, event, arg):
+        if event == 'line':
+            self.executed += 1
+
+            if self.executed > self.lines or self.elapsed > self.seconds:
+                self.exceeded = True
+                raise ScriptBudgetExceeded()
+
+        return self.trace_lines
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started
+
+    def run(self, code, globals_, locals_):
+        self.started = time.time()
+        self.executed = 0
+        self.exceeded = False
+
+        previous = sys.gettrace()
+        sys.settrace(self.trace)
+
+        try:
+            result = eval(code, globals_, locals_)
+        finally:
+            sys.settrace(previous)
+
+        if self.exceeded:
+            raise ScriptBudgetExceeded()
+
+        return result
+
+
+def evaluate_expression(
+    expression, globals_=None, locals_=None, mode='eval', budget=None
+):
     globals_ = globals_ if globals_ is not None else {}
     locals_ = locals_ if locals_ is not None else {}
 
@@ -104,8 +228,29 @@ def evaluate_expression(expression, globals_=None, locals_=None, mode='eval'):
         }
     )
 
-    code = validate_expression(expression, mode=mode)
-    return eval(code, globals_, locals_)
+    code = compile_expression(expression, mode=mode)
+
+    if budget is None:
+        return eval(code, globals_, locals_)
+
+    return budget.run(code, globals_, locals_)
+
+
+def get_pre_reserve_script():
+    """ Returns the pre-reservation script of the current site, cached until
+    the registry record is changed.
+
+    """
+    def read():
+        script = seantis.reservation.settings.get('pre_reservation_script')
+        script = isinstance(script, six.string_types) \
+            and six.text_type(script) or u''
+
+        return script.strip()
+
+    return cache.pre_reserve_scripts.cached(
+        '/'.join(api.portal.get().getPhysicalPath()), (), read
+    )
 
 
 def run_pre_reserve_script(context, start, end, data, locals_=None):
@@ -122,11 +267,11 @@ def run_pre_reserve_script(context, start, end, data, locals_=None):
 
     The available methods and variables are purposely undocumented on the
     user interface, because it's meant for developers, not users.
+
+    The script is compiled once and stopped if it exceeds its budget
+    (see ScriptBudget).
     """
-    script = seantis.reservation.settings.get('pre_reservation_script')
-    script = isinstance(script, six.string_types) \
-        and six.text_type(script) or u''
-    script = script.strip()
+    script = get_pre_reserve_script()
 
     if not script:
         return
@@ -150,7 +295,12 @@ def run_pre_reserve_script(context, start, end, data, locals_=None):
     locals_.update(utils.additional_data_objects(data))
 
     try:
-        evaluate_expression(script, locals_=locals_, mode='exec')
+        evaluate_expression(
+            script, locals_=locals_, mode='exec', budget=ScriptBudget()
+        )
+    except ScriptBudgetExceeded:
+        log.error('The pre-reservation script exceeded its budget')
+        raise
     except SystemExit:
         return
     if errors:
@@ -8,6 +8,7 @@ from zope import schema
 from zope.security import checkPermission
 
 from seantis.reservation import _
+from seantis.reservation import search_index
 from seantis.reservation.utils import cached_property
 from seantis.reservation.form import BaseForm
 from seantis.reservation.resource import YourReservationsViewlet
@@ -97,6 +98,11 @@ class SearchForm(BaseForm, AutoExtensibleForm, YourReservationsViewlet):
     results = None
     searched = False
 
+    # the number of results shown per page, the last page loaded may
+    # add a few more
+    page_size = 100
+    next_page = None
+
     start_time = None
     end_time = None
 
@@ -111,6 +117,14 @@ class SearchForm(BaseForm, AutoExtensibleForm, YourReservationsViewlet):
     def available_actions(self):
         yield dict(name='search', title=_(u'Search'), css_class='context')
 
+    @property
+    def after(self):
+        return search_index.decode_position(self.request.get('after'))
+
+    @property
+    def next_page_key(self):
+        return search_index.encode_position(self.next_page)
+
     @property
     def enable_removal(self):
         return checkPermission('cmf.ModifyPortalContent', self.context)
@@ -162,6 +176,9 @@ class SearchForm(BaseForm, AutoExtensibleForm, YourReservationsViewlet):
         if not self.options:
             self.results = tuple()
         else:
-            self.results = self.context.scheduler().search_allocations(
+            cursor = self.context.scheduler().search_allocations_cursor(
                 **self.options
             )
+            self.results, self.next_page = cursor.page(
+                self.page_size, self.after
+            )
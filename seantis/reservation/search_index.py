@@ -0,0 +1,542 @@
+""" Keeps an index of the master allocations for the search & reserve form,
+so searches don't have to load every allocation in the searched range.
+
+Each row holds the weekday and the time of day of an allocation in its own
+timezone, together with the number of spots which are still free amongst
+the master and its mirrors. The search filters on these columns using the
+indexes of the table and only checks the remaining candidates in Python.
+
+The index is kept up to date together with the availability summary (see
+seantis.reservation.summary), as both depend on the same changes to the
+allocations and reservations of a day.
+
+"""
+
+import pytz
+import sedate
+
+from datetime import datetime, time, timedelta
+from itertools import islice
+
+from libres.db.models import ORMBase, Allocation, ReservedSlot
+from libres.db.models.types import UUID, UTCDateTime
+from sqlalchemy import Index, and_, func, not_, or_, types
+from sqlalchemy.schema import Column
+
+from seantis.reservation import free_slots
+
+epoch = datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+days_map = {
+    'mo': 0,
+    'tu': 1,
+    'we': 2,
+    'th': 3,
+    'fr': 4,
+    'sa': 5,
+    'su': 6
+}
+
+
+class AllocationSearchEntry(ORMBase):
+    """ The searchable properties of a master allocation. """
+
+    __tablename__ = 'allocation_search'
+
+    allocation = Column(types.Integer(), primary_key=True)
+    resource = Column(UUID(), nullable=False)
+
+    # the UTC date of the allocation start, as used by the summary
+    day = Column(types.Date(), nullable=False)
+
+    start = Column(UTCDateTime(timezone=False), nullable=False)
+    end = Column(UTCDateTime(timezone=False), nullable=False)
+
+    # the weekday (0 is monday) and the times in the allocation's timezone
+    weekday = Column(types.Integer(), nullable=False)
+    local_start = Column(types.Time(), nullable=False)
+    local_end = Column(types.Time(), nullable=False)
+    multiple_days = Column(types.Boolean(), nullable=False)
+
+    whole_day = Column(types.Boolean(), nullable=False)
+    partly_available = Column(types.Boolean(), nullable=False)
+    quota = Column(types.Integer(), nullable=False)
+    quota_limit = Column(types.Integer(), nullable=False)
+
+    # the number of allocations amongst the master and its mirrors which
+    # are not completely reserved (missing mirrors count as free)
+    free_spots = Column(types.Integer(), nullable=False)
+
+    __table_args__ = (
+        Index('allocation_search_range', 'resource', 'start'),
+        Index(
+            'allocation_search_times',
+            'resource', 'weekday', 'local_start', 'local_end'
+        ),
+        Index('allocation_search_days', 'resource', 'day'),
+    )
+
+
+def reserved_counts(session, allocations):
+    """ Returns the number of reserved slots of each given allocation. """
+
+    ids = [a.id for a in allocations]
+
+    if not ids:
+        return {}
+
+    query = session.query(ReservedSlot.allocation_id, func.count())
+    query = query.filter(ReservedSlot.allocation_id.in_(ids))
+    query = query.group_by(ReservedSlot.allocation_id)
+
+    return dict(query.all())
+
+
+def entries(session, allocations):
+    """ Returns the index rows of the master allocations amongst the given
+    allocations, which should include their mirrors.
+
+    """
+    allocations = list(allocations)
+    reserved = reserved_counts(session, allocations)
+
+    used = {}
+    for allocation in allocations:
+        count = reserved.get(allocation.id, 0)
+
+        if allocation.partly_available:
+            is_used = count >= allocation.count_slots()
+        else:
+            is_used = count > 0
+
+        if is_used:
+            key = (allocation.mirror_of, allocation._start)
+            used[key] = used.get(key, 0) + 1
+
+    for allocation in allocations:
+        if not allocation.is_master:
+            continue
+
+        start, end = allocation.start, allocation.end
+
+        yield AllocationSearchEntry(
+            allocation=allocation.id,
+            resource=allocation.mirror_of,
+            day=allocation._start.date(),
+            start=allocation._start,
+            end=allocation._end,
+            weekday=start.weekday(),
+            local_start=start.time(),
+            local_end=end.time(),
+            multiple_days=start.date() != end.date(),
+            whole_day=allocation.whole_day,
+            partly_available=allocation.partly_available,
+            quota=allocation.quota,
+            quota_limit=allocation.quota_limit or 0,
+            free_spots=allocation.quota - used.get(
+                (allocation.mirror_of, allocation._start), 0
+            )
+        )
+
+
+def update_days(session, resource, days, allocations):
+    """ Rebuilds the rows of the given resource and days, using the given
+    allocations of those days.
+
+    """
+    query = session.query(AllocationSearchEntry)
+    query = query.filter(AllocationSearchEntry.resource == resource)
+    query = query.filter(AllocationSearchEntry.day.in_(days))
+    query.delete(synchronize_session='fetch')
+
+    add_entries(session, allocations)
+
+
+def clear(session):
+    session.query(AllocationSearchEntry).delete()
+
+
+def add_entries(session, allocations):
+    """ Adds the rows of the given allocations, which should include the
+    mirrors of the masters.
+
+    """
+    for entry in entries(session, allocations):
+        session.add(entry)
+
+
+def encode_position(position):
+    """ Returns the given (start, id) position as text for use in urls. """
+
+    start, id = position
+    delta = start - epoch
+
+    microseconds = (
+        delta.days * 24 * 3600 + delta.seconds
+    ) * 10 ** 6 + delta.microseconds
+
+    return '{}-{}'.format(microseconds, id)
+
+
+def decode_position(text):
+    """ Returns the position encoded by encode_position or None if the text
+    is not a valid position.
+
+    """
+    if not text:
+        return None
+
+    try:
+        microseconds, id = text.split('-', 1)
+        return epoch + timedelta(microseconds=int(microseconds)), int(id)
+    except ValueError:
+        return None
+
+
+def after_position(after):
+    """ Returns the condition for the index rows after the given (start, id)
+    position.
+
+    """
+    return or_(
+        AllocationSearchEntry.start > after[0],
+        and_(
+            AllocationSearchEntry.start == after[0],
+            AllocationSearchEntry.allocation > after[1]
+        )
+    )
+
+
+class SearchCursor(object):
+    """ Iterates over the results of an allocation search, loading them
+    page by page on the start and id of the allocations. The options are
+    the same as the ones of libres' Scheduler.search_allocations.
+
+    Unlike libres, which compares the searched times of day in UTC with the
+    local times of the allocations, the searched times are compared with
+    the allocations in the timezone of the scheduler. For schedulers in UTC
+    the results are the same.
+
+    As the partly available allocations (see seantis.reservation.free_slots)
+    and the exposure of the allocations are checked in Python, a page may
+    hold fewer results than loaded rows.
+
+    Unless the search is strict, the other allocations of a group are
+    returned together with the first result of the group, so the results
+    are ordered by start within each page only. They are not returned again
+    on later pages, even if the cursor is started after a position.
+
+    """
+
+    page_size = 100
+
+    def __init__(
+        self, scheduler, start, end,
+        days=None,
+        minspots=0,
+        available_only=False,
+        whole_day='any',
+        groups='any',
+        strict=False
+    ):
+        assert start
+        assert end
+        assert whole_day in ('yes', 'no', 'any')
+        assert groups in ('yes', 'no', 'any')
+
+        self.scheduler = scheduler
+        self.session = scheduler.session
+
+        self.start, self.end = start, end
+        self.days = days and set(days_map.get(d, d) for d in days) or None
+        self.minspots = minspots
+        self.available_only = available_only
+        self.whole_day = whole_day
+        self.groups = groups
+        self.strict = strict
+
+        self.known_groups = set()
+        self.known_ids = set()
+
+        # the position of the next page, if continuing this cursor
+        self.position = None
+
+    def query(self):
+        """ Returns the index rows matching the search, as far as they can
+        be matched in the database.
+
+        """
+        start, end = self.scheduler._prepare_range(self.start, self.end)
+
+        query = self.session.query(AllocationSearchEntry)
+        query = query.filter(
+            AllocationSearchEntry.resource == self.scheduler.resource
+        )
+        query = query.filter(or_(
+            and_(
+                AllocationSearchEntry.start <= start,
+                start <= AllocationSearchEntry.end
+            ),
+            and_(
+                start <= AllocationSearchEntry.start,
+                AllocationSearchEntry.start <= end
+            )
+        ))
+
+        # the times are compared by the hour, as the searched times are
+        # aligned to the raster of each allocation later
+        first_hour = time(self.start.hour)
+        last_hour = time(self.end.hour, 59, 59, 999999)
+
+        query = query.filter(or_(
+            AllocationSearchEntry.multiple_days,
+            and_(
+                AllocationSearchEntry.local_start <= last_hour,
+                first_hour <= AllocationSearchEntry.local_end
+            )
+        ))
+
+        if self.days:
+            query = query.filter(AllocationSearchEntry.weekday.in_(self.days))
+
+        if self.whole_day != 'any':
+            query = query.filter(
+                AllocationSearchEntry.whole_day == (self.whole_day == 'yes')
+            )
+
+        if self.minspots:
+            query = query.filter(or_(
+                AllocationSearchEntry.quota_limit == 0,
+                AllocationSearchEntry.quota_limit >= self.minspots
+            ))
+            query = query.filter(
+                AllocationSearchEntry.free_spots >= self.minspots
+            )
+
+        if self.available_only:
+            query = query.filter(AllocationSearchEntry.free_spots > 0)
+
+        return query.order_by(
+            AllocationSearchEntry.start, AllocationSearchEntry.allocation
+        )
+
+    def matches(self, allocation, spots):
+        """ Checks the conditions which can't be checked by the query. The
+        spots are given for partly available allocations.
+
+        """
+
+        if not self.scheduler.is_allocation_exposed(allocation):
+            return False
+
+        # the searched times on the days of the allocation
+        timezone = allocation.start.tzname()
+
+        s = sedate.replace_timezone(datetime.combine(
+            allocation.start.date(), self.start.time()
+        ), timezone)
+        e = sedate.replace_timezone(datetime.combine(
+            allocation.end.date(), self.end.time()
+        ), timezone)
+
+        if not allocation.overlaps(s, e):
+            return False
+
+        if spots is not None:
+            if self.available_only and not spots.find_spot(s, e):
+                return False
+
+            if self.minspots:
+                required = self.minspots / float(allocation.quota) * 100.0
+
+                if required > spots.percent_free():
+                    return False
+
+        return True
+
+    def fetch(self, after=None, size=None):
+        """ Returns the results after the given (start, id) position and the
+        position of the next page (None if there are no more results).
+
+        """
+        size = size or self.page_size
+
+        query = self.query()
+
+        if after is not None:
+            query = query.filter(after_position(after))
+
+        rows = query.limit(size).all()
+
+        if len(rows) < size:
+            next_page = None
+        else:
+            next_page = (rows[-1].start, rows[-1].allocation)
+
+        results = self.matching(rows)
+
+        if after is not None and after != self.position:
+            self.add_earlier_groups(results, after)
+
+        self.position = next_page
+
+        return self.with_groups(results), next_page
+
+    def matching(self, rows):
+        """ Returns the allocations of the given index rows which match the
+        search, in the order of the rows.
+
+        """
+        if not rows:
+            return []
+
+        allocations = self.session.query(Allocation).filter(
+            Allocation.id.in_([r.allocation for r in rows])
+        )
+        allocations = dict((a.id, a) for a in allocations)
+
+        spots = free_slots.free_slots_by_allocation(self.session, (
+            a for a in allocations.values() if a.partly_available
+        ))
+
+        return [
+            allocations[r.allocation] for r in rows
+            if r.allocation in allocations and self.matches(
+                allocations[r.allocation], spots.get(r.allocation)
+            )
+        ]
+
+    def add_earlier_groups(self, allocations, after):
+        """ Marks the groups of the given allocations which had a result
+        before the given position as known, together with their allocations
+        returned on the earlier pages. Used if the cursor is started after
+        a position, which it knows nothing about otherwise.
+
+        """
+        if self.strict or self.groups == 'no':
+            return
+
+        groups = set(a.group for a in allocations) - self.known_groups
+
+        if not groups:
+            return
+
+        query = self.query().filter(not_(after_position(after)))
+        query = query.join(
+            Allocation, Allocation.id == AllocationSearchEntry.allocation
+        )
+        query = query.filter(Allocation.group.in_(groups))
+
+        earlier = set(a.group for a in self.matching(query.all()))
+
+        if not earlier:
+            return
+
+        members = self.scheduler.managed_allocations()
+        members = members.filter(Allocation.group.in_(earlier))
+
+        self.known_groups.update(earlier)
+        self.known_ids.update(
+            id for (id, ) in members.with_entities(Allocation.id)
+        )
+
+    def group_sizes(self, allocations):
+        groups = set(a.group for a in allocations)
+
+        if not groups:
+            return {}
+
+        query = self.session.query(Allocation.group, func.count())
+        query = query.filter(Allocation.resource == self.scheduler.resource)
+        query = query.filter(Allocation.group.in_(groups))
+        query = query.group_by(Allocation.group)
+
+        return dict(query.all())
+
+    def with_groups(self, allocations):
+        """ Filters the given allocations by group and adds the other
+        allocations of their groups, unless the search is strict.
+
+        """
+        if self.groups == 'any' and (self.strict or not allocations):
+            return allocations
+
+        sizes = self.group_sizes(allocations)
+        results = []
+
+        for allocation in allocations:
+
+            # returned before as part of its group
+            if allocation.id in self.known_ids:
+                continue
+
+            in_group = (
+                allocation.group in self.known_groups
+                or sizes.get(allocation.group, 0) > 1
+            )
+
+            if in_group:
+                self.known_groups.add(allocation.group)
+                self.known_ids.add(allocation.id)
+
+            if self.groups == 'yes' and not in_group:
+                continue
+            if self.groups == 'no' and in_group:
+                continue
+
+            results.append(allocation)
+
+        groups = set(a.group for a in results) & self.known_groups
+
+        if not self.strict and self.groups != 'no' and groups:
+            query = self.scheduler.managed_allocations()
+            query = query.filter(not_(Allocation.id.in_(self.known_ids)))
+            query = query.filter(Allocation.group.in_(groups))
+
+            for allocation in query.all():
+                allocation.is_extra_result = True
+                self.known_ids.add(allocation.id)
+                results.append(allocation)
+
+            results.sort(key=lambda a: a._start)
+
+        return results
+
+    def __iter__(self):
+        self.known_groups = set()
+        self.known_ids = set()
+        self.position = None
+
+        after = None
+
+        while True:
+            results, after = self.fetch(after)
+
+            for allocation in results:
+                yield allocation
+
+            if after is None:
+                break
+
+    def page(self, count, after=None):
+        """ Returns the results of the pages after the given position until
+        there are at least count results, together with the position of the
+        next page (None if there are no more results).
+
+        """
+        results = []
+
+        while True:
+            page, after = self.fetch(after)
+            results.extend(page)
+
+            if after is None or len(results) >= count:
+                return results, after
+
+    def first(self, count):
+        """ Returns the first results up to the given count and True if
+        there are more results.
+
+        """
+        results = list(islice(self, count + 1))
+        return results[:count], len(results) > count
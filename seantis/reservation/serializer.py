@@ -0,0 +1,349 @@
+""" Serializes the JSON payloads of seantis.reservation (the calendar feeds,
+the reservation data stored in the database and the JSON exports) through
+a pluggable backend.
+
+The backend is chosen in the product-config of seantis.reservation:
+
+    json-backend auto (default) | simplejson | json
+
+By default simplejson is used if it is installed with its C speedups, the
+json module of the standard library otherwise. Other backends may be added
+to the backends dictionary.
+
+Objects which are not JSON types (UUIDs, dates, sets and so on) are
+converted by the default hook given to dumps, looking up the conversion by
+type (see utils.converter). The encoders of each backend are created once
+per hook and shared by all threads.
+
+The backends can be compared through the serializer-benchmark view, which
+encodes sample payloads with each available backend.
+
+"""
+
+from logging import getLogger
+log = getLogger('seantis.reservation')
+
+import inspect
+import json
+import threading
+import time
+
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+from five import grok
+from zope.interface import Interface
+
+from seantis.reservation import utils
+from seantis.reservation.base import BaseView
+
+_backend = None  # the backend in use, chosen on first use
+
+locks = {
+    '_backend': threading.Lock()
+}
+
+
+class JsonBackend(object):
+    """ Encodes using the json module of the standard library. """
+
+    name = 'json'
+
+    def __init__(self):
+        self.module = json
+        self.encoders = {}
+        self.lock = threading.Lock()
+
+    @property
+    def accelerated(self):
+        return json.encoder.c_make_encoder is not None
+
+    def create_encoder(self, default):
+        return json.JSONEncoder(default=default)
+
+    def encoder(self, default):
+        encoder = self.encoders.get(default)
+
+        if encoder is None:
+            with self.lock:
+                encoder = self.encoders.setdefault(
+                    default, self.create_encoder(default)
+                )
+
+        return encoder
+
+    def dumps(self, value, default=None):
+        return self.encoder(default).encode(value)
+
+
+class SimplejsonBackend(JsonBackend):
+    """ Encodes using simplejson, which is faster than the json module if
+    its C speedups are available.
+
+    """
+
+    name = 'simplejson'
+
+    def __init__(self):
+        super(SimplejsonBackend, self).__init__()
+
+        import simplejson
+        self.module = simplejson
+
+    @property
+    def accelerated(self):
+        return self.module.encoder.c_make_encoder is not None
+
+    # the options which differ from the json module are turned off, so both
+    # backends return the same results
+    options = dict(
+        use_decimal=False,
+        namedtuple_as_object=False,
+        tuple_as_array=True,
+        bigint_as_string=False,
+        for_json=False,
+        iterable_as_array=False
+    )
+
+    def create_encoder(self, default):
+        # older versions of simplejson don't know all the options, which
+        # is the same as having them turned off
+        known = inspect.getargspec(self.module.JSONEncoder.__init__).args
+
+        return self.module.JSONEncoder(default=default, **dict(
+            (key, value) for key, value in self.options.items()
+            if key in known
+        ))
+
+
+# the backends by order of preference
+backends = utils.OrderedDict((
+    ('simplejson', SimplejsonBackend),
+    ('json', JsonBackend),
+))
+
+
+def available_backends():
+    """ Returns the backends which can be imported and used, by name. """
+
+    result = utils.OrderedDict()
+
+    for name, backend in backends.items():
+        try:
+            instance = backend()
+        except ImportError:
+            continue
+
+        try:
+            instance.create_encoder(None)
+        except TypeError:
+            log.exception('the {} backend cannot be used'.format(name))
+            continue
+
+        result[name] = instance
+
+    return result
+
+
+def configured_backend():
+    try:
+        return (utils.get_config('json-backend') or 'auto').strip().lower()
+    except utils.ConfigurationError:
+        return 'auto'
+
+
+def choose_backend(name):
+    available = available_backends()
+
+    if name in available:
+        return available[name]
+
+    for backend in available.values():
+        if backend.accelerated:
+            return backend
+
+    return available['json']
+
+
+def get_backend():
+    global _backend
+
+    if _backend is None:
+        with locks['_backend']:
+            if _backend is None:
+                _backend = choose_backend(configured_backend())
+
+    return _backend
+
+
+def set_backend(name=None):
+    """ Uses the backend with the given name, or the configured one if no
+    name is given.
+
+    """
+    global _backend
+
+    with locks['_backend']:
+        _backend = name and choose_backend(name) or None
+
+
+def dumps(value, default=utils.encode_uuid):
+    """ Returns the given value as JSON, converting UUIDs to strings. """
+
+    return get_backend().dumps(value, default)
+
+
+def dumps_userformdata(value):
+    """ Returns the given reservation data as JSON, in a form which is
+    restored by utils.json_loads.
+
+    """
+    if value is None:
+        return ''
+
+    return get_backend().dumps(value, utils.encode_userformdata)
+
+
+def sample_payloads(count=100):
+    """ Returns payloads resembling the ones of seantis.reservation, with the
+    given number of items each, together with the default hook they are
+    encoded with.
+
+    """
+    from seantis.reservation.export import encode_json_value
+
+    start = datetime(2015, 1, 1, 8, 0)
+    base = u'/plone/resources/room'
+
+    events = []
+    for ix in range(count):
+        event_start = start + timedelta(hours=ix)
+        group = uuid4()
+
+        events.append(dict(
+            title=u'50% Free',
+            start=event_start.isoformat(),
+            end=(event_start + timedelta(minutes=45)).isoformat(),
+            className=u'event-partly-available',
+            url=u'{}/reserve?id={}&start=1420099200&end=1420101900'.format(
+                base, ix
+            ),
+            menu={
+                u'Reservations': [
+                    dict(
+                        name=u'Reserve', target=u'overlay',
+                        url=u'{}/reserve?id={}'.format(base, ix)
+                    ),
+                    dict(
+                        name=u'Manage', target=u'inpage',
+                        url=u'{}/reservations?group={}'.format(
+                            base, group.hex
+                        )
+                    )
+                ],
+                u'Entry': [
+                    dict(
+                        name=u'Edit', target=u'overlay',
+                        url=u'{}/edit-allocation?id={}'.format(base, ix)
+                    )
+                ]
+            },
+            menuorder=[u'Reservations', u'Entry'],
+            allocation=ix,
+            partitions=[(50.0, False), (50.0, True)],
+            group=group,
+            allDay=False,
+            moveurl=u'{}/edit-allocation?id={}'.format(base, ix),
+            header=False
+        ))
+
+    data = []
+    for ix in range(count):
+        data.append({
+            u'personalien': dict(
+                desc=u'Personalien',
+                interface=u'seantis.reservation.personalien',
+                values=[
+                    dict(key=u'name', desc=u'Name', sortkey=0,
+                         value=u'M\xfcller {}'.format(ix)),
+                    dict(key=u'birthday', desc=u'Birthday', sortkey=1,
+                         value=start.date() - timedelta(days=ix)),
+                    dict(key=u'arrival', desc=u'Arrival', sortkey=2,
+                         value=start + timedelta(minutes=ix)),
+                    dict(key=u'options', desc=u'Options', sortkey=3,
+                         value=set([u'parking', u'lunch']))
+                ]
+            )
+        })
+
+    rows = []
+    for ix in range(count):
+        rows.append(utils.OrderedDict((
+            (u'Token', uuid4()),
+            (u'Title', u'Room {}'.format(ix)),
+            (u'Start', start + timedelta(hours=ix)),
+            (u'End', start + timedelta(hours=ix, minutes=45)),
+            (u'Quota', 1),
+            (u'Email', u'user{}@example.org'.format(ix)),
+            (u'Status', u'approved'),
+            (u'Comment', None)
+        )))
+
+    return utils.OrderedDict((
+        ('calendar', (events, utils.encode_uuid)),
+        ('data', (data, utils.encode_userformdata)),
+        ('export', (rows, encode_json_value)),
+    ))
+
+
+def benchmark(repetitions=10, count=100):
+    """ Encodes the sample payloads with each available backend and returns
+    the seconds spent per payload and backend.
+
+    """
+    payloads = sample_payloads(count)
+    results = utils.OrderedDict()
+
+    for name, backend in available_backends().items():
+        timings = utils.OrderedDict()
+
+        for payload, (value, default) in payloads.items():
+            started = time.time()
+
+            for ix in range(repetitions):
+                backend.dumps(value, default)
+
+            timings[payload] = time.time() - started
+
+        results[name] = dict(
+            accelerated=backend.accelerated,
+            seconds=timings
+        )
+
+    return results
+
+
+class SerializerBenchmarkView(BaseView):
+    """ Compares the available backends on the sample payloads and returns
+    the timings as JSON. Pass repetitions and count to change the number of
+    times the payloads are encoded and the number of items per payload.
+
+    """
+
+    permission = 'cmf.ManagePortal'
+
+    grok.name('serializer-benchmark')
+    grok.require(permission)
+    grok.context(Interface)
+
+    def render(self):
+        repetitions = int(self.request.get('repetitions', 10))
+        count = int(self.request.get('count', 100))
+
+        result = dict(
+            backend=get_backend().name,
+            results=benchmark(repetitions, count)
+        )
+
+        self.request.response.setHeader('Content-Type', 'application/json')
+        return json.dumps(result, sort_keys=True)
@@ -1,16 +1,30 @@
 import libres
+import sedate
 import threading
 import re
 
+from bisect import bisect_right
+from uuid import uuid4 as new_uuid
+
 from five import grok
 from plone import api
+from seantis.reservation import cache
+from seantis.reservation import instrumentation
+from seantis.reservation import pool
+from seantis.reservation import search_index
+from seantis.reservation import serializer
+from seantis.reservation import summary
 from seantis.reservation import utils
-from sqlalchemy import create_engine
+from libres.db.models import Allocation, Reservation, ReservedSlot
+from libres.modules import errors, rasterizer
+from libres.context.session import SERIALIZABLE
+from sqlalchemy import create_engine, func, inspect
+from sqlalchemy.orm import scoped_session, sessionmaker
 from zope.component import getUtility
 from zope.event import notify
 from zope.interface import implements
 from zope.interface import Interface
-from zope.sqlalchemy import ZopeTransactionExtension
+from zope.sqlalchemy import ZopeTransactionExtension, mark_changed
 
 from seantis.reservation.events import (
     ReservationsApprovedEvent,
@@ -21,24 +35,32 @@ from seantis.reservation.events import (
 )
 
 
-def get_postgres_version(dsn):
+def get_postgres_version(engine):
     """ Returns the postgres version in a tuple with the first value being
     the major version, the second being the minor version.
 
-    Uses it's own connection to be independent from any session.
+    Uses it's own connection to be independent from any session. The
+    connection is taken from the pool of the given engine.
 
     """
-    assert 'postgres' in dsn, "Not a postgres database"
+    assert 'postgres' in engine.dialect.name, "Not a postgres database"
+
+    connection = engine.connect()
 
-    engine = create_engine(dsn)
-    version = engine.execute('select version()').fetchone()[0]
-    engine.dispose()
+    try:
+        version = connection.execute('select version()').fetchone()[0]
+    finally:
+        connection.close()
 
     version = re.findall('PostgreSQL (.*?) on', version)[0]
     return map(int, version.split('.'))[:2]
 
 
 def assert_dsn(dsn):
+    """ Ensures that the given dsn is supported. The version of the database
+    is checked by the SessionProvider, once its engine is ready.
+
+    """
     assert dsn, "Database connection not found (database.cfg)"
 
     if 'test://' in dsn:
@@ -47,12 +69,46 @@ def assert_dsn(dsn):
     assert 'postgresql+psycopg2' in dsn, \
         "Only PostgreSQL combined with psycopg2 is supported"
 
-    major, minor = get_postgres_version(dsn)
+    return dsn
 
-    assert (major >= 9 and minor >= 1) or (major >= 10), \
-        "PostgreSQL 9.1+ is required. Your version is %i.%i" % (major, minor)
 
-    return dsn
+class SessionProvider(libres.context.session.SessionProvider):
+    """ Provides libres with sessions bound to an engine with a configurable
+    and metered connection pool (see seantis.reservation.pool). If turned
+    on, the statements of the engine are instrumented as well (see
+    seantis.reservation.instrumentation).
+
+    Unlike the SessionProvider of libres, the version of the database is
+    checked with a connection of that pool, instead of a separate engine.
+
+    """
+
+    def __init__(
+        self, dsn, site_id, pool_config={}, engine_config={},
+        session_config={}
+    ):
+        self.dsn = dsn
+
+        config = dict(engine_config)
+        config.update(pool_config)
+
+        self.engine = create_engine(
+            dsn, poolclass=pool.MeteredQueuePool,
+            isolation_level=SERIALIZABLE,
+            **config
+        )
+
+        pool.observe(self.engine, site_id)
+        instrumentation.instrument(self.engine)
+
+        self.assert_valid_postgres_version(dsn)
+
+        self.session = scoped_session(sessionmaker(
+            bind=self.engine, **session_config
+        ))
+
+    def get_postgres_version(self, dsn):
+        return get_postgres_version(self.engine)
 
 
 class ILibresUtility(Interface):
@@ -86,6 +142,9 @@ class CustomScheduler(libres.db.scheduler.Scheduler):
 
     """
 
+    # the number of allocations passed to a single executemany call
+    allocation_batch_size = 1000
+
     def revoke_reservation(self, token, reason, id=None, send_email=True):
         """ Revoke a reservation and inform the user of that."""
 
@@ -101,6 +160,276 @@ class CustomScheduler(libres.db.scheduler.Scheduler):
 
         self.remove_reservation(token, id)
 
+    def allocate(
+        self,
+        dates,
+        partly_available=False,
+        raster=rasterizer.MIN_RASTER,
+        whole_day=False,
+        quota=None,
+        quota_limit=0,
+        grouped=False,
+        data=None,
+        approve_manually=False,
+        progress=None
+    ):
+        """ Works like libres' allocate, but scales to long recurrences.
+
+        Overlaps between the dates are found by sorting them. Overlaps with
+        existing allocations are found with a single query, instead of one
+        query per date. The allocations are written in batches, each
+        one a single insert statement executed with all the rows of the
+        batch (executemany), instead of adding them through the ORM.
+
+        If given, progress is called with the number of allocations written
+        and the total number of allocations after each batch.
+
+        """
+        dates = self._prepare_dates(dates)
+
+        group = new_uuid()
+        quota = quota or 1
+
+        if partly_available and grouped:
+            raise errors.InvalidAllocationError
+
+        if whole_day:
+            for ix, (start, end) in enumerate(dates):
+                dates[ix] = sedate.align_range_to_day(
+                    start, end, self.timezone
+                )
+
+        if not dates:
+            return []
+
+        rasterized_dates = [
+            rasterizer.rasterize_span(s, e, raster) for s, e in dates
+        ]
+
+        # ensure that the list of dates contains no overlaps inside
+        latest_end = None
+
+        for start, end in sorted(rasterized_dates):
+            if end < start:
+                raise errors.InvalidAllocationError
+
+            if latest_end is not None and start <= latest_end:
+                raise errors.InvalidAllocationError
+
+            latest_end = end if latest_end is None else max(end, latest_end)
+
+        # make sure that the dates do not overlap existing masters, which
+        # do not overlap each other and are therefore sorted by end as well
+        first_start = min(s for s, e in rasterized_dates)
+
+        existing = self.allocations_in_range(first_start, latest_end)
+        existing = existing.with_entities(
+            Allocation.id, Allocation._start, Allocation._end
+        )
+        existing = existing.order_by(Allocation._start).all()
+
+        existing_starts = [start for id, start, end in existing]
+
+        for start, end in rasterized_dates:
+            ix = bisect_right(existing_starts, end) - 1
+
+            if ix >= 0 and start <= existing[ix][2]:
+                raise errors.OverlappingAllocationError(
+                    start, end, self.allocation_by_id(existing[ix][0])
+                )
+
+        # write the master allocations
+        columns = [
+            (prop.key, prop.columns[0].name)
+            for prop in inspect(Allocation).column_attrs
+            if prop.key != 'id'
+        ]
+
+        def record(start, end):
+            allocation = Allocation()
+            allocation.raster = raster
+            allocation.start = start
+            allocation.end = end
+            allocation.timezone = self.timezone
+            allocation.resource = self.resource
+            allocation.mirror_of = self.resource
+            allocation.quota = quota
+            allocation.quota_limit = quota_limit
+            allocation.partly_available = partly_available
+            allocation.approve_manually = approve_manually
+            allocation.data = data
+            allocation.group = grouped and group or new_uuid()
+
+            # omitted values are filled by the column defaults
+            return dict(
+                (name, getattr(allocation, key)) for key, name in columns
+                if getattr(allocation, key) is not None
+            )
+
+        insert = Allocation.__table__.insert()
+        total = len(dates)
+
+        for offset in range(0, total, self.allocation_batch_size):
+            batch = dates[offset:offset + self.allocation_batch_size]
+            self.session.execute(insert, [record(s, e) for s, e in batch])
+
+            if progress:
+                progress(offset + len(batch), total)
+
+        # the session doesn't know about the inserts otherwise
+        mark_changed(self.session)
+
+        # load the written allocations in the order of the dates
+        existing_ids = set(id for id, start, end in existing)
+
+        written = dict(
+            (a._start, a)
+            for a in self.allocations_in_range(first_start, latest_end)
+            if a.id not in existing_ids
+        )
+
+        allocations = [written[start] for start, end in rasterized_dates]
+
+        libres.modules.events.on_allocations_added(self.context, allocations)
+
+        return allocations
+
+    def move_allocation(self, master_id, *args, **kwargs):
+        cache.invalidate_feeds([self.resource])
+
+        # the days before and after the move are affected
+        master = self.allocation_by_id(master_id)
+        summary.mark_allocations([master])
+
+        result = super(CustomScheduler, self).move_allocation(
+            master_id, *args, **kwargs
+        )
+
+        summary.mark_allocations([master])
+
+        return result
+
+    def remove_allocation(self, id=None, groups=None):
+        cache.invalidate_feeds([self.resource])
+
+        if id:
+            summary.mark_allocations([self.allocation_by_id(id)])
+        elif groups:
+            summary.mark_days(summary.allocation_days(
+                self.allocations_by_groups(groups, masters_only=False)
+            ))
+
+        return super(CustomScheduler, self).remove_allocation(id, groups)
+
+    def remove_unused_allocations(self, start, end):
+        cache.invalidate_feeds([self.resource])
+
+        # mark all days in the range, unused or not
+        prepared_start, prepared_end = self._prepare_range(
+            sedate.as_datetime(start), sedate.as_datetime(end)
+        )
+        query = self.managed_allocations()
+        query = query.filter(prepared_start <= Allocation._start)
+        query = query.filter(Allocation._end <= prepared_end)
+        summary.mark_days(summary.allocation_days(query))
+
+        return super(CustomScheduler, self).remove_unused_allocations(
+            start, end
+        )
+
+    def remove_reservation(self, token, id=None):
+        # the affected resources and days are only known before the removal
+        reservations = self.reservations_by_token(token, id)
+        cache.invalidate_feeds(set(r.resource for r in reservations))
+        summary.mark_days(summary.reservation_days(self.session, [token]))
+
+        return super(CustomScheduler, self).remove_reservation(token, id)
+
+    def search_allocations_cursor(self, start, end, **options):
+        """ Searches the allocations like search_allocations, but uses the
+        search index and returns a cursor which loads the results page by
+        page (see seantis.reservation.search_index).
+
+        """
+        summary.update_pending_days(self.session)
+
+        return search_index.SearchCursor(self, start, end, **options)
+
+    def allocation_availabilities(self, allocations):
+        """ Returns a dictionary with the id of each given allocation as key
+        and a tuple of availability and waitinglist length as value.
+
+        The result is the same as calling availability(start, end) and
+        allocation.waitinglist_length for each allocation, but it is
+        gathered with two aggregate queries instead of two queries per
+        allocation.
+
+        The allocations are expected to be exposed already, as the
+        availability is computed from the master and mirrors sharing the
+        same start date. They may belong to other resources than the one
+        of the scheduler, as used by the compare-slots feed.
+
+        """
+
+        allocations = [a for a in allocations if a.id is not None]
+
+        if not allocations:
+            return {}
+
+        # the number of reserved slots per resource and allocation start,
+        # summed up over the master and all existing mirrors
+        query = self.session.query(
+            Allocation.mirror_of, Allocation._start,
+            func.count(ReservedSlot.start)
+        )
+        query = query.join(
+            ReservedSlot, ReservedSlot.allocation_id == Allocation.id
+        )
+        query = query.filter(
+            Allocation.mirror_of.in_(set(a.mirror_of for a in allocations))
+        )
+        query = query.filter(
+            Allocation._start >= min(a._start for a in allocations)
+        )
+        query = query.filter(
+            Allocation._start <= max(a._start for a in allocations)
+        )
+        query = query.group_by(Allocation.mirror_of, Allocation._start)
+
+        reserved = dict(
+            ((resource, start), count) for resource, start, count in query
+        )
+
+        # the number of pending reservations per group
+        query = self.session.query(Reservation.target, func.count())
+        query = query.filter(
+            Reservation.target.in_(set(a.group for a in allocations))
+        )
+        query = query.filter(Reservation.status == u'pending')
+        query = query.group_by(Reservation.target)
+
+        waiting = dict(query.all())
+
+        result = {}
+
+        for allocation in allocations:
+
+            # missing mirrors count as completely free, which is why the
+            # availability can be derived from the master's slot count
+            total = allocation.count_slots() * allocation.quota
+            used = reserved.get((allocation.mirror_of, allocation._start), 0)
+
+            if not total:
+                availability = 0.0
+            else:
+                availability = 100.0 - (float(used) / float(total) * 100.0)
+
+            result[allocation.id] = (
+                availability, waiting.get(allocation.group, 0)
+            )
+
+        return result
+
     def change_reservation_time(
         self, token, id, new_start, new_end, send_email=True, reason=None
     ):
@@ -182,13 +511,17 @@ class LibresUtility(grok.GlobalUtility):
             raise utils.ConfigurationError('No database configuration found.')
 
     def session_provider(self, context):
-        return libres.context.session.SessionProvider(
+        site_id = context.get_setting('site_id')
+
+        return SessionProvider(
             context.get_setting('dsn'),
+            site_id,
+            pool_config=pool.pool_config(site_id),
             session_config={
                 'extension': ZopeTransactionExtension()
             },
             engine_config={
-                'json_serializer': utils.json_dumps,
+                'json_serializer': serializer.dumps_userformdata,
                 'json_deserializer': utils.json_loads
             }
         )
@@ -201,6 +534,12 @@ class LibresUtility(grok.GlobalUtility):
             return name
         return uuid_generator
 
+    def exposure_factory(self, context):
+        # the context is shared by all threads, the exposure is bound to
+        # the request of the current thread
+        from seantis.reservation import exposure
+        return exposure.for_request()
+
     @property
     def context(self):
         site = api.portal.get()
@@ -210,7 +549,9 @@ class LibresUtility(grok.GlobalUtility):
             context = libres.registry.register_context(context_id)
             context.set_service('session_provider', self.session_provider)
             context.set_setting('dsn', self.get_dsn(site))
+            context.set_setting('site_id', self.get_site_id(site))
             context.set_service('uuid_generator', self.uuid_generator_factory)
+            context.set_service('exposure', self.exposure_factory)
         else:
             context = libres.registry.get_context(context_id)
 
@@ -219,13 +560,16 @@ class LibresUtility(grok.GlobalUtility):
     def scheduler(self, name, timezone):
         return CustomScheduler(self.context, name, timezone)
 
+    def get_site_id(self, site):
+        return site and site.id or '__no_site__'
+
     def get_dsn(self, site):
         """ Returns the DSN for the given site. Will look for those dsns
         in the zope.conf which is preferrably modified using buildout's
         <product-config> construct. See database.cfg.example for more info.
 
         """
-        site_id = site and site.id or '__no_site__'
+        site_id = self.get_site_id(site)
 
         if site_id not in self._dsn_cache:
             specific = utils.get_config('dsn-%s' % site_id)
@@ -0,0 +1,407 @@
+""" Keeps a per-day summary of the availability of each resource, so the
+overview does not have to load all allocations of all listed resources each
+time it is shown.
+
+Each row holds the sum of the availabilities of the allocations of one
+resource starting on one day, together with the number of allocations and
+the number of allocations expected from the quota of the masters. This is
+what libres' availability_by_allocations needs to compute the availability
+of a day, so the rows of several resources can be combined into the same
+result as the live computation.
+
+The day is the UTC date of the allocation start, which is how the overview
+groups allocations. As timeframes are checked against the date in the
+timezone of the allocation, that date is kept as well.
+
+Rows are marked as outdated when allocations or reservations change and
+updated before they are read or when the transaction is committed. The
+search index of the allocations (see seantis.reservation.search_index) is
+updated together with the summary.
+
+"""
+
+from logging import getLogger
+log = getLogger('seantis.reservation')
+
+import isodate
+import pytz
+import threading
+import transaction
+
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from five import grok
+from libres.db.models import ORMBase, Allocation, ReservedSlot
+from libres.db.models.types import UUID
+from sqlalchemy import and_, or_, types
+from sqlalchemy.schema import Column
+from zope.interface import Interface
+
+from seantis.reservation import search_index
+from seantis.reservation import utils
+from seantis.reservation.base import BaseView
+
+
+class AvailabilitySummary(ORMBase):
+    """ The availability of a resource on a single day. """
+
+    __tablename__ = 'availability_summaries'
+
+    resource = Column(UUID(), primary_key=True)
+
+    # the UTC date of the allocation start
+    day = Column(types.Date(), primary_key=True)
+
+    # the date of the allocation start in the allocation's timezone
+    local_day = Column(types.Date(), primary_key=True)
+
+    # the sum of the availability of all allocations (masters and mirrors)
+    total = Column(types.Float(), nullable=False)
+
+    # the number of allocations (masters and mirrors)
+    allocations = Column(types.Integer(), nullable=False)
+
+    # the number of allocations expected by the quota of the masters
+    expected = Column(types.Integer(), nullable=False)
+
+
+_pending = threading.local()
+
+
+def pending_days():
+    """ Returns the set of (resource, day) tuples marked as outdated during
+    the current transaction.
+
+    """
+    current = transaction.get()
+
+    if getattr(_pending, 'transaction', None) is not current:
+        _pending.transaction = current
+        _pending.days = set()
+
+        current.addBeforeCommitHook(update_pending_days)
+
+    return _pending.days
+
+
+def mark_days(days):
+    """ Marks the given (resource, day) tuples as outdated. """
+    pending_days().update(
+        (utils.string_uuid(resource), day) for resource, day in days
+    )
+
+
+def mark_allocations(allocations):
+    mark_days((a.mirror_of, a._start.date()) for a in allocations)
+
+
+def allocation_days(query):
+    """ Returns the (resource, day) tuples of the allocations in the given
+    query.
+
+    """
+    query = query.with_entities(Allocation.mirror_of, Allocation._start)
+    return set((resource, start.date()) for resource, start in query)
+
+
+def reservation_days(session, tokens):
+    """ Returns the (resource, day) tuples of the allocations holding slots
+    of the reservations with the given tokens.
+
+    """
+    query = session.query(Allocation).join(
+        ReservedSlot, ReservedSlot.allocation_id == Allocation.id
+    )
+    query = query.filter(ReservedSlot.reservation_token.in_(tokens))
+
+    return allocation_days(query)
+
+
+def update_pending_days(session=None):
+    """ Updates the rows marked as outdated during the current transaction.
+
+    """
+    days = pending_days()
+
+    if not days:
+        return
+
+    if session is None:
+        from seantis.reservation.session import Session
+        session = Session()
+
+    update_days(session, days)
+    days.clear()
+
+
+def update_days(session, days):
+    """ Rebuilds the rows of the given (resource, day) tuples. """
+
+    by_resource = defaultdict(set)
+    for resource, day in days:
+        by_resource[resource].add(day)
+
+    for resource, days in by_resource.items():
+        query = session.query(AvailabilitySummary)
+        query = query.filter(AvailabilitySummary.resource == resource)
+        query = query.filter(AvailabilitySummary.day.in_(days))
+        query.delete(synchronize_session='fetch')
+
+        query = session.query(Allocation)
+        query = query.filter(Allocation.mirror_of == resource)
+        query = query.filter(or_(*(
+            and_(
+                day_start(day) <= Allocation._start,
+                Allocation._start < day_start(day + timedelta(days=1))
+            ) for day in days
+        )))
+
+        allocations = query.all()
+
+        for row in summarize(allocations):
+            session.add(row)
+
+        search_index.update_days(session, resource, days, allocations)
+
+    session.flush()
+
+
+def day_start(day):
+    return datetime(day.year, day.month, day.day, tzinfo=pytz.utc)
+
+
+def summarize(allocations):
+    """ Returns the summary rows of the given allocations. """
+
+    rows = {}
+
+    for allocation in allocations:
+        key = (
+            utils.real_uuid(allocation.mirror_of),
+            allocation._start.date(),
+            allocation.start.date()
+        )
+
+        if key not in rows:
+            rows[key] = AvailabilitySummary(
+                resource=key[0], day=key[1], local_day=key[2],
+                total=0.0, allocations=0, expected=0
+            )
+
+        row = rows[key]
+        row.total += allocation.availability
+        row.allocations += 1
+
+        if allocation.is_master:
+            row.expected += allocation.quota
+
+    return rows.values()
+
+
+def availability_by_day(session, start, end, resources, is_exposed):
+    """ Returns the same result as libres' availability_by_day, read from
+    the summary table. is_exposed is called with the resource uuid and the
+    local day of each row (see exposure.for_days).
+
+    Unlike the live computation, which includes allocations overlapping
+    the start of the range, the days are selected by the start date alone.
+
+    """
+    update_pending_days(session)
+
+    query = session.query(
+        AvailabilitySummary.resource,
+        AvailabilitySummary.day,
+        AvailabilitySummary.local_day,
+        AvailabilitySummary.total,
+        AvailabilitySummary.allocations,
+        AvailabilitySummary.expected
+    )
+    query = query.filter(AvailabilitySummary.resource.in_(resources))
+    query = query.filter(AvailabilitySummary.day >= start.date())
+    query = query.filter(AvailabilitySummary.day <= end.date())
+
+    totals = {}
+
+    for resource, day, local_day, total, allocations, expected in query:
+        if not is_exposed(resource, local_day):
+            continue
+
+        if day not in totals:
+            totals[day] = [0.0, 0, 0, set()]
+
+        totals[day][0] += total
+        totals[day][1] += allocations
+        totals[day][2] += expected
+        totals[day][3].add(resource)
+
+    days = {}
+
+    for day, (total, count, expected, members) in totals.items():
+        if not expected:
+            availability = 0
+        else:
+            availability = (total + (expected - count) * 100) / expected
+
+        days[day] = (availability, members)
+
+    return days
+
+
+def rebuild(session):
+    """ Rebuilds the whole summary table and the search index, one resource
+    at a time. Returns the number of summary rows written.
+
+    """
+    session.query(AvailabilitySummary).delete()
+    search_index.clear(session)
+
+    resources = session.query(Allocation.mirror_of).distinct()
+    count = 0
+
+    for (resource, ) in resources.all():
+        query = session.query(Allocation)
+        query = query.filter(Allocation.mirror_of == resource)
+
+        allocations = query.all()
+
+        for row in summarize(allocations):
+            session.add(row)
+            count += 1
+
+        search_index.add_entries(session, allocations)
+
+        session.flush()
+
+    return count
+
+
+def check(session, start=None, end=None):
+    """ Compares the summary with the live computation from the allocations
+    and returns a list of differences. Each difference is a tuple of the
+    (resource, day, local_day) key, the expected values and the stored
+    values (total, allocations, expected). Missing rows are None.
+
+    """
+    update_pending_days(session)
+
+    allocations = session.query(Allocation)
+    rows = session.query(AvailabilitySummary)
+
+    if start:
+        allocations = allocations.filter(day_start(start) <= Allocation._start)
+        rows = rows.filter(start <= AvailabilitySummary.day)
+
+    if end:
+        allocations = allocations.filter(
+            Allocation._start < day_start(end + timedelta(days=1))
+        )
+        rows = rows.filter(AvailabilitySummary.day <= end)
+
+    values = lambda r: (round(r.total, 6), r.allocations, r.expected)
+    key = lambda r: (r.resource, r.day, r.local_day)
+
+    expected = dict((key(r), values(r)) for r in summarize(allocations))
+    stored = dict((key(r), values(r)) for r in rows)
+
+    differences = []
+
+    for k in sorted(set(expected) | set(stored)):
+        if expected.get(k) != stored.get(k):
+            differences.append((k, expected.get(k), stored.get(k)))
+
+    return differences
+
+
+def on_allocations_added(context, allocations):
+    mark_allocations(allocations)
+
+
+def on_reservations_approved(context, reservations):
+    from seantis.reservation.session import Session
+    mark_days(reservation_days(Session(), set(r.token for r in reservations)))
+
+
+def on_reservation_time_changed(context, reservation, *args, **kwargs):
+    from seantis.reservation.session import Session
+    mark_days(reservation_days(Session(), [reservation.token]))
+
+
+def setup_libres_events():
+    """ Removed allocations and reservations are handled by the
+    CustomScheduler, as the affected days need to be known before the
+    records are deleted.
+
+    """
+    from libres.modules import events
+
+    subscribers = (
+        ('on_allocations_added', on_allocations_added),
+        ('on_reservations_approved', on_reservations_approved),
+        ('on_reservation_time_changed', on_reservation_time_changed),
+    )
+
+    for event, subscriber in subscribers:
+        libres_event = getattr(events, event)
+
+        if subscriber not in libres_event:
+            libres_event.append(subscriber)
+
+setup_libres_events()
+
+
+class SummaryView(BaseView):
+
+    permission = 'cmf.ManagePortal'
+
+    grok.baseclass()
+    grok.require(permission)
+    grok.context(Interface)
+
+    @property
+    def session(self):
+        from seantis.reservation.session import Session
+        return Session()
+
+    def parse_date(self, name):
+        value = self.request.get(name)
+        return value and isodate.parse_date(value) or None
+
+
+class RebuildSummaryView(SummaryView):
+    """ Rebuilds the availability summary of the site's database. """
+
+    grok.name('rebuild-availability-summary')
+
+    def render(self):
+        count = rebuild(self.session)
+        log.info('rebuilt the availability summary with %i rows' % count)
+
+        return "rebuilt the availability summary with %i rows" % count
+
+
+class CheckSummaryView(SummaryView):
+    """ Compares the availability summary with the live computation. The
+    range may be limited using the start and end parameters (yyyy-mm-dd).
+
+    """
+
+    grok.name('check-availability-summary')
+
+    def render(self):
+        differences = check(
+            self.session, self.parse_date('start'), self.parse_date('end')
+        )
+
+        if not differences:
+            return "the availability summary is consistent"
+
+        lines = ["found %i differences" % len(differences)]
+        lines.extend(
+            "%s %s %s: expected %s, found %s" % (
+                utils.string_uuid(key[0]), key[1], key[2], expected, stored
+            ) for key, expected, stored in differences
+        )
+
+        return '\n'.join(lines)
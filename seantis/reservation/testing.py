@@ -34,7 +34,12 @@ class SqlLayer(PloneSandboxLayer):
         if not hasattr(config, 'product_config'):
             config.product_config = {}
 
-        config.product_config['seantis.reservation'] = dict(dsn=dsn)
+        # the mail outbox is flushed by the tests that need it
+        config.product_config['seantis.reservation'] = {
+            'dsn': dsn,
+            'mail-workers': '0',
+            'maintenance-thread': 'off'
+        }
 
         setConfiguration(config)
 
@@ -25,7 +25,14 @@ from seantis.reservation.utils import getSite
 from seantis.reservation.session import ILibresUtility
 from seantis.reservation.testing import SQL_INTEGRATION_TESTING
 from seantis.reservation.testing import SQL_FUNCTIONAL_TESTING
+from seantis.reservation import cache
+from seantis.reservation import export_jobs
+from seantis.reservation import pool
+from seantis.reservation import throttle
+from seantis.reservation import instrumentation
 from seantis.reservation import maintenance
+from seantis.reservation import restricted_eval
+from seantis.reservation import serializer
 
 from Products.CMFCore.utils import getToolByName
 
@@ -96,7 +103,18 @@ class TestCase(unittest.TestCase):
             aq_base(self._original_MailHost), provided=IMailHost
         )
 
-        maintenance.clear_clockservers()
+        maintenance.stop_runner()
+        instrumentation.clear_stats()
+        cache.feeds.clear()
+        cache.timeframe_indexes.clear()
+        cache.manager_emails.clear()
+        cache.email_templates.clear()
+        cache.pre_reserve_scripts.clear()
+        restricted_eval.clear_compiled()
+        serializer.set_backend()
+        export_jobs.clear_jobs()
+        pool.clear_metrics()
+        throttle.clear_backends()
 
         # since the testbrowser may create different records we need
         # to clear the database by hand each time
@@ -105,6 +123,10 @@ class TestCase(unittest.TestCase):
         outlaw.execute('DELETE FROM reservations')
         outlaw.execute('DELETE FROM reserved_slots')
         outlaw.execute('DELETE FROM allocations')
+        outlaw.execute('DELETE FROM availability_summaries')
+        outlaw.execute('DELETE FROM allocation_search')
+        outlaw.execute('DELETE FROM throttle_entries')
+        outlaw.execute('DELETE FROM mail_outbox')
         outlaw.dispose()
 
         self.logout()
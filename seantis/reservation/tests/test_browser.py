@@ -268,6 +268,55 @@ class TestBrowser(FunctionalTestCase):
         self.assertTrue('testfolder - one' in browser.contents)
         self.assertTrue('testfolder - two' in browser.contents)
 
+    def test_compare_slots(self):
+
+        self.add_resource('one')
+        self.add_resource('two')
+        self.add_resource('three')
+
+        start = datetime(2014, 8, 20, 15, 00)
+        end = datetime(2014, 8, 20, 16, 00)
+
+        self.add_allocation('one', start, end)
+        self.add_allocation('two', start, end)
+        self.add_allocation('two', start + timedelta(days=1),
+                            end + timedelta(days=1))
+
+        browser = self.admin_browser
+
+        uuids = {}
+        for name in ('one', 'two', 'three'):
+            browser.open(self.infolder('/%s/@@uuid' % name))
+            uuids[name] = browser.contents
+
+        browser.open(self.infolder('/two?compare_to=%s&compare_to=%s' % (
+            uuids['one'], uuids['three']
+        )))
+        self.assertIn('compare-slots?compare_to=', browser.contents)
+
+        s = utils.utctimestamp(start - timedelta(days=1))
+        e = utils.utctimestamp(end + timedelta(days=2))
+
+        browser.open(self.infolder(
+            '/two/compare-slots?compare_to=%s&compare_to=%s'
+            '&start=%s&end=%s' % (uuids['one'], uuids['three'], s, e)
+        ))
+        events = json.loads(browser.contents.replace('\n', ''))
+
+        self.assertEqual(sorted(events.keys()), sorted(uuids.values()))
+        self.assertEqual(len(events[uuids['one']]), 1)
+        self.assertEqual(len(events[uuids['two']]), 2)
+        self.assertEqual(len(events[uuids['three']]), 0)
+
+        # the events are the same as the ones of the single feeds
+        by_start = lambda events: sorted(events, key=lambda e: e['start'])
+
+        for name in ('one', 'two'):
+            slots = self.load_slot_data(
+                name, start - timedelta(days=1), end + timedelta(days=2)
+            )
+            self.assertEqual(by_start(events[uuids[name]]), by_start(slots))
+
     def test_resource_properties(self):
 
         browser = self.new_browser()
@@ -0,0 +1,75 @@
+import transaction
+
+from seantis.reservation.cache import TaggedCache, invalidate_after_commit
+from seantis.reservation.tests import IntegrationTestCase
+
+
+class TestCache(IntegrationTestCase):
+
+    def test_tagged_cache(self):
+        cache = TaggedCache(max_age=60, max_entries=2)
+
+        generation = cache.generation(['a'])
+        self.assertTrue(cache.set('one', ['a'], 1, generation))
+        self.assertEqual(cache.get('one'), 1)
+
+        generation = cache.generation(['a', 'b'])
+        self.assertTrue(cache.set('two', ['a', 'b'], 2, generation))
+
+        cache.invalidate(['b'])
+        self.assertEqual(cache.get('one'), 1)
+        self.assertEqual(cache.get('two'), None)
+
+        # values computed during an invalidation are not stored
+        generation = cache.generation(['b'])
+        cache.invalidate(['b'])
+        self.assertFalse(cache.set('two', ['b'], 2, generation))
+        self.assertEqual(cache.get('two'), None)
+
+        # the oldest entry is dropped once the cache is full
+        cache.set('two', ['b'], 2, cache.generation(['b']))
+        cache.set('three', ['c'], 3, cache.generation(['c']))
+        self.assertEqual(cache.get('one'), None)
+        self.assertEqual(cache.get('three'), 3)
+
+        # the tags no longer reference the removed entries
+        self.assertEqual(dict(cache.keys_by_tag), {
+            'b': set(['two']), 'c': set(['three'])
+        })
+
+        generation = cache.generation(['c'])
+        cache.invalidate_all()
+        self.assertEqual(cache.get('three'), None)
+        self.assertFalse(cache.set('three', ['c'], 3, generation))
+
+    def test_tagged_cache_max_age(self):
+        cache = TaggedCache(max_age=-1, max_entries=10)
+
+        computed = []
+        compute = lambda: computed.append(1) or len(computed)
+
+        self.assertEqual(cache.cached('key', ['a'], compute), 1)
+        self.assertEqual(cache.cached('key', ['a'], compute), 2)
+
+    def test_invalidate_after_commit(self):
+        cache = TaggedCache(max_age=60, max_entries=10)
+
+        cache.set('one', ['a'], 1, cache.generation(['a']))
+        cache.set('two', ['b'], 2, cache.generation(['b']))
+
+        invalidate_after_commit(cache, ['a'])
+        self.assertEqual(cache.get('one'), None)
+        self.assertEqual(cache.get('two'), 2)
+
+        # values stored before the commit are invalidated again after it
+        cache.set('one', ['a'], 1, cache.generation(['a']))
+
+        hooks = list(transaction.get().getAfterCommitHooks())
+        hook, args, kwargs = hooks[-1]
+        hook(True, *args, **kwargs)
+
+        self.assertEqual(cache.get('one'), None)
+        self.assertEqual(cache.get('two'), 2)
+
+        invalidate_after_commit(cache)
+        self.assertEqual(cache.get('two'), None)
@@ -1,13 +1,20 @@
 # -*- coding: utf-8 -*-
+import json
+
 from datetime import datetime
 
 from Acquisition import aq_base
 
+from plone import api
 from pytz import timezone
 from seantis.reservation.tests import IntegrationTestCase
 from seantis.reservation import utils
 from seantis.reservation import exports
-from seantis.reservation.export import ExportView, prepare_record
+from seantis.reservation import export_jobs
+from seantis.reservation.export import (
+    ExportView, CsvExportView, JsonExportView, ExportDownloadView,
+    ExportJobView, prepare_record
+)
 
 
 class TestExports(IntegrationTestCase):
@@ -205,3 +212,193 @@ class TestExports(IntegrationTestCase):
         self.assertEqual(
             response.headers['content-type'], 'application/json;charset=utf-8'
         )
+
+    def test_streamed_export(self):
+        self.login_manager()
+
+        resource = self.create_resource()
+        sc = resource.scheduler()
+
+        dates = (datetime(2012, 2, 1, 12, 0), datetime(2012, 2, 1, 16, 0))
+        sc.allocate(dates, approve_manually=False, quota=2)
+
+        token = sc.reserve(
+            u'a@example.com', dates,
+            data=utils.mock_data_dictionary({'stop': u'hammertime!'})
+        )
+
+        request = self.request()
+        request['source'] = 'reservations'
+        request['uuid'] = resource.uuid()
+
+        output = ''.join(JsonExportView(self.portal, request).render())
+        records = json.loads(output)
+
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['Token'], utils.string_uuid(token))
+        self.assertEqual(records[0]['Mocktest.stop'], u'hammertime!')
+        self.assertTrue(records[0]['Start'].startswith(u'2012-02-01T'))
+
+        self.assertEqual(
+            request.RESPONSE.headers['content-length'], str(len(output))
+        )
+
+        output = ''.join(CsvExportView(self.portal, request).render())
+        lines = output.splitlines()
+
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].endswith('Mocktest.stop'))
+        self.assertTrue(lines[1].endswith('hammertime!'))
+
+    def test_discover_headers(self):
+        self.login_manager()
+
+        resource = self.create_resource()
+        sc = resource.scheduler()
+
+        dates = (datetime(2012, 2, 1, 12, 0), datetime(2012, 2, 1, 16, 0))
+        sc.allocate(dates, approve_manually=False, quota=3)
+
+        sc.reserve(u'a@example.com', dates, data=utils.mock_data_dictionary(
+            {'stop': u'hammertime!', 'bust': u'a move!'}
+        ))
+        sc.reserve(u'b@example.com', dates, data=utils.mock_data_dictionary(
+            {'never': u'gonna', 'stop': u'give you up'}
+        ))
+        sc.reserve(u'c@example.com', dates)
+
+        resources = {resource.uuid(): resource}
+        reservations = exports.reservations.fetch_records(
+            resources, 'all', 'all'
+        )
+
+        headers = exports.reservations.discover_headers(
+            resources, 'all', 'all'
+        )
+
+        self.assertEqual(len(headers), 3)
+        self.assertEqual(
+            headers, exports.reservations.additional_headers(reservations)
+        )
+        self.assertEqual(
+            exports.reservations.discover_headers(resources, '2010', 'all'),
+            []
+        )
+
+    def test_discover_headers_forms(self):
+        self.login_manager()
+
+        resource = self.create_resource()
+        sc = resource.scheduler()
+
+        dates = (datetime(2012, 2, 1, 12, 0), datetime(2012, 2, 1, 16, 0))
+        sc.allocate(dates, approve_manually=False)
+
+        data = utils.mock_data_dictionary(
+            {'name': u'Ted'}, formset_key='zeta', formset_desc='Zeta'
+        )
+        data.update(utils.mock_data_dictionary(
+            {'phone': u'555'}, formset_key='alpha', formset_desc='Alpha'
+        ))
+        sc.reserve(u'a@example.com', dates, data=data)
+
+        resources = {resource.uuid(): resource}
+        reservations = exports.reservations.fetch_records(
+            resources, 'all', 'all'
+        )
+
+        # both ways put the forms of a reservation in the order of their keys
+        expected = ['Alpha.phone', 'Zeta.name']
+
+        self.assertEqual(
+            exports.reservations.additional_headers(reservations), expected
+        )
+        self.assertEqual(
+            exports.reservations.discover_headers(resources, 'all', 'all'),
+            expected
+        )
+
+    def test_export_job(self):
+        self.login_manager()
+
+        resource = self.create_resource()
+        sc = resource.scheduler()
+
+        dates = (datetime(2012, 2, 1, 12, 0), datetime(2012, 2, 1, 16, 0))
+        sc.allocate(dates, approve_manually=False)
+        sc.reserve(u'a@example.com', dates)
+
+        new_job = lambda: export_jobs.ExportJob(
+            site_path='/'.join(self.portal.getPhysicalPath()),
+            user_id=api.user.get_current().getId(),
+            source='reservations',
+            format='xlsx',
+            resources={resource.uuid(): '/'.join(resource.getPhysicalPath())},
+            language='en',
+            year='all',
+            month='all',
+            filename='export.xlsx'
+        )
+
+        job = export_jobs.enqueue(new_job(), start=False)
+        self.assertEqual(job.state, 'queued')
+
+        # the same parameters lead to the same job
+        self.assertIs(export_jobs.enqueue(new_job(), start=False), job)
+
+        job.run(self.portal)
+        self.assertEqual(job.state, 'finished')
+        self.assertFalse(job.expired)
+
+        # finished jobs are run again when the export is started again
+        finished = job
+        job = export_jobs.enqueue(new_job(), start=False)
+        self.assertIsNot(job, finished)
+        self.assertEqual(job.state, 'queued')
+
+        job.run(self.portal)
+        self.assertEqual(job.state, 'finished')
+
+        request = self.request()
+        request['id'] = job.id
+
+        output = ''.join(ExportDownloadView(self.portal, request).render())
+        self.assertEqual(output, open(job.path, 'rb').read())
+
+        # other users don't see the job
+        self.logout()
+        self.assertEqual(
+            ExportDownloadView(self.portal, request).render(), u''
+        )
+
+    def test_failed_export_job(self):
+        self.login_manager()
+
+        job = export_jobs.enqueue(export_jobs.ExportJob(
+            site_path='/'.join(self.portal.getPhysicalPath()),
+            user_id=api.user.get_current().getId(),
+            source='reservations',
+            format='xlsx',
+            resources={'invalid': '/plone/missing-resource'},
+            language='en',
+            year='all',
+            month='all',
+            filename='export.xlsx'
+        ), start=False)
+
+        self.assertRaises(Exception, job.run, self.portal)
+        self.assertEqual(job.state, 'failed')
+        self.assertFalse(job.expired)
+
+        # the failure is shown on the status page until the job expires
+        request = self.request()
+        request['id'] = job.id
+
+        view = ExportJobView(self.portal, request)
+        self.assertIs(view.job, job)
+        self.assertFalse(view.running)
+        self.assertIn(u'The export failed', view())
+
+        job.finished -= export_jobs.max_age + 1
+        self.assertTrue(job.expired)
+        self.assertIs(ExportJobView(self.portal, request).job, None)
@@ -4,9 +4,15 @@ from datetime import date, datetime, timedelta
 
 from seantis.reservation import utils
 from seantis.reservation import settings
-from seantis.reservation.error import CustomReservationError
+from seantis.reservation.error import (
+    CustomReservationError,
+    ScriptBudgetExceeded
+)
 from seantis.reservation.tests import IntegrationTestCase
 from seantis.reservation.restricted_eval import (
+    ScriptBudget,
+    compile_expression,
+    get_pre_reserve_script,
     validate_expression,
     evaluate_expression,
     run_pre_reserve_script
@@ -47,6 +53,59 @@ class TestCustomFilterScript(IntegrationTestCase):
         run("file = var", g={'var': 'test'}, l=locals_)
         self.assertEqual(locals_['file'], 'test')
 
+    def test_compile_expression(self):
+        code = compile_expression(u'x = 1', 'exec')
+
+        self.assertIs(compile_expression(u'x = 1', 'exec'), code)
+        self.assertIsNot(compile_expression(u'x = 1', 'eval'), code)
+        self.assertIsNot(compile_expression(u'x = 2', 'exec'), code)
+
+        # invalid expressions are not cached
+        script = "class Test(object): pass"
+        self.assertRaises(ValueError, compile_expression, script, 'exec')
+        self.assertRaises(ValueError, compile_expression, script, 'exec')
+
+    def test_script_budget(self):
+        run = lambda s, budget: evaluate_expression(
+            dedent(s), None, {}, 'exec', budget
+        )
+
+        script = """
+        while True:
+            pass
+        """
+        budget = ScriptBudget(seconds=10, lines=1000)
+        self.assertRaises(ScriptBudgetExceeded, run, script, budget)
+        self.assertTrue(budget.exceeded)
+
+        # the lines of functions defined by the script count as well
+        script = """
+        count = lambda x: len(list(map(lambda y: y, x)))
+        result = count(list(map(lambda y: y, [1] * 2000)))
+        """
+        budget = ScriptBudget(seconds=10, lines=1000)
+        self.assertRaises(ScriptBudgetExceeded, run, script, budget)
+
+        script = """
+        result = sum([1, 2, 3])
+        """
+        self.assertRaises(NameError, run, script, ScriptBudget(10, 1000))
+
+        locals_ = {}
+        evaluate_expression(
+            'result = max([1, 2, 3])', None, locals_, 'exec',
+            ScriptBudget(10, 1000)
+        )
+        self.assertEqual(locals_['result'], 3)
+
+    def test_pre_reserve_script_cache(self):
+        settings.set('pre_reservation_script', u'  exit()  ')
+        self.assertEqual(get_pre_reserve_script(), u'exit()')
+
+        # the cache is invalidated when the record changes
+        settings.set('pre_reservation_script', u'error("no")')
+        self.assertEqual(get_pre_reserve_script(), u'error("no")')
+
     def test_pre_reserve_script_variables(self):
 
         class MockContext(object):
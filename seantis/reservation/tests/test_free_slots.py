@@ -0,0 +1,64 @@
+from datetime import datetime
+
+from seantis.reservation.free_slots import free_slots_by_allocation
+from seantis.reservation.session import Session
+from seantis.reservation.tests import IntegrationTestCase
+
+
+class TestFreeSlots(IntegrationTestCase):
+
+    def test_free_slots(self):
+        self.login_manager()
+
+        resource = self.create_resource()
+        sc = resource.scheduler()
+
+        allocation = sc.allocate(
+            (datetime(2015, 4, 1, 8, 0), datetime(2015, 4, 1, 12, 0)),
+            partly_available=True, raster=15, quota=2,
+            approve_manually=False
+        )[0]
+
+        def spots():
+            return free_slots_by_allocation(Session(), [allocation])[
+                allocation.id
+            ]
+
+        timespans = [
+            (datetime(2015, 4, 1, 8, 0), datetime(2015, 4, 1, 12, 0)),
+            (datetime(2015, 4, 1, 9, 0), datetime(2015, 4, 1, 9, 30)),
+            (datetime(2015, 4, 1, 9, 10), datetime(2015, 4, 1, 9, 20)),
+            (datetime(2015, 4, 1, 10, 0), datetime(2015, 4, 1, 11, 0)),
+            (datetime(2015, 4, 1, 11, 45), datetime(2015, 4, 1, 12, 0)),
+        ]
+
+        def assert_same():
+            for start, end in timespans:
+                self.assertEqual(
+                    spots().find_spot(start, end),
+                    allocation.find_spot(start, end) is not None
+                )
+
+            self.assertAlmostEqual(
+                spots().percent_free(),
+                sc.availability(allocation.start, allocation.end)
+            )
+
+        assert_same()
+        self.assertEqual(spots().percent_free(), 100.0)
+
+        sc.approve_reservations(sc.reserve(
+            u'test@example.org',
+            (datetime(2015, 4, 1, 9, 0), datetime(2015, 4, 1, 10, 0))
+        ))
+        assert_same()
+
+        sc.approve_reservations(sc.reserve(
+            u'test@example.org',
+            (datetime(2015, 4, 1, 9, 0), datetime(2015, 4, 1, 9, 30))
+        ))
+        assert_same()
+
+        self.assertFalse(spots().find_spot(*timespans[2]))
+        self.assertTrue(spots().find_spot(*timespans[3]))
+        self.assertAlmostEqual(spots().percent_free(), 81.25)
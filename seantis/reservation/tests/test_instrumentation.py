@@ -0,0 +1,78 @@
+from libres.db.models import Allocation
+
+from seantis.reservation import instrumentation
+from seantis.reservation import macros, resource
+from seantis.reservation.session import Session
+from seantis.reservation.tests import IntegrationTestCase
+
+
+class TestInstrumentation(IntegrationTestCase):
+
+    def test_shape(self):
+        shape = instrumentation.shape
+
+        self.assertEqual(
+            shape(
+                'SELECT * FROM allocations\n'
+                'WHERE id IN (%(id_1)s, %(id_2)s) AND quota = 2'
+            ),
+            'SELECT * FROM allocations WHERE id IN (?) AND quota = ?'
+        )
+        self.assertEqual(
+            shape("SELECT * FROM reservations WHERE email = 'a''b'"),
+            shape("SELECT * FROM reservations WHERE email = 'c'")
+        )
+
+    def test_view_name(self):
+        self.login_admin()
+
+        request = self.request()
+        context = self.create_resource()
+
+        self.assertEqual(
+            instrumentation.view_name(macros.View(context, request)),
+            'seantis.reservation.macros.View'
+        )
+        self.assertEqual(
+            instrumentation.view_name(resource.View(context, request)),
+            'seantis.reservation.resource.View'
+        )
+        self.assertIs(instrumentation.view_name(self.portal), None)
+        self.assertIs(instrumentation.view_name(None), None)
+
+    def test_request_stats(self):
+        self.login_admin()
+
+        resource = self.create_resource()
+        session = Session()
+        engine = session.bind
+
+        self.assertFalse(instrumentation.instrument(engine))
+        instrumentation.observe(engine)
+
+        try:
+            instrumentation.start_request()
+
+            for i in range(12):
+                session.query(Allocation).filter(Allocation.id == i).all()
+
+            session.query(Allocation).filter(
+                Allocation.mirror_of == resource.uuid()
+            ).all()
+
+            stats = instrumentation.end_request('Slots')
+        finally:
+            instrumentation.unobserve(engine)
+
+        self.assertEqual(stats.statements, 13)
+        self.assertEqual(len(stats.repeated_shapes(10)), 1)
+
+        result = instrumentation.stats_for('Slots').as_dict()
+        self.assertEqual(result['requests'], 1)
+        self.assertEqual(result['statements'], 13)
+        self.assertEqual(len(result['repeated_statements']), 1)
+        self.assertEqual(sum(result['request_times'].values()), 1)
+
+        # statements outside of requests are not recorded
+        session.query(Allocation).all()
+        self.assertIs(instrumentation.end_request('Slots'), None)
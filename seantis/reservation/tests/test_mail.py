@@ -1,10 +1,19 @@
+from plone import api
 from plone.app.testing import TEST_USER_ID
+from plone.app.workflow.events import LocalrolesModifiedEvent
+from plone.dexterity.utils import createContentInContainer
+from zope.event import notify
+from zope.lifecycleevent import ObjectModifiedEvent
 
+from seantis.reservation import cache
+from seantis.reservation import outbox
 from seantis.reservation import settings
+from seantis.reservation.session import Session
 from seantis.reservation.tests import IntegrationTestCase
 from seantis.reservation.mail import (
-    get_managers_by_context, get_manager_emails
+    get_email_content, get_managers_by_context, get_manager_emails
 )
+from seantis.reservation.mail_templates import CompiledTemplate, templates
 
 
 class MailTestCase(IntegrationTestCase):
@@ -48,3 +57,138 @@ class MailTestCase(IntegrationTestCase):
             get_manager_emails(resource),
             []
         )
+
+    def test_outbox(self):
+        self.login_manager()
+
+        outbox.enqueue(
+            u'Site <site@example.org>', u'test@example.org', 'Subject: Test'
+        )
+        outbox.enqueue(u'site@example.org', u'info@example.org', 'Subject: 2')
+
+        session = Session()
+        path = outbox.site_path(self.portal)
+
+        messages = outbox.due_messages(session, path, 1)
+        self.assertEqual(len(messages), 1)
+
+        self.assertEqual(outbox.send_batch(self.portal, session, messages), 1)
+        self.assertEqual(len(self.mailhost.messages), 1)
+        self.assertEqual(outbox.pending_messages(session, path).count(), 1)
+
+        # failed messages are retried later
+        message = outbox.pending_messages(session, path).one()
+        outbox.reschedule(message, u'Connection refused')
+        self.assertEqual(message.attempts, 1)
+        self.assertEqual(outbox.due_messages(session, path, 10), [])
+
+        # messages given up on are removed after the retention period
+        message.attempts = outbox.max_attempts
+        session.flush()
+
+        self.assertEqual(outbox.pending_messages(session, path).count(), 0)
+        self.assertEqual(outbox.remove_dead_messages(session), 0)
+
+        message.created -= outbox.retention
+        session.flush()
+        self.assertEqual(outbox.remove_dead_messages(session), 1)
+
+    def test_manager_emails_cache(self):
+        self.login_manager()
+        settings.set('send_email_to_managers', 'by_path')
+
+        resource = self.create_resource()
+
+        self.assign_reservation_manager('ted@example.com', resource)
+        self.assertEqual(get_manager_emails(resource), ['ted@example.com'])
+
+        # manage_setLocalRoles doesn't notify anyone, so the new manager is
+        # not known until the cached entry expires
+        self.assign_reservation_manager('brad@example.com', resource)
+        self.assertEqual(get_manager_emails(resource), ['ted@example.com'])
+
+        # changes through the sharing view invalidate the cache
+        notify(LocalrolesModifiedEvent(resource, self.request()))
+        self.assertEqual(
+            sorted(get_manager_emails(resource)),
+            ['brad@example.com', 'ted@example.com']
+        )
+
+        # other changes are picked up once the cache expires
+        resource.manage_delLocalRoles(['brad'])
+        self.assertEqual(len(get_manager_emails(resource)), 2)
+
+        max_age = cache.manager_emails.max_age
+        cache.manager_emails.max_age = -1
+
+        try:
+            self.assertEqual(
+                get_manager_emails(resource), ['ted@example.com']
+            )
+        finally:
+            cache.manager_emails.max_age = max_age
+
+    def test_manager_emails_group_members(self):
+        if cache.IPrincipalAddedToGroupEvent is None:
+            return  # membership changes are not notified before PAS 1.11
+
+        self.login_manager()
+        settings.set('send_email_to_managers', 'by_path')
+
+        resource = self.create_resource()
+
+        username, password = self.assign_reservation_manager(
+            'ted@example.com', resource
+        )
+        resource.manage_delLocalRoles([username])
+
+        api.group.create(groupname='reservation-managers')
+        resource.manage_setLocalRoles(
+            'reservation-managers', ['Reservation-Manager']
+        )
+        self.assertEqual(get_manager_emails(resource), [])
+
+        api.group.add_user(groupname='reservation-managers', username=username)
+        self.assertEqual(get_manager_emails(resource), ['ted@example.com'])
+
+        api.group.remove_user(
+            groupname='reservation-managers', username=username
+        )
+        self.assertEqual(get_manager_emails(resource), [])
+
+    def test_compiled_template(self):
+        template = CompiledTemplate(u'%(quota)s of %(resource)s (100%%)')
+
+        self.assertEqual(template.fields, set(['quota', 'resource']))
+        self.assertEqual(
+            template.render({'quota': 2, 'resource': u'Room'}),
+            u'2 of Room (100%)'
+        )
+
+        # invalid templates fail like the % operator
+        template = CompiledTemplate(u'%(quota)s of 100%')
+        self.assertRaises(ValueError, template.render, {'quota': 2})
+
+    def test_user_templates(self):
+        self.login_manager()
+
+        resource = self.create_resource()
+        default = templates['reservation_made'].get('en')
+
+        self.assertEqual(
+            get_email_content(resource, 'reservation_made', 'en'), default
+        )
+
+        template = createContentInContainer(
+            self.portal, 'seantis.reservation.emailtemplate',
+            language='en', reservation_made_subject=u'Made %(resource)s'
+        )
+
+        subject, body = get_email_content(resource, 'reservation_made', 'en')
+        self.assertEqual(subject, u'Made %(resource)s')
+
+        template.reservation_made_subject = u'Changed'
+        notify(ObjectModifiedEvent(template))
+
+        subject, body = get_email_content(resource, 'reservation_made', 'en')
+        self.assertEqual(subject, u'Changed')
@@ -1,16 +1,82 @@
+from datetime import datetime, timedelta
+from uuid import uuid4 as new_uuid
+
 from zope.component.hooks import getSite
 
 from seantis.reservation.tests import IntegrationTestCase
 from seantis.reservation import maintenance
+from seantis.reservation import throttle
+from seantis.reservation import utils
+from seantis.reservation.session import Session
 
 
 class TestMaintenance(IntegrationTestCase):
 
-    def test_register_once_per_connection(self):
+    def test_register_site(self):
+
+        self.assertTrue(maintenance.register_site(getSite()))
+        self.assertFalse(maintenance.register_site(getSite()))
+
+        self.assertEqual(1, len(maintenance._connections))
+
+        # the thread is turned off in testing
+        self.assertIs(maintenance._runner, None)
+
+    def test_remove_expired_sessions(self):
+        self.login_admin()
+
+        resource = self.create_resource()
+        sc = resource.scheduler()
+
+        dates = [
+            (datetime(2015, 5, day, 8, 0), datetime(2015, 5, day, 10, 0))
+            for day in range(1, 6)
+        ]
+
+        for start, end in dates:
+            sc.allocate((start, end), quota=1)
+
+        session_ids = [new_uuid() for i in range(3)]
+
+        for i, (start, end) in enumerate(dates):
+            sc.reserve(
+                u'test@example.org', (start, end),
+                session_id=session_ids[i % len(session_ids)]
+            )
+
+        commits = []
+        metrics = maintenance.CleanupMetrics()
+
+        sessions, reservations = maintenance.remove_expired_sessions(
+            Session(), lambda: commits.append(True),
+            expiration_date=utils.utcnow() + timedelta(minutes=1),
+            batch_size=2, metrics=metrics
+        )
+
+        self.assertEqual((sessions, reservations), (3, 5))
+        self.assertEqual(len(commits), 2)
+        self.assertEqual(metrics.as_dict()['batches'], 2)
+        self.assertEqual(sc.managed_reservations().count(), 0)
+
+        # sessions which are not expired are kept
+        sc.reserve(
+            u'test@example.org', dates[0], session_id=session_ids[0]
+        )
+
+        self.assertEqual(
+            maintenance.remove_expired_sessions(Session(), lambda: None),
+            (0, 0)
+        )
+        self.assertEqual(sc.managed_reservations().count(), 1)
+
+    def test_run_cleanup_throttle_entries(self):
+        backend = throttle.PostgresBackend()
+        backend.acquire('reserve', 'session:a', 0)
+        backend.acquire('reserve', 'session:b', 60)
 
-        once = maintenance.register_once_per_connection
-        self.assertTrue(once('/test', getSite(), 1))
-        self.assertFalse(once('/test', getSite(), 1))
-        self.assertFalse(once('/test2', getSite(), 1))
+        maintenance.run_cleanup('/plone', Session(), lambda: None)
 
-        self.assertEqual(1, len(maintenance._clockservers))
+        self.assertEqual(
+            Session().query(throttle.ThrottleEntry.key).all(),
+            [('session:b', )]
+        )
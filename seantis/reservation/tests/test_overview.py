@@ -1,5 +1,10 @@
+import json
+
 from datetime import datetime
+from plone.app.testing import TEST_USER_ID
 from pytz import timezone
+from seantis.reservation import cache
+from seantis.reservation import utils
 from seantis.reservation.tests import IntegrationTestCase
 from seantis.reservation.overview import Overview
 
@@ -50,3 +55,35 @@ class TestOverview(IntegrationTestCase):
 
         self.assertEqual(len(events), 1)
         self.assertEqual(events[0]['className'], 'event-partly-available')
+
+    def test_overview_feed_per_user(self):
+        self.login_manager()
+
+        resource = self.create_resource()
+        resource.scheduler().allocate(
+            (datetime(2015, 1, 23, 12, 0), datetime(2015, 1, 23, 15, 0)),
+            approve_manually=False
+        )
+
+        request = self.request()
+        request.form.update({
+            'start': str(utils.utctimestamp(datetime(2015, 1, 21))),
+            'end': str(utils.utctimestamp(datetime(2015, 1, 24))),
+            'uuid[]': [resource.uuid()]
+        })
+
+        overview = Overview(resource, request)
+        overview.__name__ = 'overview'
+
+        key = lambda: cache.feed_key(
+            resource, request, 'overview', [resource.uuid()],
+            None, None, per_user=True
+        )
+
+        self.assertEqual(key()[-1], TEST_USER_ID)
+        self.assertEqual(len(json.loads(overview.render())), 1)
+
+        self.logout()
+
+        self.assertIs(key()[-1], None)
+        self.assertIsInstance(json.loads(overview.render()), list)
@@ -9,6 +9,8 @@ from seantis.reservation.tests import IntegrationTestCase
 from seantis.reservation.reports import GeneralReportParametersMixin
 from seantis.reservation.reports.monthly_report import monthly_report
 from seantis.reservation.reports.latest_reservations import (
+    decode_page_key,
+    encode_page_key,
     human_date,
     latest_reservations
 )
@@ -95,6 +97,38 @@ class TestReports(IntegrationTestCase):
         # on reservation on the second day
         self.assertEqual(len(report[30][resource.uuid()]['approved']), 1)
 
+    def test_monthly_report_groups(self):
+        self.login_admin()
+
+        resource = self.create_resource()
+        sc = resource.scheduler()
+
+        dates = [
+            (datetime(2013, 9, 2, 8), datetime(2013, 9, 2, 10)),
+            (datetime(2013, 9, 9, 8), datetime(2013, 9, 9, 10)),
+            (datetime(2013, 10, 7, 8), datetime(2013, 10, 7, 10)),
+        ]
+
+        group = sc.allocate(dates, grouped=True)[0].group
+
+        sc.approve_reservations(sc.reserve(reservation_email, group=group))
+        sc.reserve(reservation_email, group=group)
+
+        report = monthly_report(2013, 9, {resource.uuid(): resource})
+
+        # one record for each allocation of the group in the month
+        self.assertEqual(report.keys(), [2, 9])
+
+        for day in (2, 9):
+            lists = report[day][resource.uuid()]
+            self.assertEqual(len(lists['approved']), 1)
+            self.assertEqual(len(lists['pending']), 1)
+            self.assertEqual(lists['approved'][0]['start'], u'08:00')
+            self.assertEqual(lists['approved'][0]['end'], u'10:00')
+
+        report = monthly_report(2013, 10, {resource.uuid(): resource})
+        self.assertEqual(report.keys(), [7])
+
     @mock.patch('seantis.reservation.utils.utcnow')
     def test_latest_reservations_human_date(self, utcnow):
         translate = lambda text: i18n.translate(
@@ -179,3 +213,88 @@ class TestReports(IntegrationTestCase):
 
         report = latest_reservations({resource.uuid(): resource}, daterange)
         self.assertEqual(len(report), 0)
+
+    def test_latest_reservations_timespans(self):
+
+        self.login_admin()
+
+        resource = self.create_resource()
+        sc = resource.scheduler()
+
+        dates = [
+            (datetime(2013, 9, 25, 8), datetime(2013, 9, 25, 10)),
+            (datetime(2013, 9, 26, 8), datetime(2013, 9, 26, 10))
+        ]
+
+        single = (datetime(2013, 9, 27, 8), datetime(2013, 9, 27, 10))
+
+        group = sc.allocate(dates, grouped=True)[0].group
+        sc.allocate(single, quota=2)
+
+        grouped = sc.reserve(reservation_email, group=group)
+        sc.approve_reservations(grouped)
+
+        token = sc.reserve(reservation_email, single, quota=2)
+
+        now = datetime.utcnow().replace(tzinfo=pytz.utc)
+        daterange = (now - timedelta(days=30), now)
+
+        report = latest_reservations({resource.uuid(): resource}, daterange)
+        self.assertEqual(list(report.keys()), [token, grouped])
+
+        reservation = report[grouped]
+        self.assertEqual(reservation.title, reservation_email)
+        self.assertEqual(reservation.status, u'approved')
+        self.assertEqual(reservation.resource, resource.uuid())
+        self.assertEqual(
+            sorted(reservation.timespans()),
+            sorted(
+                (a.start, a.end) for a in sc.allocations_by_group(group)
+            )
+        )
+
+        reservation = report[token]
+        timespans = sc.reservations_by_token(token).one().timespans()
+
+        self.assertEqual(reservation.status, u'pending')
+        self.assertEqual(reservation.quota, 2)
+        self.assertEqual(
+            reservation.timespans(),
+            [tuple(t) for t in timespans]
+        )
+
+    def test_latest_reservations_pages(self):
+
+        self.login_admin()
+
+        resource = self.create_resource()
+        sc = resource.scheduler()
+
+        days = [
+            (datetime(2013, 9, day, 8), datetime(2013, 9, day, 10))
+            for day in (23, 24, 25)
+        ]
+
+        tokens = []
+        for day in days:
+            sc.allocate(day, quota=1)
+            tokens.append(sc.reserve(reservation_email, day))
+
+        now = datetime.utcnow().replace(tzinfo=pytz.utc)
+        daterange = (now - timedelta(days=30), now)
+        resources = {resource.uuid(): resource}
+
+        first = latest_reservations(resources, daterange, page_size=2)
+        self.assertEqual(len(first), 2)
+        self.assertEqual(list(first.keys()), tokens[::-1][:2])
+
+        after = decode_page_key(encode_page_key(*first.next_page))
+        self.assertEqual(after, first.next_page)
+
+        second = latest_reservations(
+            resources, daterange, after=after, page_size=2
+        )
+        self.assertEqual(list(second.keys()), [tokens[0]])
+        self.assertIs(second.next_page, None)
+
+        self.assertIs(decode_page_key('invalid'), None)
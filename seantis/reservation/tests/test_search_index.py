@@ -0,0 +1,156 @@
+from datetime import datetime, timedelta
+from zope.component import getUtility
+
+from seantis.reservation import search_index
+from seantis.reservation.interfaces import ILibresUtility
+from seantis.reservation.tests import IntegrationTestCase
+
+
+class TestSearchIndex(IntegrationTestCase):
+
+    def test_search_allocations_cursor(self):
+        self.login_manager()
+
+        resource = self.create_resource()
+        sc = resource.scheduler()
+
+        start = datetime(2015, 3, 2, 8, 0)
+
+        # two weeks of mornings and afternoons, starting on a monday
+        for day in range(14):
+            for hours in ((8, 10), (14, 16)):
+                sc.allocate((
+                    start.replace(hour=hours[0]) + timedelta(days=day),
+                    start.replace(hour=hours[1]) + timedelta(days=day)
+                ), quota=2, approve_manually=False)
+
+        token = sc.reserve(
+            u'test@example.org',
+            (datetime(2015, 3, 2, 8, 0), datetime(2015, 3, 2, 10, 0)),
+            quota=2
+        )
+        sc.approve_reservations(token)
+
+        searches = [
+            dict(),
+            dict(days=('mo', 'we')),
+            dict(available_only=True),
+            dict(minspots=2),
+            dict(days=('mo', ), available_only=True),
+        ]
+
+        times = [
+            (datetime(2015, 3, 1, 0, 0), datetime(2015, 3, 20, 23, 59)),
+            (datetime(2015, 3, 1, 9, 0), datetime(2015, 3, 20, 12, 0)),
+            (datetime(2015, 3, 5, 15, 30), datetime(2015, 3, 9, 17, 0)),
+        ]
+
+        for options in searches:
+            for s, e in times:
+                expected = [
+                    a.id for a in sc.search_allocations(s, e, **options)
+                ]
+
+                cursor = sc.search_allocations_cursor(s, e, **options)
+                cursor.page_size = 3
+
+                self.assertEqual([a.id for a in cursor], expected)
+
+        cursor = sc.search_allocations_cursor(*times[0])
+        results, more = cursor.first(10)
+        self.assertEqual(len(results), 10)
+        self.assertTrue(more)
+
+        results, more = sc.search_allocations_cursor(*times[0]).first(28)
+        self.assertEqual(len(results), 28)
+        self.assertFalse(more)
+
+        # the pages of the search form, each started by a new cursor
+        pages, after = [], None
+
+        while True:
+            cursor = sc.search_allocations_cursor(*times[0])
+            cursor.page_size = 4
+
+            results, after = cursor.page(10, after)
+            pages.append([a.id for a in results])
+
+            if after is None:
+                break
+
+            after = search_index.decode_position(
+                search_index.encode_position(after)
+            )
+
+        self.assertEqual([len(p) for p in pages], [12, 12, 4])
+        self.assertEqual(
+            sum(pages, []),
+            [a.id for a in sc.search_allocations(*times[0])]
+        )
+        self.assertIs(search_index.decode_position('invalid'), None)
+
+    def test_search_allocations_cursor_local_times(self):
+        self.login_manager()
+
+        resource = self.create_resource()
+        sc = getUtility(ILibresUtility).scheduler(
+            resource.string_uuid(), 'Europe/Zurich'
+        )
+
+        # 09:00 - 10:00 in Zurich, 08:00 - 09:00 in UTC
+        sc.allocate((
+            datetime(2015, 3, 2, 9, 0), datetime(2015, 3, 2, 10, 0)
+        ))
+
+        def search(start, end):
+            start = datetime(2015, 3, 1, *start)
+            end = datetime(2015, 3, 3, *end)
+
+            return (
+                [a.id for a in sc.search_allocations_cursor(start, end)],
+                [a.id for a in sc.search_allocations(start, end)]
+            )
+
+        # the searched times are the local times of the allocations
+        cursor, libres = search((9, 15), (9, 45))
+        self.assertEqual(len(cursor), 1)
+        self.assertEqual(len(libres), 0)
+
+        # libres compares the searched times in UTC with the local times
+        cursor, libres = search((10, 15), (10, 45))
+        self.assertEqual(len(cursor), 0)
+        self.assertEqual(len(libres), 1)
+
+    def test_search_allocations_cursor_groups(self):
+        self.login_manager()
+
+        resource = self.create_resource()
+        sc = resource.scheduler()
+
+        # a group of five mornings, larger than the pages of the cursor
+        sc.allocate([
+            (datetime(2015, 3, day, 8, 0), datetime(2015, 3, day, 10, 0))
+            for day in range(2, 7)
+        ], grouped=True)
+
+        start, end = datetime(2015, 3, 4, 0, 0), datetime(2015, 3, 8, 0, 0)
+        expected = [a.id for a in sc.search_allocations(start, end)]
+        self.assertEqual(len(expected), 5)
+
+        cursor = sc.search_allocations_cursor(start, end)
+        cursor.page_size = 2
+
+        results = [a.id for a in cursor]
+        self.assertEqual(sorted(results), sorted(expected))
+
+        # the whole group is returned with the first page, a cursor started
+        # after it doesn't return the group again
+        cursor = sc.search_allocations_cursor(start, end)
+        cursor.page_size = 2
+
+        results, after = cursor.fetch()
+        self.assertEqual(sorted(a.id for a in results), sorted(expected))
+
+        cursor = sc.search_allocations_cursor(start, end)
+        cursor.page_size = 2
+        self.assertEqual(cursor.fetch(after), ([], None))
@@ -0,0 +1,116 @@
+import json
+
+from datetime import date, datetime, time
+from plone.app.textfield.value import RichTextValue
+
+from seantis.reservation import serializer
+from seantis.reservation import utils
+from seantis.reservation.tests import IntegrationTestCase
+
+
+class TestSerializer(IntegrationTestCase):
+
+    def test_backends(self):
+        payloads = serializer.sample_payloads(count=10)
+        backends = serializer.available_backends()
+
+        self.assertIn('json', backends)
+
+        for payload, (value, default) in payloads.items():
+            expected = json.dumps(value, default=default)
+
+            # the json backend returns exactly what the json module does
+            self.assertEqual(backends['json'].dumps(value, default), expected)
+
+            for name, backend in backends.items():
+                self.assertEqual(
+                    json.loads(backend.dumps(value, default)),
+                    json.loads(expected)
+                )
+
+    def test_choose_backend(self):
+        try:
+            serializer.set_backend('json')
+            self.assertEqual(serializer.get_backend().name, 'json')
+
+            # unknown backends fall back to the default
+            serializer.set_backend('unknown')
+            self.assertIn(
+                serializer.get_backend().name,
+                serializer.available_backends()
+            )
+        finally:
+            serializer.set_backend()
+
+    def test_unusable_backend(self):
+
+        class OutdatedBackend(serializer.JsonBackend):
+            name = 'outdated'
+
+            def create_encoder(self, default):
+                return json.JSONEncoder(default=default, for_json=False)
+
+        serializer.backends['outdated'] = OutdatedBackend
+
+        try:
+            # backends whose encoder can't be built are not used
+            self.assertNotIn('outdated', serializer.available_backends())
+
+            serializer.set_backend('outdated')
+            self.assertNotEqual(serializer.get_backend().name, 'outdated')
+        finally:
+            del serializer.backends['outdated']
+            serializer.set_backend()
+
+    def test_dumps_userformdata(self):
+        richtext = RichTextValue(
+            raw=u'<p>Hi</p>', mimeType='text/html',
+            outputMimeType='text/x-html-safe', encoding='utf-8'
+        )
+
+        data = {
+            'form': {
+                'values': [
+                    dict(key='day', value=date(2015, 1, 1)),
+                    dict(key='arrival', value=datetime(2015, 1, 1, 8, 30)),
+                    dict(key='time', value=time(9, 15)),
+                    dict(key='options', value=set([u'lunch'])),
+                    dict(key='notes', value=richtext),
+                ]
+            }
+        }
+
+        encoded = serializer.dumps_userformdata(data)
+
+        # the values are encoded in the format userformdata_decode expects
+        values = [v['value'] for v in json.loads(encoded)['form']['values']]
+        self.assertEqual(values[:4], [
+            u'__date__@2015-01-01',
+            u'__datetime__@2015-01-01T08:30:00',
+            u'__time__@09:15:00',
+            [u'lunch']
+        ])
+        self.assertTrue(values[4].startswith(u'__richtext__@'))
+
+        values = utils.json_loads(encoded)['form']['values']
+        self.assertEqual(values[0]['value'], date(2015, 1, 1))
+        self.assertEqual(values[1]['value'], datetime(2015, 1, 1, 8, 30))
+        self.assertEqual(values[2]['value'], time(9, 15))
+        self.assertEqual(values[3]['value'], [u'lunch'])
+        self.assertEqual(values[4]['value'].raw, u'<p>Hi</p>')
+        self.assertEqual(values[4]['value'].mimeType, 'text/html')
+
+        self.assertEqual(serializer.dumps_userformdata(None), '')
+        self.assertRaises(TypeError, serializer.dumps_userformdata, object())
+
+    def test_benchmark(self):
+        results = serializer.benchmark(repetitions=1, count=10)
+
+        self.assertEqual(
+            results.keys(), serializer.available_backends().keys()
+        )
+
+        for result in results.values():
+            self.assertEqual(
+                result['seconds'].keys(), ['calendar', 'data', 'export']
+            )
@@ -2,7 +2,7 @@ import mock
 
 from collections import namedtuple
 from uuid import uuid1 as uuid
-from datetime import datetime
+from datetime import datetime, timedelta
 from seantis.reservation.tests import IntegrationTestCase
 
 from seantis.reservation.session import (
@@ -11,7 +11,9 @@ from seantis.reservation.session import (
 )
 
 from seantis.reservation import Session
+from seantis.reservation import pool
 from libres.db.models import Allocation
+from libres.modules import errors
 
 
 def add_something(resource=None):
@@ -46,3 +48,121 @@ class TestSession(IntegrationTestCase):
         util._default_dsn = 'test://{*}'
         get_config.return_value = None
         self.assertEqual(util.get_dsn(MockSite('test4')), 'test://test4')
+
+    @mock.patch('seantis.reservation.utils.get_config')
+    def test_pool_config(self, get_config):
+        config = {
+            'pool-size': '10',
+            'pool-size-mysite': '20',
+            'pool-recycle': '3600',
+            'pool-pre-ping': 'True',
+        }
+        get_config.side_effect = config.get
+
+        self.assertEqual(pool.pool_config('yoursite'), {
+            'pool_size': 10,
+            'max_overflow': 5,
+            'pool_recycle': 3600,
+            'pool_pre_ping': True
+        })
+        self.assertEqual(pool.pool_config('mysite')['pool_size'], 20)
+
+    def test_pool_metrics(self):
+        self.login_manager()
+
+        resource = self.create_resource()
+        resource.scheduler().managed_allocations().all()
+
+        metrics = pool.metrics_for('plone').as_dict()
+
+        self.assertTrue(metrics['checkouts'] > 0)
+        self.assertEqual(metrics['timeouts'], 0)
+        self.assertEqual(metrics['size'], 5)
+
+    def test_allocation_availabilities(self):
+        self.login_manager()
+
+        resource = self.create_resource()
+        scheduler = resource.scheduler()
+
+        dates = [
+            (datetime(2015, 1, 23, 12, 0), datetime(2015, 1, 23, 15, 0)),
+            (datetime(2015, 1, 24, 12, 0), datetime(2015, 1, 24, 15, 0)),
+        ]
+
+        scheduler.allocate(dates, quota=4, approve_manually=True)
+        allocations = scheduler.allocations_in_range(
+            datetime(2015, 1, 23), datetime(2015, 1, 25)
+        ).order_by(Allocation._start).all()
+
+        scheduler.approve_reservations(
+            scheduler.reserve(u'test@example.org', dates[0], quota=3)
+        )
+        scheduler.reserve(u'test@example.org', dates[0])
+        scheduler.reserve(u'test@example.org', dates[0])
+
+        availabilities = scheduler.allocation_availabilities(allocations)
+        self.assertEqual(len(availabilities), 2)
+
+        for allocation in allocations:
+            self.assertEqual(
+                availabilities[allocation.id],
+                (
+                    scheduler.availability(allocation.start, allocation.end),
+                    allocation.waitinglist_length
+                )
+            )
+
+        self.assertEqual(availabilities[allocations[0].id], (25.0, 2))
+        self.assertEqual(availabilities[allocations[1].id], (100.0, 0))
+
+    def test_allocate_recurrence(self):
+        self.login_manager()
+
+        resource = self.create_resource()
+        scheduler = resource.scheduler()
+        scheduler.allocation_batch_size = 10
+
+        start = datetime(2015, 1, 1, 12, 0)
+        dates = [
+            (start + timedelta(days=d), start + timedelta(days=d, hours=2))
+            for d in range(25)
+        ]
+
+        reports = []
+        progress = lambda written, total: reports.append((written, total))
+
+        allocations = scheduler.allocate(
+            dates, grouped=True, quota=2, progress=progress
+        )
+
+        self.assertEqual(reports, [(10, 25), (20, 25), (25, 25)])
+        self.assertEqual(len(allocations), 25)
+        self.assertEqual(len(set(a.group for a in allocations)), 1)
+        self.assertEqual(
+            [a.display_start().replace(tzinfo=None) for a in allocations],
+            [s for s, e in dates]
+        )
+        self.assertTrue(all(a.id and a.quota == 2 for a in allocations))
+
+        # overlaps with existing allocations
+        self.assertRaises(
+            errors.OverlappingAllocationError, scheduler.allocate,
+            [(datetime(2014, 12, 31, 12), datetime(2014, 12, 31, 13)),
+             (datetime(2015, 1, 10, 13), datetime(2015, 1, 10, 15))]
+        )
+
+        # overlaps within the dates
+        self.assertRaises(
+            errors.InvalidAllocationError, scheduler.allocate,
+            [(datetime(2015, 2, 1, 12), datetime(2015, 2, 1, 16)),
+             (datetime(2015, 2, 1, 13), datetime(2015, 2, 1, 14))]
+        )
+
+        # adjacent dates do not overlap
+        allocations = scheduler.allocate(
+            [(datetime(2015, 1, 1, 14), datetime(2015, 1, 1, 15)),
+             (datetime(2015, 1, 1, 10), datetime(2015, 1, 1, 12))]
+        )
+        self.assertEqual(len(allocations), 2)
+        self.assertNotEqual(allocations[0].group, allocations[1].group)
@@ -0,0 +1,62 @@
+from datetime import date, datetime
+
+from pytz import timezone
+
+from seantis.reservation import exposure
+from seantis.reservation import summary
+from seantis.reservation.resource import get_queries
+from seantis.reservation.session import Session
+from seantis.reservation.tests import IntegrationTestCase
+
+
+class TestSummary(IntegrationTestCase):
+
+    def test_availability_summary(self):
+        self.login_manager()
+
+        r1 = self.create_resource()
+        r2 = self.create_resource()
+        uuids = [r1.uuid(), r2.uuid()]
+
+        s1, s2 = r1.scheduler(), r2.scheduler()
+
+        dates = (datetime(2015, 1, 23, 12, 0), datetime(2015, 1, 23, 15, 0))
+        s1.allocate(dates, approve_manually=False, quota=4)
+        s2.allocate(dates, approve_manually=False)
+
+        other = (datetime(2015, 1, 24, 12, 0), datetime(2015, 1, 24, 13, 0))
+        other_id = s1.allocate(other, approve_manually=False)[0].id
+
+        token = s1.reserve(u'test@example.org', dates, quota=2)
+        s1.approve_reservations(token)
+
+        daterange = (
+            datetime(2015, 1, 21, tzinfo=timezone('UTC')),
+            datetime(2015, 1, 25, tzinfo=timezone('UTC'))
+        )
+
+        def days():
+            return summary.availability_by_day(
+                Session(), daterange[0], daterange[1], uuids,
+                exposure.for_days(uuids)
+            )
+
+        live = get_queries(uuids).availability_by_day(
+            daterange[0], daterange[1], uuids
+        )
+
+        self.assertEqual(days(), live)
+        self.assertEqual(days()[date(2015, 1, 23)][0], 60.0)
+        self.assertEqual(summary.check(Session()), [])
+
+        s1.remove_reservation(token)
+        self.assertEqual(days()[date(2015, 1, 23)][0], 100.0)
+
+        s1.remove_allocation(other_id)
+        self.assertNotIn(date(2015, 1, 24), days())
+        self.assertEqual(summary.check(Session()), [])
+
+        # the rebuild leads to the same result
+        summary.rebuild(Session())
+        self.assertEqual(summary.check(Session()), [])
+        self.assertEqual(len(days()), 1)
@@ -0,0 +1,42 @@
+from seantis.reservation.tests import IntegrationTestCase
+from seantis.reservation.throttle import (
+    MemoryBackend, PostgresBackend, ThrottleEntry, remove_expired_entries
+)
+
+
+class TestThrottle(IntegrationTestCase):
+
+    def assert_backend(self, backend):
+        release = backend.acquire('reserve', 'session:a', 60)
+        self.assertTrue(release)
+
+        self.assertIs(backend.acquire('reserve', 'session:a', 60), None)
+        self.assertTrue(backend.acquire('reserve', 'session:b', 60))
+        self.assertTrue(backend.acquire('other', 'session:a', 60))
+
+        # an aborted action doesn't count
+        release()
+        self.assertTrue(backend.acquire('reserve', 'session:a', 60))
+
+    def test_memory_backend(self):
+        self.assert_backend(MemoryBackend())
+
+    def test_postgres_backend(self):
+        self.assert_backend(PostgresBackend())
+
+    def test_postgres_backend_removes_expired(self):
+        backend = PostgresBackend()
+
+        backend.acquire('reserve', 'session:a', 0)
+        backend.acquire('reserve', 'session:b', 0)
+        backend.acquire('reserve', 'session:c', 60)
+
+        query = backend.session.query(ThrottleEntry.key)
+
+        # only the expired entries of the acquired key are removed
+        backend.acquire('reserve', 'session:a', 0)
+        self.assertEqual(len(query.all()), 3)
+
+        # the others are removed by the maintenance run
+        self.assertEqual(remove_expired_entries(backend.session), 2)
+        self.assertEqual(query.all(), [('session:c', )])
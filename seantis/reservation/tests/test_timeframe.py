@@ -0,0 +1,84 @@
+from datetime import date
+
+from plone.dexterity.utils import createContentInContainer
+from zope.component.hooks import getSite
+from zope.globalrequest import setRequest
+
+from seantis.reservation import exposure
+from seantis.reservation.tests import IntegrationTestCase
+from seantis.reservation.timeframe import TimeframeIndex, timeframe_index
+
+
+class TestTimeframe(IntegrationTestCase):
+
+    def test_timeframe_index(self):
+        index = TimeframeIndex([
+            (('', 'plone', 'a'), date(2014, 1, 1), date(2014, 1, 31), True),
+            (('', 'plone', 'a'), date(2014, 3, 1), date(2014, 3, 31), False),
+            (('', 'plone', 'a'), date(2014, 2, 1), date(2014, 2, 28), True),
+            (('', 'plone'), date(2014, 1, 1), date(2014, 12, 31), True),
+        ])
+
+        frames = index.timeframes_for(['', 'plone', 'a', 'resource'])
+
+        self.assertFalse(frames.is_visible(date(2013, 12, 31)))
+        self.assertTrue(frames.is_visible(date(2014, 1, 1)))
+        self.assertTrue(frames.is_visible(date(2014, 1, 31)))
+        self.assertTrue(frames.is_visible(date(2014, 2, 15)))
+        self.assertFalse(frames.is_visible(date(2014, 3, 15)))
+        self.assertFalse(frames.is_visible(date(2014, 4, 1)))
+
+        frames = index.timeframes_for(['', 'plone', 'b', 'resource'])
+        self.assertTrue(frames.is_visible(date(2014, 4, 1)))
+
+        self.assertIs(index.timeframes_for(['', 'other']), None)
+
+    def test_timeframe_index_invalidation(self):
+        self.login_manager()
+
+        resource = self.create_resource()
+        self.assertIs(timeframe_index().timeframes_for(resource), None)
+
+        createContentInContainer(
+            getSite(), 'seantis.reservation.timeframe',
+            start=date(2014, 1, 1), end=date(2014, 1, 31)
+        )
+
+        frames = timeframe_index().timeframes_for(resource)
+        self.assertTrue(frames.is_visible(date(2014, 1, 15)))
+        self.assertFalse(frames.is_visible(date(2014, 2, 15)))
+
+    def test_request_exposure(self):
+        self.login_manager()
+
+        r1 = self.create_resource()
+        r2 = self.create_resource()
+
+        setRequest(self.request())
+
+        try:
+            # the schedulers of a request share the exposure
+            shared = exposure.for_request()
+
+            for scheduler in (r1.scheduler(), r2.scheduler()):
+                self.assertIs(scheduler.is_allocation_exposed.im_self, shared)
+
+            self.assertIs(exposure.for_allocations([r1]).im_self, shared)
+            self.assertIs(exposure.for_days([r2.uuid()]).im_self, shared)
+
+            # managers see the allocations of all days
+            self.assertTrue(shared.is_exposed_on(r1.uuid(), date(2014, 1, 1)))
+            self.assertEqual(len(shared.timeframes), 2)
+
+            # the exposure is discarded once a timeframe changes
+            createContentInContainer(
+                getSite(), 'seantis.reservation.timeframe',
+                start=date(2014, 1, 1), end=date(2014, 1, 31)
+            )
+
+            self.assertIsNot(exposure.for_request(), shared)
+        finally:
+            setRequest(None)
+
+        # without a request, each call has its own exposure
+        self.assertIsNot(exposure.for_request(), exposure.for_request())
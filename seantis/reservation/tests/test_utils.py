@@ -1,4 +1,5 @@
 from datetime import datetime, timedelta, date
+from uuid import uuid4
 
 from seantis.reservation import utils
 from seantis.reservation import settings
@@ -322,3 +323,42 @@ class UtilsTestCase(IntegrationTestCase):
                 (datetime(2012, 1, 10), datetime(2012, 1, 12)),
             ]
         )
+
+    def test_get_resources_by_uuids(self):
+        self.login_manager()
+
+        first, second = self.create_resource(), self.create_resource()
+        missing = uuid4().hex
+
+        brains = utils.get_resources_by_uuids(
+            [first.uuid(), str(utils.real_uuid(second)), missing]
+        )
+
+        self.assertEqual(
+            sorted(brains.keys()),
+            sorted([utils.string_uuid(first), utils.string_uuid(second)])
+        )
+        self.assertIs(
+            utils.get_resource_by_uuid(first.uuid()),
+            brains[utils.string_uuid(first)]
+        )
+        self.assertIs(utils.get_resource_by_uuid(missing), None)
+
+        objects = utils.get_resource_objects_by_uuids([first.uuid()])
+        self.assertEqual(objects[utils.string_uuid(first)], first)
+
+    def test_url_template(self):
+        params = dict(
+            id=utils.urlfield('id'),
+            start=utils.urlfield('start'),
+            view='agendaDay'
+        )
+        template = utils.UrlTemplate('/plone/resource', 'reserve', params)
+
+        values = dict(id=12, start=u'2014-08-20 15:00 \xe4')
+        expected = utils.urlparam('/plone/resource', 'reserve', dict(
+            id=values['id'], start=values['start'], view='agendaDay'
+        ))
+
+        self.assertEqual(template.render(values), expected)
+        self.assertIn('start=2014-08-20%2015%3A00%20%C3%A4', expected)
@@ -1,13 +1,206 @@
-from datetime import datetime
+""" Throttles reservations, so that users without the 'Unthrottled
+Reservations' permission need to wait between reservations.
 
+The throttle is keyed by the seantis.reservation session id of the browser
+or by the ip address of the client. Which key is used and where the
+throttle is stored may be configured in the product-config of
+seantis.reservation:
+
+    throttle-key session (default) | ip
+    throttle-backend postgres (default) | memory
+
+The postgres backend keeps a sliding window in the database of the site,
+which is shared by all ZEO clients. The memory backend keeps a token bucket
+per key in the current process, which is faster but only works for
+instances with a single ZEO client.
+
+"""
+
+import threading
+import time
+
+from datetime import timedelta
+
+from libres.db.models import ORMBase
+from libres.db.models.types import UTCDateTime
+from sqlalchemy import Index, types
+from sqlalchemy.schema import Column
 from zope.component.hooks import getSite
+from zope.globalrequest import getRequest
 from zope.security import checkPermission
 
 from seantis.reservation import settings
 from seantis.reservation import error
+from seantis.reservation import plone_session
 from seantis.reservation import utils
 
 
+class ThrottleEntry(ORMBase):
+    """ A throttled action, kept until the throttle expires. """
+
+    __tablename__ = 'throttle_entries'
+
+    id = Column(types.Integer(), primary_key=True, autoincrement=True)
+    name = Column(types.Text(), nullable=False)
+    key = Column(types.Text(), nullable=False)
+    created = Column(UTCDateTime(timezone=False), nullable=False)
+
+    # the time after which the entry is removed by the maintenance run
+    expires = Column(UTCDateTime(timezone=False), nullable=False)
+
+    __table_args__ = (
+        Index('throttle_entries_lookup', 'name', 'key', 'created'),
+        Index('throttle_entries_expires', 'expires'),
+    )
+
+
+def remove_expired_entries(session):
+    """ Removes the entries of all keys whose throttle has expired. Returns
+    the number of entries removed.
+
+    This is done by the maintenance run (see seantis.reservation.maintenance)
+    instead of the reservations, which would otherwise all write the same
+    rows in their serializable transactions.
+
+    """
+    query = session.query(ThrottleEntry)
+    query = query.filter(ThrottleEntry.expires <= utils.utcnow())
+
+    return query.delete(synchronize_session=False)
+
+
+class MemoryBackend(object):
+    """ Keeps a token bucket with a single token per key in this process.
+
+    The token of a key is refilled once the required seconds have passed
+    since it was taken. To do this without locks, time is divided into
+    windows as long as the required seconds. Taking the token claims the
+    window with dict.setdefault, which is atomic, and fails if the current
+    window is claimed or if the previous window was claimed less than the
+    required seconds ago.
+
+    """
+
+    # the number of claims kept before expired claims are removed
+    max_entries = 10000
+
+    def __init__(self):
+        self.claims = {}
+
+    def acquire(self, name, key, seconds):
+        now = time.time()
+        window = int(now // seconds)
+
+        previous = self.claims.get((name, key, window - 1))
+
+        if previous is not None and now - previous[0] < seconds:
+            return None
+
+        claim = (now, object())
+
+        if self.claims.setdefault((name, key, window), claim) is not claim:
+            return None
+
+        if len(self.claims) > self.max_entries:
+            self.remove_expired(window)
+
+        def release():
+            if self.claims.get((name, key, window)) is claim:
+                self.claims.pop((name, key, window), None)
+
+        return release
+
+    def remove_expired(self, window):
+        for claim_key in self.claims.keys():
+            if claim_key[2] < window - 1:
+                self.claims.pop(claim_key, None)
+
+    def clear(self):
+        self.claims.clear()
+
+
+class PostgresBackend(object):
+    """ Keeps a sliding window per key in the database of the site.
+
+    The entries are written in the session of the reservation, so they
+    are only committed together with it.
+
+    """
+
+    @property
+    def session(self):
+        from seantis.reservation.session import Session
+        return Session()
+
+    def acquire(self, name, key, seconds):
+        session = self.session
+        now = utils.utcnow()
+        expired = now - timedelta(seconds=seconds)
+
+        query = session.query(ThrottleEntry)
+        query = query.filter(ThrottleEntry.name == name)
+        query = query.filter(ThrottleEntry.key == key)
+
+        # only the entries of the current key are touched, so reservations
+        # of other users don't conflict with this one. The expired entries
+        # of other keys are left to the maintenance run
+        query.filter(ThrottleEntry.created <= expired).delete(
+            synchronize_session=False
+        )
+
+        if session.query(query.exists()).scalar():
+            return None
+
+        entry = ThrottleEntry(
+            name=name, key=key, created=now,
+            expires=now + timedelta(seconds=seconds)
+        )
+        session.add(entry)
+        session.flush()
+
+        def release():
+            # a failed transaction is rolled back together with the entry
+            if session.is_active:
+                session.delete(entry)
+                session.flush()
+
+        return release
+
+    def clear(self):
+        self.session.query(ThrottleEntry).delete()
+
+
+backends = {
+    'memory': MemoryBackend,
+    'postgres': PostgresBackend
+}
+
+_backends = dict()  # the backend instances by name
+locks = {
+    '_backends': threading.Lock()
+}
+
+
+def get_backend():
+    name = utils.get_config('throttle-backend') or 'postgres'
+
+    if name not in _backends:
+        with locks['_backends']:
+            if name not in _backends:
+                _backends[name] = backends[name]()
+
+    return _backends[name]
+
+
+def clear_backends():
+    """ Clears the in-process state of the backends for testing. """
+
+    with locks['_backends']:
+        for backend in _backends.values():
+            if isinstance(backend, MemoryBackend):
+                backend.clear()
+
+
 def is_throttling_active():
     return not checkPermission(
         'seantis.reservation.UnthrottledReservations', getSite()
@@ -20,31 +213,34 @@ def seconds_required():
     return settings.get('throttle_minutes') * 60
 
 
-def session_get(key):
-    man = getSite().session_data_manager
-    return man.hasSessionData() and man.getSessionData().get(key) or None
+def throttle_key():
+    """ Returns the key identifying the current user. """
 
+    if utils.get_config('throttle-key') == 'ip':
+        return 'ip:{}'.format(getRequest().getClientAddr())
 
-def session_set(key, value):
-    man = getSite().session_data_manager
-    man.getSessionData()[key] = value
+    # the session id is created by the reservation anyway, so reading it
+    # here does not lead to an additional write
+    return 'session:{}'.format(plone_session.get_session_id(getSite()))
 
 
 def apply(name):
-    key = 'throttle_' + name
-    last_change = session_get(key)
+    seconds = seconds_required()
 
-    if last_change:
-        delta = (datetime.today() - last_change)
-        seconds_since = utils.total_timedelta_seconds(delta)
+    if not seconds:
+        return lambda: None
 
-        if seconds_since < seconds_required():
-            raise error.ThrottleBlock
+    release = get_backend().acquire(
+        '{}:{}'.format('/'.join(getSite().getPhysicalPath()), name),
+        throttle_key(),
+        seconds
+    )
 
-    session_set(key, datetime.today())
+    if release is None:
+        raise error.ThrottleBlock
 
     # return a function which resets the throttle if called
-    return lambda: last_change and session_set(key, last_change)
+    return release
 
 
 def throttled(function, name):
@@ -1,3 +1,4 @@
+from bisect import bisect_right
 from datetime import datetime
 
 from five import grok
@@ -7,16 +8,16 @@ from plone.memoize import view
 from Products.CMFCore.utils import getToolByName
 from Products.CMFCore.interfaces import IFolderish
 from z3c.form import button
+from zope.component.hooks import getSite
 
 from seantis.reservation import _
 from seantis.reservation.base import BaseViewlet
 from seantis.reservation.interfaces import (
     ITimeframe, OverviewletManager, ISeantisReservationSpecific
 )
+from seantis.reservation import cache
 from seantis.reservation import utils
 
-# TODO cache all timeframe stuff for an hour or so.. no frequent updates needed
-
 
 class Timeframe(Item):
     @property
@@ -64,6 +65,93 @@ def timeframes_by_context(context):
     )
 
 
+class TimeframeSet(object):
+    """ The timeframes of a single folder, sorted by start date. As the
+    timeframes of a folder may not overlap, the timeframe of a day is found
+    by bisecting the start dates.
+
+    """
+
+    def __init__(self, frames):
+        self.frames = sorted(frames)
+        self.starts = [frame[0] for frame in self.frames]
+
+    def is_visible(self, day):
+        """ Returns true if the given day lies in a visible timeframe. """
+
+        ix = bisect_right(self.starts, day) - 1
+
+        if ix < 0:
+            return False
+
+        start, end, visible = self.frames[ix]
+        return day <= end and visible
+
+
+class TimeframeIndex(object):
+    """ Site-wide index of all timeframes, grouped by the path of the folder
+    they are stored in.
+
+    """
+
+    def __init__(self, frames):
+        folders = {}
+
+        for path, start, end, visible in frames:
+            folders.setdefault(path, []).append((start, end, visible))
+
+        self.folders = dict(
+            (path, TimeframeSet(f)) for path, f in folders.items()
+        )
+
+    def timeframes_for(self, context):
+        """ Returns the timeframe set of the given context. Like in
+        :func:`timeframes_by_context` this is the set of the nearest folder
+        up the path containing timeframes.
+
+        Returns None if there are no timeframes for the context.
+
+        """
+        path = tuple(utils.context_path(context))
+
+        while path:
+            if path in self.folders:
+                return self.folders[path]
+
+            path = path[:-1]
+
+        return None
+
+
+def build_timeframe_index(site):
+    catalog = getToolByName(site, 'portal_catalog')
+    brains = catalog.unrestrictedSearchResults(
+        portal_type='seantis.reservation.timeframe'
+    )
+
+    return TimeframeIndex((
+        (
+            tuple(brain.getPath().split('/')[:-1]),
+            brain.start,
+            brain.end,
+            brain.review_state == 'visible'
+        ) for brain in brains
+    ))
+
+
+def timeframe_index():
+    """ Returns the timeframe index of the current site. The index is kept
+    in a process-wide cache and rebuilt if a timeframe changes.
+
+    """
+    site = getSite()
+    key = '/'.join(site.getPhysicalPath())
+
+    return cache.timeframe_indexes.cached(
+        key, (key, ), lambda: build_timeframe_index(site)
+    )
+
+
 def overlapping_timeframe(context, start, end):
     if context.portal_type == 'seantis.reservation.timeframe':
         folder = context.aq_inner.aq_parent
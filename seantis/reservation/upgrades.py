@@ -52,6 +52,17 @@ def db_upgrade(fn):
     return wrapper
 
 
+def create_table(operations, table):
+    """ Creates the given table unless it exists already, which is the case
+    if the upgrade already went through on a site sharing the database.
+
+    """
+    bind = operations.get_bind()
+
+    if not bind.dialect.has_table(bind, table.name):
+        table.create(bind=bind)
+
+
 def recook_js_resources(context):
     getToolByName(context, 'portal_javascripts').cookResources()
 
@@ -372,3 +383,35 @@ def upgrade_1033_to_1034(operations, metadata):
             'reservations',
             Column('type', types.Text(), nullable=True)
         )
+
+
+@db_upgrade
+def upgrade_1034_to_1035(operations, metadata):
+    from seantis.reservation.summary import AvailabilitySummary
+    create_table(operations, AvailabilitySummary.__table__)
+
+
+@db_upgrade
+def upgrade_1035_to_1036(operations, metadata):
+    from seantis.reservation.throttle import ThrottleEntry
+    create_table(operations, ThrottleEntry.__table__)
+
+
+@db_upgrade
+def upgrade_1036_to_1037(operations, metadata):
+    from seantis.reservation.outbox import OutboxMessage
+    create_table(operations, OutboxMessage.__table__)
+
+
+@db_upgrade
+def upgrade_1037_to_1038(operations, metadata):
+    from seantis.reservation.search_index import AllocationSearchEntry
+    create_table(operations, AllocationSearchEntry.__table__)
+
+
+def upgrade_1038_to_1039(context):
+    from seantis.reservation.session import Session
+    from seantis.reservation.summary import rebuild
+
+    # the search index is built together with the summary
+    rebuild(Session())
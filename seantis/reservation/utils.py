@@ -25,9 +25,12 @@ import pytz
 from plone.dexterity.utils import SchemaNameEncoder
 
 from App.config import getConfiguration
+from AccessControl import getSecurityManager
 from Acquisition import aq_inner
+from zope.annotation.interfaces import IAnnotations
 from zope.component import getMultiAdapter
 from zope.component.hooks import getSite
+from zope.globalrequest import getRequest
 from zope import i18n
 from zope import interface
 from Products.CMFCore.utils import getToolByName
@@ -585,18 +588,85 @@ def uuid_query(uuid):
         uuid[:8], uuid[8:12], uuid[12:16], uuid[16:20], uuid[20:]]))
 
 
-def get_resource_by_uuid(
-    uuid, ensure_portal_type='seantis.reservation.resource'
+def request_cache(name):
+    """ Returns a dictionary stored on the current request, which may be used
+    as a cache that lives exactly as long as the request. The dictionary is
+    bound to the current user, as the user may change during a request.
+
+    If there's no request, a new dictionary is returned every time.
+
+    """
+    request = getRequest()
+
+    if request is None:
+        return {}
+
+    try:
+        annotations = IAnnotations(request)
+    except TypeError:
+        return {}
+
+    user = getSecurityManager().getUser()
+    key = ('seantis.reservation', name, user and user.getId() or None)
+
+    if key not in annotations:
+        annotations[key] = {}
+
+    return annotations[key]
+
+
+def get_resources_by_uuids(
+    uuids, ensure_portal_type='seantis.reservation.resource'
 ):
-    """Returns the zodb object with the given uuid."""
-    catalog = getToolByName(getSite(), 'portal_catalog')
+    """Returns a dictionary with the given uuids as keys (as returned by
+    string_uuid) and the catalog brains as values.
+
+    All uuids not yet resolved during the current request are looked up with
+    a single catalog query. Uuids which cannot be found are left out.
+
+    """
+    brains = request_cache('brains-%s' % ensure_portal_type)
+    uuids = set(string_uuid(uuid) for uuid in uuids)
+    missing = [uuid for uuid in uuids if uuid not in brains]
+
+    if missing:
+        catalog = getToolByName(getSite(), 'portal_catalog')
+
+        query = dict(UID=list(flatten(uuid_query(uuid) for uuid in missing)))
+
+        if ensure_portal_type:
+            query['portal_type'] = ensure_portal_type
+
+        for brain in catalog(**query):
+            brains[string_uuid(brain.UID)] = brain
+
+    return dict((uuid, brains[uuid]) for uuid in uuids if uuid in brains)
 
-    if ensure_portal_type:
-        results = catalog(UID=uuid_query(uuid), portal_type=ensure_portal_type)
-    else:
-        results = catalog(UID=uuid_query(uuid))
 
-    return len(results) == 1 and results[0] or None
+def get_resource_objects_by_uuids(
+    uuids, ensure_portal_type='seantis.reservation.resource'
+):
+    """Same as get_resources_by_uuids, but with the zodb objects as values.
+    The objects are kept for the rest of the request as well.
+
+    """
+    objects = request_cache('objects-%s' % ensure_portal_type)
+    brains = get_resources_by_uuids(uuids, ensure_portal_type)
+
+    for uuid, brain in brains.items():
+        if uuid not in objects:
+            objects[uuid] = brain.getObject()
+
+    return dict((uuid, objects[uuid]) for uuid in brains)
+
+
+def get_resource_by_uuid(
+    uuid, ensure_portal_type='seantis.reservation.resource'
+):
+    """Returns the catalog brain of the zodb object with the given uuid."""
+    return get_resources_by_uuids([uuid], ensure_portal_type).get(
+        string_uuid(uuid)
+    )
 
 
 def get_resource_title(resource, title_prefix=''):
@@ -634,46 +704,61 @@ def json_loads(value):
 
 
 def json_dumps(value):
-    if value is not None:
-        return json.dumps(value, cls=UserFormDataEncoder)
-    else:
-        return ''
+    from seantis.reservation import serializer
+    return serializer.dumps_userformdata(value)
 
 
-class UUIDEncoder(json.JSONEncoder):
-    """Encodes UUID objects as string in JSON."""
-    def default(self, obj):
-        if isinstance(obj, UUID):
-            return string_uuid(obj)
-        return json.JSONEncoder.default(self, obj)
+def converter(converters):
+    """Returns a function for the default hook of a json encoder, which
+    converts the objects of the types in the given dictionary using the
+    function stored for the type (or the nearest base class).
 
+    """
+    def convert(obj):
+        for cls in type(obj).__mro__:
+            if cls in converters:
+                return converters[cls](obj)
 
-class UserFormDataEncoder(json.JSONEncoder):
-    """Encodes additional user data."""
+        raise TypeError(repr(obj) + " is not JSON serializable")
+
+    return convert
 
-    def default(self, obj):
 
-        if isinstance(obj, set):
-            return list(obj)
+def encode_richtext(obj):
+    return u'__richtext__@%s' % base64.b64encode(json.dumps(dict(
+        raw=obj.raw,
+        encoding=obj.encoding,
+        mime=obj.mimeType,
+        output_mime=obj.outputMimeType
+    )))
 
-        if isinstance(obj, datetime):
-            return u'__datetime__@%s' % isodate.datetime_isoformat(obj)
 
-        if isinstance(obj, date):
-            return u'__date__@%s' % isodate.date_isoformat(obj)
+# encodes UUID objects as string
+encode_uuid = converter({
+    UUID: string_uuid
+})
 
-        if isinstance(obj, datetime_time):
-            return u'__time__@%s' % isodate.time_isoformat(obj)
+# encodes additional user data, in a way that userformdata_decode reverts
+encode_userformdata = converter({
+    set: list,
+    datetime: lambda obj: u'__datetime__@%s' % isodate.datetime_isoformat(obj),
+    date: lambda obj: u'__date__@%s' % isodate.date_isoformat(obj),
+    datetime_time: lambda obj: u'__time__@%s' % isodate.time_isoformat(obj),
+    RichTextValue: encode_richtext
+})
 
-        if isinstance(obj, RichTextValue):
-            return u'__richtext__@%s' % base64.b64encode(json.dumps(dict(
-                raw=obj.raw,
-                encoding=obj.encoding,
-                mime=obj.mimeType,
-                output_mime=obj.outputMimeType
-            )))
 
-        return json.JSONEncoder.default(self, obj)
+class UUIDEncoder(json.JSONEncoder):
+    """Encodes UUID objects as string in JSON."""
+    def default(self, obj):
+        return encode_uuid(obj)
+
+
+class UserFormDataEncoder(json.JSONEncoder):
+    """Encodes additional user data."""
+
+    def default(self, obj):
+        return encode_userformdata(obj)
 
 
 def userformdata_decode(string):
@@ -774,7 +859,8 @@ def allocation_class(allocation):
 
 
 def event_availability(
-    context, request, scheduler, allocation, start=None, end=None
+    context, request, scheduler, allocation, start=None, end=None,
+    availability=None, waitinglist_length=None, spots=None
 ):
     """ Returns the availability, the text with the availability and the class
     for the availability to display on the calendar view.
@@ -784,21 +870,28 @@ def event_availability(
     returns True. That is if the timespan between start and end
     is completely reservable.
 
-    This is very involved and slow, so you probably shouldn't use that.
     This feature tries to account for the fact that parts of allocations
     can be reserved in search, where the user gets the impression that
     the time he entered is the actual allocation, when that timespan might
     only refer to a part of the allocation.
 
-    For now this will be a new features which we'll test against. In the
-    future this needs to be made much faster => TODO.
+    Going through the slots of the allocation and its mirrors is slow, so
+    the spots of the allocation should be passed if many allocations are
+    shown. See seantis.reservation.free_slots.
+
+    The availability and the waitinglist length may be passed if they are
+    already known, to avoid two queries per allocation. See
+    CustomScheduler.allocation_availabilities.
 
     """
     translate = translator(context, request)
 
     if start and end and allocation.partly_available:
-        availability = allocation.find_spot(start, end) and 100 or 0
-    else:
+        if spots is not None:
+            availability = spots.find_spot(start, end) and 100 or 0
+        else:
+            availability = allocation.find_spot(start, end) and 100 or 0
+    elif availability is None:
         availability = scheduler.availability(allocation.start, allocation.end)
 
     spots = int(round(allocation.quota * availability / 100))
@@ -818,7 +911,10 @@ def event_availability(
 
     # with approval the number of people in the waitinglist have to be shown
     if allocation.approve_manually:
-        length = allocation.waitinglist_length
+        if waitinglist_length is None:
+            length = allocation.waitinglist_length
+        else:
+            length = waitinglist_length
         if length == 0:
             text += '\n' + translate(_(u'Waitinglist is Free'))
         elif length == 1:
@@ -881,6 +977,20 @@ def safe_parse_int(value, default):
         return default
 
 
+def skip_locked(session, query):
+    """ Locks the rows returned by the given query, skipping the rows locked
+    by other transactions if the database supports it (PostgreSQL 9.5+).
+    Otherwise the query waits for the locks to be released.
+
+    """
+    version = session.bind.dialect.server_version_info or (0, )
+
+    if version >= (9, 5):
+        return query.with_for_update(skip_locked=True)
+    else:
+        return query.with_for_update()
+
+
 def get_config(key):
     config = getConfiguration()
     if not hasattr(config, 'product_config'):
@@ -964,84 +1074,126 @@ def merge_reserved_slots(slots):
     return merged
 
 
+def urlquote(fragment):
+    return quote(six.text_type(fragment).encode('utf-8'))
+
+
 def urlparam(base, url, params):
     """Joins an url, adding parameters as query parameters."""
     if not base.endswith('/'):
         base += '/'
 
-    urlquote = lambda fragment: quote(six.text_type(fragment).encode('utf-8'))
     querypair = lambda pair: pair[0] + '=' + urlquote(pair[1])
 
     query = '?' + '&'.join(map(querypair, params.items()))
     return ''.join(functools.reduce(urljoin, (base, url, query)))
 
 
+def urlfield(name):
+    """Returns a placeholder for the parameter value with the given name,
+    to be used with UrlTemplate.
+
+    """
+    return u'\x00%s\x00' % name
+
+
+class UrlTemplate(object):
+    """An url built by urlparam, with some of the parameter values left as
+    placeholders (see urlfield). Rendering the url only quotes the values
+    and joins them with the rest of the url.
+
+    """
+
+    # the quoted placeholders
+    placeholder = re.compile(r'%00([a-z_]+)%00')
+
+    def __init__(self, base, url, params):
+        self.parts = self.placeholder.split(urlparam(base, url, params))
+
+    def render(self, values):
+        parts = self.parts[:]
+
+        for ix in range(1, len(parts), 2):
+            parts[ix] = urlquote(values[parts[ix]])
+
+        return ''.join(parts)
+
+
 class EventUrls(object):
+    """The urls of a single event, as rendered by EventUrlTemplates."""
+
+    def __init__(self, default, move, menu, order):
+        self.default = default
+        self.move = move
+        self.menu = menu
+        self.order = order
+
+
+class EventUrlTemplates(object):
+    """Holds the urls and the menu entries of calendar events which only
+    differ by the values of their parameters.
+
+    The permissions of the views are checked and the menu entries are
+    translated once, when they are added. The urls of each event are then
+    rendered by filling in the values of the event.
+
+    """
+
     def __init__(self, resource, request, exposure):
         self.resource = resource
         self.base = resource.absolute_url_path()
-        self.request = request
         self.translate = translator(resource, request)
-        self.menu = {}
-        self.order = []
-        self.exposure = exposure
-        self.default = ""
-        self.move = ""
-
-    @memoize
-    def restricted_url(self, view):
-        """Returns a function which can be used to build an url with optional
-        parameters. The function only builds the url if the current user has
-        the right to do so.
+        self.is_exposed = exposure.for_views(resource, request)
+        self.entries = []
+        self.default = None
+        self.move = None
+
+    def restricted_template(self, view, params):
+        """Returns the template of the url with the given parameters or None
+        if the current user has no right to see the view.
 
         """
-        base = self.resource.absolute_url_path()
-        is_exposed = self.exposure.for_views(self.resource, self.request)
-
-        def build(params):
-            if is_exposed(view):
-                return urlparam(base, view, params)
-            else:
-                return None
-
-        # return closure
-        return build
-
-    @memoize
-    def get_restricted(self, view, params):
-        urlfactory = self.restricted_url(view)
-        if not urlfactory:
+        if not self.is_exposed(view):
             return None
 
-        return urlfactory(params)
+        return UrlTemplate(self.base, view, params)
 
     def menu_add(self, group, name, view, params, target):
-        url = self.get_restricted(view, params)
-        if not url:
+        template = self.restricted_template(view, params)
+        if not template:
             return
 
-        group = self.translate(group)
-        name = self.translate(name)
+        self.entries.append((
+            self.translate(group), self.translate(name), template, target
+        ))
 
-        if group not in self.menu:
-            self.menu[group] = []
-            self.order.append(group)
+    def default_url(self, view, params):
+        self.default = self.restricted_template(view, params)
 
-        self.menu[group].append(dict(name=name, url=url, target=target))
+    def move_url(self, view, params):
+        self.move = self.restricted_template(view, params)
 
-    def default_url(self, view, params):
-        url = self.get_restricted(view, params)
-        if not url:
-            return
+    def render(self, values):
+        """Returns the urls of the event with the given parameter values."""
 
-        self.default = url
+        menu = {}
+        order = []
 
-    def move_url(self, view, params):
-        url = self.get_restricted(view, params)
-        if not url:
-            return
+        for group, name, template, target in self.entries:
+            if group not in menu:
+                menu[group] = []
+                order.append(group)
 
-        self.move = url
+            menu[group].append(
+                dict(name=name, url=template.render(values), target=target)
+            )
+
+        return EventUrls(
+            default=self.default and self.default.render(values) or "",
+            move=self.move and self.move.render(values) or "",
+            menu=menu,
+            order=order
+        )
 
 
 def get_date_range(day, start_time, end_time):
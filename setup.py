@@ -12,6 +12,9 @@ zug_require = [
 teamraum_require = [
     'plonetheme.teamraum'
 ]
+speedups_require = [
+    'simplejson'
+]
 tests_require = [
     'collective.betterbrowser[pyquery]',
     'collective.testcaselayer',
@@ -74,7 +77,7 @@ setup(name=name, version=version, description=description,
           'setuptools',
           'seantis.plonetools>=0.11',
           'six',
-          'SQLAlchemy>=0.7.3',
+          'SQLAlchemy>=1.2',
           'tablib',
           'xlwt',
           'zope.sqlalchemy',
@@ -82,12 +85,16 @@ setup(name=name, version=version, description=description,
       extras_require=dict(
           zug=zug_require,
           tests=tests_require,
-          teamraum=teamraum_require
+          teamraum=teamraum_require,
+          speedups=speedups_require
       ),
       entry_points="""
       # -*- Entry points: -*-
 
       [z3c.autoinclude.plugin]
       target = plone
+
+      [console_scripts]
+      seantis-reservation-maintenance = seantis.reservation.maintenance:main
       """
       )